@@ -626,8 +626,9 @@ class Config:
         return "ignorecat" in self.optionMap or self.isRecording()
 
     def hasPerformance(self, app, perfType=""):
-        extractors = app.getConfigValue("performance_logfile_extractor")
-        if (perfType and perfType in extractors) or (not perfType and len(extractors) > 0):
+        perfStems = list(app.getConfigValue("performance_logfile_extractor").keys()) + \
+            list(app.getConfigValue("performance_resource_usage").keys())
+        if (perfType and perfType in perfStems) or (not perfType and len(perfStems) > 0):
             return True
         else:
             return app.hasAutomaticCputimeChecking()
@@ -903,6 +904,16 @@ class Config:
         infoFinder.setUpApplication(test.app)
         return infoFinder.allMachinesTestPerformance(test, stem)
 
+    def getExpectedRunTime(self, test, allApps):
+        """ Seconds the test is expected to take: from its performance file, or failing that from earlier batch runs """
+        try:
+            expectedTime = performance.getTestPerformance(test)
+            if expectedTime >= 0:
+                return expectedTime
+        except ValueError:
+            pass
+        return batch.findStoredPerformance(test, allApps)
+
     def getMachineInfoFinder(self):
         return sandbox.MachineInfoFinder()
 
@@ -1236,6 +1247,8 @@ class Config:
                              "Password for SMTP authentication when sending mail in batch mode")
         app.setConfigDefault("batch_result_repository", {"default": ""},
                              "Directory to store historical batch results under")
+        app.setConfigDefault("batch_result_database", {"default": "false"},
+                             "Store historical batch results in a database file in the batch_result_repository, rather than in files per test")
         app.setConfigDefault("file_to_url", {}, "Mapping of file locations to URLS, for linking to HTML reports")
         app.setConfigDefault("historical_report_location", {"default": ""},
                              "Directory to create reports on historical batch data under")
@@ -1295,6 +1308,8 @@ class Config:
                              "Which result file to collect performance data from")
         app.setConfigDefault("performance_logfile_extractor", {},
                              "What string to look for when collecting performance data")
+        app.setConfigDefault("performance_resource_usage", {},
+                             "Mapping of performance file names to what to measure of the test process directly (maxrss, blockio or contextswitches)")
         app.setConfigDefault("performance_test_machine", {"default": [], "*mem*": ["any"]},
                              "List of machines where performance can be collected")
         app.setConfigDefault("performance_variation_%", {"default": 10.0},
@@ -1417,6 +1432,8 @@ class Config:
                              "Mapping of result file names to paths to collect them from")
         app.setConfigDefault("collate_script", self.getDefaultCollateScripts(),
                              "Mapping of result file names to scripts which turn them into suitable text")
+        app.setConfigDefault("collate_script_processes", 0,
+                             "Number of collate_script pipelines to run in parallel for a test (0 means run them one at a time). Collations must not read each other's results")
         trafficText = "Deprecated. Use CaptureMock."
         app.setConfigDefault("collect_traffic", {"default": [], "asynchronous": []}, trafficText)
         app.setConfigDefault("collect_traffic_environment", {"default": []}, trafficText)
@@ -1430,6 +1447,8 @@ class Config:
 
         app.setConfigDefault("unordered_text", {"default": []},
                              "Mapping of patterns to extract and sort from result files", trackFiles=True)
+        app.setConfigDefault("filter_processes", 0,
+                             "Number of processes to filter a test's result files in parallel (0 means filter them one at a time)")
         app.setConfigDefault("file_split_pattern", {}, "Pattern to use for splitting result files")
         app.setConfigDefault("create_catalogues", "false", "Do we create a listing of files created/removed by tests")
         app.setConfigAlias("collect_file_changes", "create_catalogues")
@@ -1492,16 +1511,16 @@ class Config:
         return "tkdiff"
 
     def setExternalToolDefaults(self, app, homeOS):
-        app.setConfigDefault("text_diff_program", "diff",
-                             "External program to use for textual comparison of files")
+        app.setConfigDefault("text_diff_program", "builtin",
+                             "External program to use for textual comparison of files. 'builtin' means generate a unified diff without running anything")
         app.setConfigDefault("lines_of_text_difference", 30,
                              "How many lines to present in textual previews of file diffs")
         app.setConfigDefault("max_width_text_difference", 500,
                              "How wide lines can be in textual previews of file diffs")
         app.setConfigDefault("max_file_size", {
                              "default": "-1"}, "The maximum file size to load into external programs, in bytes. -1 means no limit.")
-        app.setConfigDefault("text_diff_program_filters", {"default": [], "diff": [
-                             "^<", "^>"]}, "Filters that should be applied for particular diff tools to aid with grouping in dynamic GUI")
+        app.setConfigDefault("text_diff_program_filters", {"default": [], "diff": ["^<", "^>"], "builtin": [
+                             "^-", "^\\+"]}, "Filters that should be applied for particular diff tools to aid with grouping in dynamic GUI")
         app.setConfigDefault("diff_program", {"default": self.defaultDiffProgram()},
                              "External program to use for graphical file comparison")
         app.setConfigDefault("view_program", {"default": self.defaultViewProgram(homeOS)},
@@ -1518,6 +1537,10 @@ class Config:
                              "Username to use when logging in to bug systems defined in bug_system_location")
         app.setConfigDefault("bug_system_password", {},
                              "Password to use when logging in to bug systems defined in bug_system_location")
+        app.setConfigDefault("bug_system_cache_minutes", {"default": 0},
+                             "How long to keep information from bug systems in a file in the personal directory, for use by later runs")
+        app.setConfigDefault("bug_system_prefetch", 0,
+                             "Look up all bugs in known bugs files in the bug systems in parallel when tests start, rather than when tests find them")
         app.setConfigDefault("batch_jenkins_marked_artefacts", {
                              "default": []}, "Artefacts to highlight in the report when they are updated")
         app.setConfigDefault("batch_jenkins_archive_file_pattern", {
@@ -1654,6 +1677,10 @@ class Config:
                              "Default value for $TEXTTEST_TMP, if it is not set")
         app.setConfigDefault("default_texttest_local_tmp", "",
                              "Default value for $TEXTTEST_LOCAL_TMP, if it is not set")
+        app.setConfigDefault("reconnect_link_files", 1,
+                             "When recomputing results on reconnect, share the original run's files rather than copying them: 1 uses reflinks where the file system supports them, 2 also uses hard links otherwise, 0 always copies")
+        app.setConfigDefault("reconnect_threads", 8,
+                             "Number of threads to load the tests' stored results with when reconnecting (1 means load them one at a time)")
         app.setConfigDefault("checkout_location", {"default": []}, "Absolute paths to look for checkouts under")
         app.setConfigDefault("default_checkout", "", "Default checkout, relative to the checkout location")
         app.setConfigDefault("remote_shell_program", "ssh", "Program to use for running commands remotely")
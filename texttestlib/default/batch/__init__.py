@@ -9,14 +9,17 @@ import logging
 import re
 import tarfile
 import stat
+import sqlite3
 from texttestlib.default.batch import testoverview
 from texttestlib import plugins
 from .summarypages import GenerateSummaryPage, GenerateGraphs  # only so they become package level entities
 from .ci import CIPlatform
+from .resultdatabase import ResultDatabase
 from collections import OrderedDict
 from .batchutils import getBatchRunName, BatchVersionFilter, parseFileName, convertToUrl
 import subprocess
 from glob import glob
+from io import BytesIO
 
 
 class BatchCategory(plugins.Filter):
@@ -453,11 +456,47 @@ def getVersionName(app, allApps):
         return "default"
 
 
+def usesResultDatabase(app):
+    return app.getBatchConfigValue("batch_result_database") == "true"
+
+
 def getBatchRepository(suite):
     repo = suite.app.getBatchConfigValue("batch_result_repository", envMapping=suite.environment)
     return os.path.expanduser(repo)
 
 
+def findLatestStoredState(test, allApps):
+    """ The most recent test state saved for this test in the batch result repository, if there is one.
+    Only failures are saved there unless resource pages are enabled. """
+    repository = getBatchRepository(test)
+    if not repository:
+        return
+    version = getVersionName(test.app, allApps)
+    try:
+        if usesResultDatabase(test.app):
+            if ResultDatabase.exists(repository):
+                stateData = ResultDatabase.readLatestState(repository, test.app.name, version, test.getRelPath())
+                if stateData:
+                    return plugins.getNewTestStateFromFile(BytesIO(stateData))
+        else:
+            targetDir = os.path.join(repository, test.app.name, version, test.getRelPath())
+            stateFiles = glob(os.path.join(targetDir, "teststate_*"))
+            if stateFiles:
+                with open(max(stateFiles, key=os.path.getmtime), "rb") as f:
+                    return plugins.getNewTestStateFromFile(f)
+    except Exception as e:
+        logging.getLogger("Result Database").info("Failed to read stored state for " + repr(test) + " : " + str(e))
+
+
+def findStoredPerformance(test, allApps):
+    state = findLatestStoredState(test, allApps)
+    if state and hasattr(state, "findComparison"):
+        comparison = state.findComparison(test.getConfigValue("default_performance_stem"), includeSuccess=True)[0]
+        perfComparison = getattr(comparison, "perfComparison", None)
+        if perfComparison and perfComparison.newPerformance >= 0:
+            return perfComparison.newPerformance
+
+
 def dateInSeconds(val):
     return time.mktime(time.strptime(val, "%d%b%Y"))
 
@@ -523,14 +562,19 @@ class SaveState(plugins.Responder):
 
     def saveToRepository(self, test):
         testRepository = self.repositories[test.app]
-        targetDir = os.path.join(testRepository, test.app.name, getVersionName(test.app, self.allApps),
-                                 test.getRelPath())
+        version = getVersionName(test.app, self.allApps)
+        # Need to store teststate files for succeeded tests if we have resource pages
+        storeState = not test.state.hasSucceeded() or len(test.app.getBatchConfigValue("historical_report_resources")) > 0
+        if usesResultDatabase(test.app):
+            self.saveToDatabase(test, testRepository, version, storeState)
+            return
+
+        targetDir = os.path.join(testRepository, test.app.name, version, test.getRelPath())
         try:
             plugins.ensureDirectoryExists(targetDir)
         except EnvironmentError:
             plugins.printWarning("Could not create directory at " + targetDir)
-        # Need to store teststate files for succeeded tests if we have resource pages
-        if test.state.hasSucceeded() and len(test.app.getBatchConfigValue("historical_report_resources")) == 0:
+        if not storeState:
             targetFile = os.path.join(targetDir, self.successFileName)
             with open(targetFile, "a") as f:
                 writeSuccessLine(f, self.runPostfix, test.state)
@@ -544,6 +588,19 @@ class SaveState(plugins.Responder):
                 except EnvironmentError:
                     plugins.printWarning("Could not write file at " + targetFile)
 
+    def saveToDatabase(self, test, testRepository, version, storeState):
+        try:
+            database = ResultDatabase.getInstance(testRepository)
+            stateData = None
+            if storeState:
+                with open(test.getStateFile(), "rb") as f:
+                    stateData = f.read()
+            if not database.addResult(test.app.name, version, self.runPostfix, test.getRelPath(), test.state, stateData):
+                plugins.printWarning("Result already exists for " + repr(test) + " in run " + self.runPostfix +
+                                     " in " + database.path + " - not overwriting!")
+        except (EnvironmentError, sqlite3.Error) as e:
+            plugins.printWarning("Could not save result for " + repr(test) + " to batch result database : " + str(e))
+
     def addSuite(self, suite):
         testStateRepository = getBatchRepository(suite)
         self.diag.info("Test state repository is " + repr(testStateRepository))
@@ -631,6 +688,66 @@ class MigrateBatchRepository(plugins.Action):
             self.migrate(repository)
 
 
+class MigrateBatchRepositoryToDatabase(plugins.Action):
+    """ Moves the results stored in the directory structure into the batch result database """
+    def __init__(self):
+        self.successFileName = "succeeded_runs"
+
+    def migrateStateFile(self, database, appName, version, testPath, path):
+        with open(path, "rb") as f:
+            stateData = f.read()
+        state = testoverview.GenerateWebPages.readStateData(stateData)
+        tag = os.path.basename(path).replace("teststate_", "")
+        return database.addResult(appName, version, tag, testPath, state, stateData, commit=False)
+
+    def migrateSuccessFile(self, database, appName, version, testPath, path):
+        with open(path) as f:
+            for line in f:
+                parts = line.strip().split(" ", 1)
+                if len(parts) == 2:
+                    tag, text = parts
+                    brief, hosts = testoverview.parseState(text)
+                    state = plugins.TestState("success", briefText=brief.strip(), executionHosts=hosts)
+                    if not database.addResult(appName, version, tag, testPath, state, commit=False):
+                        plugins.printWarning("More than one result present for tag '" + tag + "' in file " + path +
+                                             ", ignoring later ones")
+        return True
+
+    def migrate(self, repository, appName):
+        database = ResultDatabase.getInstance(repository)
+        appDir = os.path.join(repository, appName)
+        plugins.log.info("Migrating repository at " + appDir + " to database at " + database.path)
+        migratedFiles = []
+        for version in sorted(os.listdir(appDir)):
+            versionDir = os.path.join(appDir, version)
+            if not os.path.isdir(versionDir):
+                continue
+            for root, _, files in sorted(os.walk(versionDir)):
+                testPath = os.path.relpath(root, versionDir)
+                for f in sorted(files):
+                    path = os.path.join(root, f)
+                    if f.startswith("teststate_"):
+                        if not self.migrateStateFile(database, appName, version, testPath, path):
+                            plugins.printWarning("Result already present in database for " + path + ", ignoring it")
+                        migratedFiles.append(path)
+                    elif f.startswith("succeeded_"):
+                        self.migrateSuccessFile(database, appName, version, testPath, path)
+                        migratedFiles.append(path)
+        database.commit()
+        # Only remove the files once the database has everything
+        for path in migratedFiles:
+            os.remove(path)
+        plugins.log.info("Migrated " + str(len(migratedFiles)) + " files. Set 'batch_result_database' to 'true' to use them.")
+
+    def setUpSuite(self, suite):
+        if suite.parent is None:
+            repository = getBatchRepository(suite)
+            appDir = os.path.join(repository, suite.app.name)
+            if not os.path.isdir(appDir):
+                raise plugins.TextTestError("Batch result repository " + appDir + " does not exist")
+            self.migrate(os.path.abspath(repository), suite.app.name)
+
+
 class ArchiveScript(plugins.ScriptWithArgs):
     def __init__(self, argDict):
         self.descriptors = []
@@ -1059,6 +1176,8 @@ class WebPageResponder(plugins.Responder):
         return repositories
 
     def checkRepository(self, repository, app):
+        if usesResultDatabase(app) and ResultDatabase.exists(os.path.dirname(repository)):
+            return True
         if not os.path.isdir(repository):
             plugins.printWarning("Batch result repository " + repository +
                                  " does not exist - not creating pages for " + repr(app))
@@ -1151,10 +1270,17 @@ class WebPageResponder(plugins.Responder):
                 return versionToCheck
         return ""
 
+    def listVersions(self, repository, app):
+        if usesResultDatabase(app):
+            database = ResultDatabase.getInstance(os.path.dirname(repository))
+            return database.getVersions(os.path.basename(repository))
+        else:
+            return os.listdir(repository)
+
     def findRelevantSubdirectories(self, repositories, app, extraVersions, versionTitleMethod=None):
         subdirs = OrderedDict()
         for repository in repositories:
-            dirlist = os.listdir(repository)
+            dirlist = self.listVersions(repository, app)
             dirlist.sort()
             appVersions = set(app.versions)
             for dir in dirlist:
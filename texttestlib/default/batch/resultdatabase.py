@@ -0,0 +1,184 @@
+""" Historical batch results stored in a single SQLite file at the top of the batch result repository,
+as an alternative to the directory structure of teststate and succeeded_runs files """
+
+import os
+import sqlite3
+import logging
+from threading import Lock, RLock
+from texttestlib import plugins
+
+
+class ResultDatabase:
+    fileName = "batch_results.db"
+    instances = {}
+    instanceLock = Lock()
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            app TEXT NOT NULL,
+            version TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            UNIQUE (app, version, tag));
+        CREATE TABLE IF NOT EXISTS tests (
+            id INTEGER PRIMARY KEY,
+            app TEXT NOT NULL,
+            version TEXT NOT NULL,
+            path TEXT NOT NULL,
+            UNIQUE (app, version, path));
+        CREATE TABLE IF NOT EXISTS results (
+            run INTEGER NOT NULL REFERENCES runs(id),
+            test INTEGER NOT NULL REFERENCES tests(id),
+            category TEXT NOT NULL,
+            brief_text TEXT NOT NULL,
+            hosts TEXT NOT NULL,
+            state BLOB,
+            PRIMARY KEY (run, test));
+        CREATE TABLE IF NOT EXISTS comparisons (
+            run INTEGER NOT NULL REFERENCES runs(id),
+            test INTEGER NOT NULL REFERENCES tests(id),
+            stem TEXT NOT NULL,
+            type TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            severity INTEGER,
+            PRIMARY KEY (run, test, stem));
+    """
+
+    @classmethod
+    def getInstance(cls, repository):
+        path = os.path.join(os.path.abspath(repository), cls.fileName)
+        with cls.instanceLock:
+            if path not in cls.instances:
+                cls.instances[path] = cls(path)
+            return cls.instances[path]
+
+    @classmethod
+    def exists(cls, repository):
+        return os.path.isfile(os.path.join(repository, cls.fileName))
+
+    @classmethod
+    def getForVersionDirectory(cls, versionDir):
+        # The layout is <repository>/<application>/<version>, as for the files
+        appDir, version = os.path.split(versionDir)
+        repository, appName = os.path.split(appDir)
+        return cls.getInstance(repository), appName, version
+
+    def __init__(self, path):
+        self.path = path
+        self.diag = logging.getLogger("Result Database")
+        plugins.ensureDirExistsForFile(path)
+        # Several batch runs may save into the same repository at the same time.
+        # Within this process, results are saved from the threads that receive them from slaves:
+        # they share the connection, one statement and commit at a time
+        self.lock = RLock()
+        self.connection = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.connection.executescript(self.schema)
+        self.runIds = {}
+        self.testIds = {}
+
+    def getRunId(self, appName, version, tag):
+        key = appName, version, tag
+        with self.lock:
+            if key not in self.runIds:
+                self.runIds[key] = self.getOrInsert("runs", "tag", key)
+            return self.runIds[key]
+
+    def getTestId(self, appName, version, testPath):
+        key = appName, version, testPath
+        with self.lock:
+            if key not in self.testIds:
+                self.testIds[key] = self.getOrInsert("tests", "path", key)
+            return self.testIds[key]
+
+    def getOrInsert(self, table, column, key):
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO " + table + " (app, version, " + column + ") VALUES (?, ?, ?)", key)
+            query = "SELECT id FROM " + table + " WHERE app = ? AND version = ? AND " + column + " = ?"
+            return self.connection.execute(query, key).fetchone()[0]
+
+    def addResult(self, appName, version, tag, testPath, state, stateData=None, commit=True):
+        """ Returns False if there is already a result for this test in this run """
+        with self.lock:
+            runId = self.getRunId(appName, version, tag)
+            testId = self.getTestId(appName, version, testPath.replace(os.sep, "/"))
+            cursor = self.connection.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                             (runId, testId, state.category, state.briefText,
+                                              ", ".join(state.executionHosts), stateData))
+            added = cursor.rowcount > 0
+            if added and stateData is not None and hasattr(state, "getComparisons"):
+                rows = [(runId, testId, comp.stem, comp.getType(), comp.getSummary(), comp.severity)
+                        for comp in state.getComparisons()]
+                self.connection.executemany("INSERT OR IGNORE INTO comparisons VALUES (?, ?, ?, ?, ?, ?)", rows)
+            if commit:
+                self.connection.commit()
+            return added
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def getVersions(self, appName):
+        with self.lock:
+            cursor = self.connection.execute("SELECT DISTINCT version FROM runs WHERE app = ?", (appName,))
+            return [version for version, in cursor]
+
+    def getTags(self, appName, version):
+        return list(self.findRunIds(appName, version).keys())
+
+    def findRunIds(self, appName, version):
+        with self.lock:
+            cursor = self.connection.execute("SELECT tag, id FROM runs WHERE app = ? AND version = ?", (appName, version))
+            return dict(cursor.fetchall())
+
+    def getFingerprints(self, appName, version):
+        """ Something per run that changes whenever results are added to it or removed from it """
+        query = "SELECT runs.tag, runs.id, COUNT(results.run), TOTAL(results.rowid), TOTAL(LENGTH(results.state)) " + \
+                "FROM runs LEFT JOIN results ON results.run = runs.id " + \
+                "WHERE runs.app = ? AND runs.version = ? GROUP BY runs.id"
+        with self.lock:
+            rows = self.connection.execute(query, (appName, version)).fetchall()
+            self.connection.commit()
+        return dict((row[0], "%d:%d:%d:%d" % row[1:]) for row in rows)
+
+    def readResults(self, appName, version, tags, withState):
+        """ Results for the given tags, ordered by test. Results with stored states, or without, as requested """
+        stateCondition = "results.state IS NOT NULL" if withState else "results.state IS NULL"
+        query = "SELECT tests.path, runs.tag, results.category, results.brief_text, results.hosts, results.state " + \
+                "FROM results JOIN selected_runs ON results.run = selected_runs.id " + \
+                "JOIN runs ON results.run = runs.id JOIN tests ON results.test = tests.id " + \
+                "WHERE " + stateCondition + " ORDER BY tests.path"
+        self.diag.info("Reading results for " + appName + " version " + version + " from " + str(len(tags)) + " runs")
+        with self.lock:
+            runIds = self.findRunIds(appName, version)
+            self.connection.execute("CREATE TEMPORARY TABLE IF NOT EXISTS selected_runs (id INTEGER PRIMARY KEY)")
+            self.connection.execute("DELETE FROM selected_runs")
+            self.connection.executemany("INSERT INTO selected_runs VALUES (?)",
+                                        [(runIds[tag],) for tag in set(tags) if tag in runIds])
+            rows = self.connection.execute(query).fetchall()
+            # Don't keep the database locked, batch runs may be saving to it
+            self.connection.commit()
+        return rows
+
+    @classmethod
+    def readLatestState(cls, repository, appName, version, testPath):
+        """ The most recently stored state for the test. Uses a connection of its own, as it is
+        called while running tests rather than when saving or reporting results """
+        query = "SELECT results.state FROM results JOIN tests ON results.test = tests.id " + \
+                "WHERE tests.app = ? AND tests.version = ? AND tests.path = ? AND results.state IS NOT NULL " + \
+                "ORDER BY results.rowid DESC LIMIT 1"
+        connection = sqlite3.connect(os.path.join(repository, cls.fileName), timeout=300)
+        try:
+            row = connection.execute(query, (appName, version, testPath.replace(os.sep, "/"))).fetchone()
+            return row[0] if row else None
+        finally:
+            connection.close()
+
+    def removeRuns(self, appName, version, tags):
+        with self.lock:
+            runIds = self.findRunIds(appName, version)
+            toRemove = [(runIds[tag],) for tag in tags if tag in runIds]
+            for table in ["comparisons", "results", "runs"]:
+                column = "id" if table == "runs" else "run"
+                self.connection.executemany("DELETE FROM " + table + " WHERE " + column + " = ?", toRemove)
+            self.connection.commit()
+            for tag in tags:
+                self.runIds.pop((appName, version, tag), None)
@@ -4,16 +4,20 @@
 import os
 import time
 import html
+import json
+import hashlib
 import sys
 import logging
 import locale
 from texttestlib.default.batch import HTMLgen, HTMLcolors
 from texttestlib.default.batch.ci import CIPlatform
-from texttestlib import plugins
+from texttestlib import plugins, texttest_version
 from collections import OrderedDict
 from glob import glob
 from datetime import datetime, timedelta
+from io import BytesIO
 from .batchutils import convertToUrl, getEnvironmentFromRunFiles
+from .resultdatabase import ResultDatabase
 HTMLgen.PRINTECHO = 0
 
 
@@ -38,10 +42,14 @@ def getWeekDay(tag):
 class ColourFinder:
     def __init__(self, getConfigValue):
         self.getConfigValue = getConfigValue
+        self.colours = {}
 
     def find(self, title):
-        colourName = self.getConfigValue("historical_report_colours", title)
-        return self.htmlColour(colourName)
+        # Looked up for every cell in the table, so don't go back to the config each time
+        if title not in self.colours:
+            colourName = self.getConfigValue("historical_report_colours", title)
+            self.colours[title] = self.htmlColour(colourName)
+        return self.colours[title]
 
     def htmlColour(self, colourName):
         if colourName and not colourName.startswith("#"):
@@ -88,6 +96,7 @@ class GenerateWebPages(object):
         self.resourceNames = resourceNames
         self.descriptionInfo = descriptionInfo
         self.diag = logging.getLogger("GenerateWebPages")
+        self.manifest = None
 
     def makeSelectors(self, subPageNames, tags=[]):
         allSelectors = []
@@ -120,16 +129,21 @@ class GenerateWebPages(object):
                 for line in linesToKeep:
                     writeFile.write(line)
 
+    def findResults(self, repositoryDirInfo):
+        if self.getConfigValue("batch_result_database") == "true":
+            return DatabaseResults(self, repositoryDirInfo)
+        else:
+            return RepositoryFileResults(self, repositoryDirInfo)
+
     def generate(self, repositoryDirs, subPageNames, archiveUnused):
-        minorVersionHeader = HTMLgen.Container()
         allMonthSelectors = set()
         latestMonth = None
-        pageToGraphs = {}
+        versionResults = []
         for version, repositoryDirInfo in list(repositoryDirs.items()):
             self.diag.info("Generating " + version)
-            tagData, stateFiles, successFiles = self.findTestStateFilesAndTags(repositoryDirInfo)
-            if len(stateFiles) > 0 or len(successFiles) > 0:
-                tags = list(tagData.keys())
+            results = self.findResults(repositoryDirInfo)
+            tags = results.getTags()
+            if len(tags) > 0:
                 tags.sort(key=self.tagSortKey)
                 selectors = self.makeSelectors(subPageNames, tags)
                 monthSelectors = SelectorByMonth.makeInstances(tags)
@@ -158,78 +172,8 @@ class GenerateWebPages(object):
                             plugins.log.info("- " + tag)
                         plugins.log.info(
                             "(To disable automatic repository cleaning in future, please run with the --manualarchive flag when collating the HTML report.)")
-                        self.removeUnused(unusedTags, tagData)
-
-                loggedTests = OrderedDict()
-                categoryHandlers = {}
-                self.diag.info("Processing " + str(len(stateFiles)) + " teststate files")
-                relevantFiles = 0
-                for stateFile, repository in stateFiles:
-                    tag = self.getTagFromFile(stateFile)
-                    if len(tags) == 0 or tag in tags:
-                        relevantFiles += 1
-                        testId, state, extraVersion = self.processTestStateFile(stateFile, repository)
-                        loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                            testId, OrderedDict())[tag] = state
-                        categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                            testId, state.category, extraVersion, state)
-                        if relevantFiles % 100 == 0:
-                            self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
-                self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
-                self.diag.info("Processing " + str(len(successFiles)) + " success files")
-                for successFile, repository in successFiles:
-                    testId = self.getTestIdentifier(successFile, repository)
-                    extraVersion = self.findExtraVersion(repository)
-                    with open(successFile) as f:
-                        fileTags = set()
-                        for line in f:
-                            parts = line.strip().split(" ", 1)
-                            if len(parts) != 2:
-                                continue
-                            tag, text = parts
-                            if tag in fileTags:
-                                sys.stderr.write("WARNING: more than one result present for tag '" +
-                                                 tag + "' in file " + successFile + "!\n")
-                                sys.stderr.write("Ignoring later ones\n")
-                                continue
-
-                            fileTags.add(tag)
-                            if len(tags) == 0 or tag in tags:
-                                loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                                    testId, OrderedDict())[tag] = text
-                                categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                                    testId, "success", extraVersion, text)
-                self.diag.info("Processed " + str(len(successFiles)) + " success files")
-                versionToShow = self.removePageVersion(version)
-                hasData = False
-                for sel in selectors:
-                    filePath = self.getPageFilePath(sel)
-                    if filePath in self.pagesOverview:
-                        page, pageColours = self.pagesOverview[filePath]
-                    else:
-                        page = self.createPage()
-                        pageColours = {"last_column": set(), "all_columns": set()}
-                        self.pagesOverview[filePath] = page, pageColours
-
-                    tableHeader = self.getTableHeader(version, repositoryDirs)
-                    heading = self.getHeading(versionToShow)
-                    hasNewData, graphLink, tableColours = self.addTable(page, self.resourceNames, categoryHandlers, version,
-                                                                        loggedTests, sel, tableHeader, filePath, heading, repositoryDirInfo)
-                    hasData |= hasNewData
-                    for colourGroupKey in tableColours:
-                        pageColours[colourGroupKey].update(tableColours[colourGroupKey])
-                    if graphLink:
-                        pageToGraphs.setdefault(page, []).append(graphLink)
-
-                if hasData and versionToShow:
-                    link = HTMLgen.Href("#" + version, versionToShow)
-                    minorVersionHeader.append(link)
-
-                # put them in reverse order, most relevant first
-                linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
-                for tag in tags:
-                    details = self.pagesDetails.setdefault(tag, TestDetails(tag, self.pageTitle, self.pageSubTitles))
-                    details.addVersionSection(version, categoryHandlers[tag], linkFromDetailsToOverview)
+                        results.removeUnused(unusedTags)
+                versionResults.append((version, repositoryDirInfo, results, tags, selectors, allSelectors))
 
         selContainer = HTMLgen.Container()
         selectors = self.makeSelectors(subPageNames)
@@ -247,6 +191,31 @@ class GenerateWebPages(object):
             target, linkName = sel.getLinkInfo(self.pageVersion)
             monthContainer.append(HTMLgen.Href(target, linkName))
 
+        self.manifest = BuildManifest(self.pageDir, self.pageVersion, self.getManifestSettings(subPageNames, monthContainer))
+        pageInputs, detailInputs = self.findPageInputs(versionResults, repositoryDirs)
+        stalePages = [page for page, inputs in pageInputs.items() if not self.manifest.isUpToDate(page, inputs)]
+        staleTags = [tag for tag, inputs in detailInputs.items()
+                     if not self.manifest.isUpToDate(os.path.join(self.pageDir, getDetailPageName(self.pageVersion, tag)), inputs)]
+        self.diag.info("Pages needing regeneration " + repr(stalePages) + ", detail pages " + repr(staleTags))
+        pageToGraphs, versionsWithData = self.generateTables(versionResults, repositoryDirs, stalePages, staleTags)
+        for filePath in pageInputs:
+            if filePath not in stalePages:
+                versionsWithData[filePath] = self.manifest.getInfo(filePath)
+        versionsInHeader = self.getVersionsInHeader(repositoryDirs, versionsWithData)
+        if versionsInHeader != self.manifest.versionsInHeader and len(stalePages) < len(pageInputs):
+            # The version links are on every overview page, so the unchanged ones are out of date too
+            remainingPages = [filePath for filePath in pageInputs if filePath not in stalePages]
+            self.diag.info("Version header has changed, regenerating " + repr(remainingPages))
+            moreGraphs, moreVersions = self.generateTables(versionResults, repositoryDirs, remainingPages, [])
+            pageToGraphs.update(moreGraphs)
+            for filePath in remainingPages:
+                versionsWithData[filePath] = moreVersions.get(filePath, [])
+            versionsInHeader = self.getVersionsInHeader(repositoryDirs, versionsWithData)
+
+        minorVersionHeader = HTMLgen.Container()
+        for version in versionsInHeader:
+            minorVersionHeader.append(HTMLgen.Href("#" + version, self.removePageVersion(version)))
+
         for page, pageColours in list(self.pagesOverview.values()):
             if len(monthContainer.contents) > 0:
                 page.prepend(HTMLgen.Heading(2, monthContainer, align='center'))
@@ -265,6 +234,90 @@ class GenerateWebPages(object):
                 page.script = self.getFilterScripts(pageColours)
 
         self.writePages()
+        for filePath in self.pagesOverview:
+            self.manifest.record(filePath, pageInputs[filePath], versionsWithData.get(filePath, []))
+        for tag in self.pagesDetails:
+            self.manifest.record(os.path.join(self.pageDir, getDetailPageName(self.pageVersion, tag)), detailInputs[tag])
+        self.manifest.versionsInHeader = versionsInHeader
+        self.manifest.write()
+
+    def generateTables(self, versionResults, repositoryDirs, stalePages, staleTags):
+        pageToGraphs, versionsWithData = {}, {}
+        for version, repositoryDirInfo, results, tags, selectors, allSelectors in versionResults:
+            pageSelectors = [sel for sel in selectors if self.getPageFilePath(sel) in stalePages]
+            detailTags = [tag for tag in tags if tag in staleTags]
+            if len(pageSelectors) == 0 and len(detailTags) == 0:
+                self.diag.info("No pages to regenerate for " + version)
+                continue
+
+            loggedTests = OrderedDict()
+            categoryHandlers = {}
+            # The detail pages only need their own run, the overview pages need all of them
+            tagsToRead = tags if pageSelectors else detailTags
+            for testId, tag, extraVersion, state, category in results.readResults(tagsToRead):
+                loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
+                    testId, OrderedDict())[tag] = state
+                categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
+                    testId, category, extraVersion, state)
+            versionToShow = self.removePageVersion(version)
+            for sel in pageSelectors:
+                filePath = self.getPageFilePath(sel)
+                if filePath in self.pagesOverview:
+                    page, pageColours = self.pagesOverview[filePath]
+                else:
+                    page = self.createPage()
+                    pageColours = {"last_column": set(), "all_columns": set()}
+                    self.pagesOverview[filePath] = page, pageColours
+
+                tableHeader = self.getTableHeader(version, repositoryDirs)
+                heading = self.getHeading(versionToShow)
+                hasNewData, graphLink, tableColours = self.addTable(page, self.resourceNames, categoryHandlers, version,
+                                                                    loggedTests, sel, tableHeader, filePath, heading, repositoryDirInfo)
+                if hasNewData:
+                    versionsWithData.setdefault(filePath, []).append(version)
+                for colourGroupKey in tableColours:
+                    pageColours[colourGroupKey].update(tableColours[colourGroupKey])
+                if graphLink:
+                    pageToGraphs.setdefault(page, []).append(graphLink)
+
+            # put them in reverse order, most relevant first
+            linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
+            for tag in detailTags:
+                details = self.pagesDetails.setdefault(tag, TestDetails(tag, self.pageTitle, self.pageSubTitles))
+                details.addVersionSection(version, categoryHandlers[tag], linkFromDetailsToOverview)
+        return pageToGraphs, versionsWithData
+
+    def getVersionsInHeader(self, repositoryDirs, versionsWithData):
+        versions = set()
+        for pageVersions in versionsWithData.values():
+            versions.update(pageVersions)
+        return [version for version in repositoryDirs if version in versions and self.removePageVersion(version)]
+
+    def getManifestSettings(self, subPageNames, monthContainer):
+        # The reconnect command line refers to the latest run, so would make every page out of date every time.
+        # Pages that are regenerated anyway pick up the new one.
+        subTitles = [(title, command) for title, command in self.pageSubTitles if "-reconnect" not in command.split()]
+        # Everything read while rendering, including what the CI changes in the detail pages use to link to bugs
+        configKeys = ["historical_report_colours", "historical_report_subpages", "historical_report_subpage_cutoff",
+                      "historical_report_subpage_weekdays", "performance_variation_serious_%", "batch_include_comment_plugin",
+                      "file_to_url", "bug_system_location", "batch_jenkins_marked_artefacts", "batch_jenkins_archive_file_pattern"]
+        configValues = [repr(self.getConfigValue(key, allSubKeys=True)) for key in configKeys]
+        return [self.pageTitle, subTitles, self.resourceNames, sorted(self.descriptionInfo.items()), configValues,
+                list(subPageNames), str(monthContainer), locale.getpreferredencoding()]
+
+    def findPageInputs(self, versionResults, repositoryDirs):
+        pageInputs, detailInputs = OrderedDict(), OrderedDict()
+        for version, repositoryDirInfo, results, tags, selectors, allSelectors in versionResults:
+            fingerprints = results.getFingerprints(tags)
+            dirs = [dir for _, dir in repositoryDirInfo]
+            for sel in selectors:
+                selectorInputs = [version, self.getTableHeader(version, repositoryDirs), dirs, sel.selectedTags,
+                                  [fingerprints.get(tag) for tag in sel.selectedTags]]
+                pageInputs.setdefault(self.getPageFilePath(sel), []).append(selectorInputs)
+            linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
+            for tag in tags:
+                detailInputs.setdefault(tag, []).append([version, dirs, fingerprints.get(tag), linkFromDetailsToOverview])
+        return pageInputs, detailInputs
 
     def getFilterScripts(self, pageColours):
         finder = ColourFinder(self.getConfigValue)
@@ -306,7 +359,7 @@ class GenerateWebPages(object):
     def getTagFromFile(self, fileName):
         return os.path.basename(fileName).replace("teststate_", "")
 
-    def findTestStateFilesAndTags(self, repositoryDirs):
+    def findTestStateFilesAndTags(self, repositoryDirs, successLines=None):
         tagData, stateFiles, successFiles = {}, [], []
         for _, dir in repositoryDirs:
             self.diag.info("Looking for teststate files in " + dir)
@@ -325,6 +378,8 @@ class GenerateWebPages(object):
                                 if parts:
                                     tag = parts[0]
                                     tagData.setdefault(tag, []).append(path)
+                                    if successLines is not None:
+                                        successLines.setdefault(tag, []).append((path, line))
 
             self.diag.info("Found " + str(len(stateFiles)) + " teststate files and " +
                            str(len(successFiles)) + " success files in " + dir)
@@ -346,15 +401,19 @@ class GenerateWebPages(object):
 
     @classmethod
     def readState(cls, stateFile):
-        file = open(stateFile, "rb")
+        with open(stateFile, "rb") as file:
+            return cls.readStateData(file.read())
+
+    @classmethod
+    def readStateData(cls, data):
         try:
-            state = plugins.getNewTestStateFromFile(file)
+            state = plugins.getNewTestStateFromFile(BytesIO(data))
             if isinstance(state, plugins.TestState):
                 return state
             else:
                 return cls.readErrorState("Incorrect type for state object.")
         except Exception as e:
-            if os.path.getsize(stateFile) > 0:
+            if len(data) > 0:
                 return cls.readErrorState("Stack info follows:\n" + str(e))
             else:
                 return plugins.Unrunnable("Results file was empty, probably the disk it resides on is full.", "Disk full?")
@@ -407,7 +466,7 @@ class GenerateWebPages(object):
 
             graphLink = None
             fullPath = os.path.abspath(os.path.join(graphDirname, graphFileRef))
-            if testTable.generateGraph(fullPath, graphHeading):
+            if testTable.generateGraph(fullPath, graphHeading, self.manifest):
                 graphLink = self.makeImageLink(graphFileRef.replace("\\", "/"))
                 cells.append(HTMLgen.TD(graphLink))
 
@@ -467,6 +526,166 @@ class GenerateWebPages(object):
         return time.mktime(time.strptime(timePart, "%d%b%Y"))
 
 
+class RepositoryFileResults:
+    """ Results stored as teststate and succeeded_runs files in a directory per test """
+    def __init__(self, generator, repositoryDirs):
+        self.generator = generator
+        self.diag = generator.diag
+        self.successLines = {}
+        self.tagData, self.stateFiles, self.successFiles = generator.findTestStateFilesAndTags(repositoryDirs, self.successLines)
+
+    def getTags(self):
+        return list(self.tagData.keys())
+
+    def getFingerprints(self, tags):
+        # The success files are appended to by every run, so use the lines rather than the files
+        fingerprints = {}
+        for tag in tags:
+            digest = hashlib.sha1()
+            for path in self.tagData.get(tag, []):
+                if os.path.basename(path).startswith("teststate_"):
+                    statInfo = os.stat(path)
+                    digest.update((path + " " + str(statInfo.st_size) + " " + str(statInfo.st_mtime_ns) + "\n").encode())
+            for path, line in self.successLines.get(tag, []):
+                digest.update((path + " " + line).encode())
+            fingerprints[tag] = digest.hexdigest()
+        return fingerprints
+
+    def removeUnused(self, tags):
+        self.generator.removeUnused(tags, self.tagData)
+
+    def readResults(self, tags):
+        self.diag.info("Processing " + str(len(self.stateFiles)) + " teststate files")
+        relevantFiles = 0
+        for stateFile, repository in self.stateFiles:
+            tag = self.generator.getTagFromFile(stateFile)
+            if len(tags) == 0 or tag in tags:
+                relevantFiles += 1
+                testId, state, extraVersion = self.generator.processTestStateFile(stateFile, repository)
+                yield testId, tag, extraVersion, state, state.category
+                if relevantFiles % 100 == 0:
+                    self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
+        self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
+        self.diag.info("Processing " + str(len(self.successFiles)) + " success files")
+        for successFile, repository in self.successFiles:
+            testId = self.generator.getTestIdentifier(successFile, repository)
+            extraVersion = self.generator.findExtraVersion(repository)
+            with open(successFile) as f:
+                fileTags = set()
+                for line in f:
+                    parts = line.strip().split(" ", 1)
+                    if len(parts) != 2:
+                        continue
+                    tag, text = parts
+                    if tag in fileTags:
+                        sys.stderr.write("WARNING: more than one result present for tag '" +
+                                         tag + "' in file " + successFile + "!\n")
+                        sys.stderr.write("Ignoring later ones\n")
+                        continue
+
+                    fileTags.add(tag)
+                    if len(tags) == 0 or tag in tags:
+                        yield testId, tag, extraVersion, text, "success"
+        self.diag.info("Processed " + str(len(self.successFiles)) + " success files")
+
+
+class DatabaseResults:
+    """ Results stored in the batch result database, see resultdatabase.py. Only the runs shown are read. """
+    def __init__(self, generator, repositoryDirs):
+        self.generator = generator
+        self.sources = []
+        for _, dir in repositoryDirs:
+            database, appName, version = ResultDatabase.getForVersionDirectory(dir)
+            self.sources.append((database, appName, version, generator.findExtraVersion(dir)))
+
+    def getTags(self):
+        tags = OrderedDict()
+        for database, appName, version, _ in self.sources:
+            for tag in database.getTags(appName, version):
+                tags[tag] = True
+        return list(tags.keys())
+
+    def removeUnused(self, tags):
+        for database, appName, version, _ in self.sources:
+            database.removeRuns(appName, version, tags)
+
+    def getFingerprints(self, tags):
+        fingerprints = {}
+        for database, appName, version, _ in self.sources:
+            for tag, fingerprint in database.getFingerprints(appName, version).items():
+                fingerprints[tag] = fingerprints.get(tag, "") + fingerprint + ";"
+        return fingerprints
+
+    def readResults(self, tags):
+        tagsToRead = tags or self.getTags()
+        # Stored states first, as when reading files
+        for withState in [True, False]:
+            for database, appName, version, extraVersion in self.sources:
+                for path, tag, category, briefText, hosts, stateData in \
+                        database.readResults(appName, version, tagsToRead, withState):
+                    testId = path.replace("/", " ")
+                    if stateData is None:
+                        # As in the succeeded_runs files
+                        text = briefText + " " + hosts if briefText else hosts
+                        yield testId, tag, extraVersion, text, category
+                    else:
+                        state = self.generator.readStateData(stateData)
+                        yield testId, tag, extraVersion, state, state.category
+
+
+class BuildManifest:
+    """ Records what each page and graph was last generated from, so that collating again
+    only regenerates the ones whose results or settings have changed """
+    formatVersion = 1
+
+    def __init__(self, pageDir, pageVersion, settings):
+        self.pageDir = pageDir
+        self.fileName = os.path.join(pageDir, "build_manifest_" + pageVersion + ".json")
+        self.diag = logging.getLogger("GenerateWebPages")
+        self.settingsKey = self.makeKey([texttest_version.version, settings])
+        self.entries, self.versionsInHeader = self.read()
+
+    def read(self):
+        try:
+            with open(self.fileName) as f:
+                data = json.load(f)
+            if data.get("format") == self.formatVersion and data.get("settings") == self.settingsKey:
+                return data["entries"], data["versions_in_header"]
+            else:
+                self.diag.info("Report settings have changed, ignoring " + self.fileName)
+        except (EnvironmentError, ValueError, KeyError):
+            pass
+        return {}, None
+
+    def write(self):
+        data = {"format": self.formatVersion, "settings": self.settingsKey,
+                "versions_in_header": self.versionsInHeader, "entries": self.entries}
+        tmpFileName = self.fileName + ".tmp"
+        try:
+            with open(tmpFileName, "w") as f:
+                json.dump(data, f, indent=0, sort_keys=True)
+            os.replace(tmpFileName, self.fileName)
+        except EnvironmentError as e:
+            plugins.printWarning("Could not write build manifest at " + self.fileName + ", all pages will be regenerated next time:\n" + str(e))
+
+    @staticmethod
+    def makeKey(inputs):
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def getName(self, path):
+        return plugins.relpath(os.path.abspath(path), os.path.abspath(self.pageDir)) or path
+
+    def isUpToDate(self, path, inputs):
+        entry = self.entries.get(self.getName(path))
+        return entry is not None and entry["inputs"] == self.makeKey(inputs) and os.path.isfile(path)
+
+    def getInfo(self, path):
+        return self.entries.get(self.getName(path), {}).get("info", [])
+
+    def record(self, path, inputs, info=None):
+        self.entries[self.getName(path)] = {"inputs": self.makeKey(inputs), "info": info or []}
+
+
 class TestTable:
     def __init__(self, getConfigValue, resourceNames, descriptionInfo, tags, categoryHandlers, pageVersion, version, graphFilePath):
         self.getConfigValue = getConfigValue
@@ -480,7 +699,7 @@ class TestTable:
         self.graphFilePath = graphFilePath  # For convenience in performance analyzer.
         self.usedColours = {"last_column": set(), "all_columns": set()}
 
-    def generateGraph(self, fileName, heading):
+    def generateGraph(self, fileName, heading, manifest=None):
         if len(self.tags) > 1:  # Don't bother with graphs when tests have only run once
             try:
                 from .resultgraphs import GraphGenerator
@@ -489,8 +708,12 @@ class TestTable:
                 return False  # if matplotlib isn't installed or is too old
 
             data = self.getColourKeySummaryData()
+            if manifest and manifest.isUpToDate(fileName, [heading, data]):
+                return True
             generator = GraphGenerator()
             generator.generateGraph(fileName, heading, data, self.colourFinder)
+            if manifest:
+                manifest.record(fileName, [heading, data])
             return True
         else:
             return False
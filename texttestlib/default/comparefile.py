@@ -1,16 +1,168 @@
 
 import os
-import filecmp
 import time
+import hashlib
 import subprocess
 import logging
 import re
 from texttestlib import plugins
 from shutil import copyfile
+from difflib import SequenceMatcher
+from threading import Lock
 
 from fnmatch import fnmatch
 
 
+def getUnifiedDiffLines(fromFileName, toFileName, windowLines=1000, windowBytes=1024 * 1024):
+    """ Unified diff without context, generated lazily in bounded memory.
+    Identical lines are dropped as they are read, and the rest is compared a window at a time, so a change
+    bigger than the window may not be lined up as a diff of the whole files would, but nothing reads the whole file """
+    with open(fromFileName, errors="ignore") as fromFile, open(toFileName, errors="ignore") as toFile:
+        fromWindow, toWindow = DiffWindow(fromFile), DiffWindow(toFile)
+        while True:
+            fromWindow.fill(windowLines, windowBytes)
+            toWindow.fill(windowLines, windowBytes)
+            if not fromWindow.lines and not toWindow.lines:
+                return
+
+            commonLines = 0
+            for fromLine, toLine in zip(fromWindow.lines, toWindow.lines):
+                if fromLine != toLine:
+                    break
+                commonLines += 1
+            if commonLines:
+                fromWindow.consume(commonLines)
+                toWindow.consume(commonLines)
+                continue
+
+            # The windows start with a difference: only that one is reported before reading on
+            _, _, fromEnd, _, toEnd = SequenceMatcher(None, fromWindow.lines, toWindow.lines).get_opcodes()[0]
+            yield "@@ -" + formatUnifiedRange(fromWindow.start, fromWindow.start + fromEnd) + \
+                  " +" + formatUnifiedRange(toWindow.start, toWindow.start + toEnd) + " @@\n"
+            for line in fromWindow.consume(fromEnd):
+                yield "-" + ensureNewline(line)
+            for line in toWindow.consume(toEnd):
+                yield "+" + ensureNewline(line)
+
+
+class DiffWindow:
+    """ The lines of a file currently being compared, and the line number of the first of them """
+    def __init__(self, file):
+        self.file = file
+        self.lines = []
+        self.start = 0
+        self.size = 0
+        self.finished = False
+
+    def fill(self, maxLines, maxBytes):
+        while not self.finished and len(self.lines) < maxLines and (not self.lines or self.size < maxBytes):
+            line = self.file.readline()
+            if line:
+                self.lines.append(line)
+                self.size += len(line)
+            else:
+                self.finished = True
+
+    def consume(self, count):
+        consumed = self.lines[:count]
+        del self.lines[:count]
+        self.start += count
+        self.size -= sum(map(len, consumed))
+        return consumed
+
+
+def formatUnifiedRange(start, stop):
+    # As in GNU diff: a single line is just its number, an empty range refers to the line before it
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    elif length == 0:
+        return str(start) + ",0"
+    else:
+        return str(start + 1) + "," + str(length)
+
+
+def ensureNewline(line):
+    return line if line.endswith("\n") else line + "\n"
+
+
+def filterDiff(diff, diffFilters):
+    filteredLines = [line + "\n" for line in diff.splitlines() if diffFilters.stringContainsText(line)]
+    # If we filter it all away, should assume it was a new file and return it unchanged
+    return "".join(filteredLines) or diff
+
+
+def extractRepeats(filteredDiff):
+    size = len(filteredDiff)
+    smallPrimes = [2, 3, 5, 7, 11, 13, 17, 19]  # Surely we won't repeat stuff more than 20 times :)
+    for prime in smallPrimes:
+        if size > prime and size % prime == 0:
+            chunkSize = size // prime
+            firstPart = filteredDiff[:chunkSize]
+            if filteredDiff == firstPart * prime:
+                return firstPart, prime
+    return None, None
+
+
+def makeDiffSignature(diff, diffFilters, maxLength):
+    """ A digest of the filtered difference and how many times it repeats a shorter one,
+    then the same for that one, and so on. Empty if the difference is too long to bother with """
+    if diff.count("\n") >= maxLength:
+        return ()
+    signature = []
+    filteredDiff = filterDiff(diff, diffFilters)
+    while filteredDiff is not None:
+        singleVersion, timesRepeated = extractRepeats(filteredDiff)
+        digest = hashlib.blake2b(filteredDiff.encode(errors="surrogatepass"), digest_size=16).hexdigest()
+        signature.append((digest, timesRepeated))
+        filteredDiff = singleVersion
+    return tuple(signature)
+
+
+class FileDigests:
+    """ Content digests of files, shared by all comparisons so each file is read at most once while unchanged """
+    lock = Lock()
+    digests = {}
+    blockSize = 1024 * 1024
+    # Don't trust modification times this recent: the file could change again within the timestamp resolution
+    racyInterval = 2 * 10 ** 9
+
+    @classmethod
+    def getStamp(cls, fileName):
+        """ Size and modification time. The time is None if it's too recent to tell us the contents haven't changed """
+        checkTime = time.time_ns()
+        statInfo = os.stat(fileName)
+        if checkTime - statInfo.st_mtime_ns > cls.racyInterval:
+            return statInfo.st_size, statInfo.st_mtime_ns
+        else:
+            return statInfo.st_size, None
+
+    @classmethod
+    def isTrustworthy(cls, stamp):
+        return stamp[1] is not None
+
+    @classmethod
+    def getDigest(cls, fileName, stamp):
+        if not cls.isTrustworthy(stamp):
+            return cls.computeDigest(fileName)
+        with cls.lock:
+            cached = cls.digests.get(fileName)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        digest = cls.computeDigest(fileName)
+        with cls.lock:
+            cls.digests[fileName] = stamp, digest
+        return digest
+
+    @classmethod
+    def computeDigest(cls, fileName):
+        sha = hashlib.sha256()
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(cls.blockSize), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+
 class FileComparison:
     SAME = 0
     DIFFERENT = 1
@@ -24,6 +176,9 @@ class FileComparison:
         self.stem = stem
         self.differenceCache = self.SAME
         self.recalculationTime = None
+        # (size, modification time) and digest of the filtered files, pickled with the rest
+        self.stdCmpDigest = None
+        self.tmpCmpDigest = None
         self.diag = logging.getLogger("FileComparison")
         stemForConfig = self.stemForConfig()
         self.severity = test.getCompositeConfigValue("failure_severity", stemForConfig)
@@ -38,6 +193,7 @@ class FileComparison:
         self.textDiffTool = test.getConfigValue("text_diff_program")
         self.textDiffToolMaxSize = plugins.parseBytes(test.getCompositeConfigValue("max_file_size", self.textDiffTool))
         self.freeTextBody = None
+        self.diffSignature = None
         # subclasses may override if they don't want to store in this way
         self.cacheDifferences(test, testInProgress)
         self.diag.info("Created file comparison std: " + repr(self.stdFile) + " tmp: " +
@@ -53,6 +209,7 @@ class FileComparison:
 
     def recompute(self, test):
         self.freeTextBody = None
+        self.diffSignature = None
         if self.needsRecalculation():
             self.recalculationTime = time.time()
         if self.tmpFile:
@@ -139,6 +296,7 @@ class FileComparison:
 
     def __setstate__(self, state):
         self.__dict__ = state
+        self.__dict__.setdefault("diffSignature", None)  # not stored by older versions
         self.diag = logging.getLogger("TestComparison")
         self.recalculationTime = None
 
@@ -245,7 +403,7 @@ class FileComparison:
 
     def updateDifferenceCache(self, valueForEqual):
         if self.stdCmpFile and self.tmpCmpFile:
-            if filecmp.cmp(self.stdCmpFile, self.tmpCmpFile, 0):
+            if self.cmpFilesEqual():
                 if self.differenceCache != self.APPROVED:
                     self.differenceCache = valueForEqual
             else:
@@ -253,6 +411,21 @@ class FileComparison:
             self.diag.info("Caching differences " + repr(self.stdCmpFile) + " " +
                            repr(self.tmpCmpFile) + " = " + repr(self.differenceCache))
 
+    def cmpFilesEqual(self):
+        stdStamp = FileDigests.getStamp(self.stdCmpFile)
+        tmpStamp = FileDigests.getStamp(self.tmpCmpFile)
+        if stdStamp[0] != tmpStamp[0]:
+            return False
+        self.stdCmpDigest = self.getDigest(self.stdCmpFile, stdStamp, getattr(self, "stdCmpDigest", None))
+        self.tmpCmpDigest = self.getDigest(self.tmpCmpFile, tmpStamp, getattr(self, "tmpCmpDigest", None))
+        return self.stdCmpDigest[1] == self.tmpCmpDigest[1]
+
+    def getDigest(self, fileName, stamp, storedDigest):
+        if storedDigest and FileDigests.isTrustworthy(stamp) and storedDigest[0] == stamp:
+            self.diag.info("Reusing stored digest for " + fileName)
+            return storedDigest
+        return stamp, FileDigests.getDigest(fileName, stamp)
+
     def cacheDifferences(self, test, testInProgress):
         self.setCmpFiles(test, testInProgress)
         self.updateDifferenceCache(self.SAME)
@@ -286,6 +459,12 @@ class FileComparison:
             self.freeTextBody = self._getFreeTextBody()
         return self.freeTextBody
 
+    def getDiffSignature(self, diffFilters, maxLength):
+        # Worked out when the test is compared, so the GUI can group identical differences without doing it itself
+        if self.diffSignature is None:
+            self.diffSignature = makeDiffSignature(self.getFreeTextBody(), diffFilters, maxLength)
+        return self.diffSignature
+
     def _getFreeTextBody(self):
         if self.binaryFile and \
                 (self.newResult() or self.missingResult()):
@@ -309,6 +488,9 @@ class FileComparison:
                           "' and re-run to see the difference in this text view.\n"
                 return self.previewGenerator.getWrappedLine(message)
 
+            if self.textDiffTool == "builtin":
+                return self.previewGenerator.getPreviewFromIterable(getUnifiedDiffLines(self.stdCmpFile, self.tmpCmpFile))
+
             cmdArgs = plugins.splitcmd(self.textDiffTool) + [self.stdCmpFile, self.tmpCmpFile]
             proc = subprocess.Popen(cmdArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
             return self.previewGenerator.getPreview(proc.stdout)
@@ -371,6 +553,7 @@ class FileComparison:
         self.stdFile = self.getStdFileForSave(versionString)
         self.diag.info("writing split files back to " + self.stdFile)
         self.freeTextBody = None  # clear the cache which may well be wrong now...
+        self.diffSignature = None
         self.backupOrRemove(self.stdFile, backupVersionStrings)
         with open(self.stdFile, "w") as f:
             for splitComp in splitComps:
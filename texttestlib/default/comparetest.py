@@ -66,10 +66,22 @@ class BaseTestComparison(plugins.TestState):
         variablesToStore = test.app.getTestRunVariables()
         isTestCase = test.classId() == "test-case"
         self.categorise(variablesToStore, isTestCase)
+        self.makeDiffSignatures(test)
         self.addAdditionalText(test)
         if (not incompleteOnly or not test.state.isComplete()) and self.category != "not_started":
             test.changeState(self)
 
+    def makeDiffSignatures(self, test):
+        # The dynamic GUI groups identical differences. Do the work here rather than in its main thread
+        maxLength = test.getConfigValue("lines_of_text_difference")
+        diffFilters = {}
+        for fileComp in self.getComparisons():
+            if fileComp.getType() == "failure":
+                if fileComp.textDiffTool not in diffFilters:
+                    filterTexts = test.getCompositeConfigValue("text_diff_program_filters", fileComp.textDiffTool)
+                    diffFilters[fileComp.textDiffTool] = plugins.TextTriggerGroup(filterTexts)
+                fileComp.getDiffSignature(diffFilters[fileComp.textDiffTool], maxLength)
+
     def getRerunCount(self, test):
         number = 1
         while True:
@@ -320,7 +332,8 @@ class TestComparison(BaseTestComparison):
         return ",".join(baseNames)
 
     def getPerformanceStems(self, test):
-        return ["performance"] + list(test.getConfigValue("performance_logfile_extractor").keys())
+        return ["performance"] + list(test.getConfigValue("performance_logfile_extractor").keys()) + \
+            list(test.getConfigValue("performance_resource_usage").keys())
 
     def createFileComparison(self, test, stem, standardFile, tmpFile):
         if stem in self.getPerformanceStems(test):
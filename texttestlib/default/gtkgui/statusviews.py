@@ -284,13 +284,6 @@ class TestProgressMonitor(guiutils.SubGUI):
         briefDesc, _ = state.categoryDescriptions.get(categoryName, (categoryName, categoryName))
         return briefDesc.replace("_", " ").capitalize()
 
-    def filterDiff(self, diff):
-        filteredDiff = ""
-        for line in diff.splitlines():
-            if self.diffFilterGroup.stringContainsText(line):
-                filteredDiff += line + "\n"
-        return filteredDiff or diff  # If we filter it all away, should assume it was a new file and return it unchanged
-
     def getDifferenceType(self, fileComp):
         if fileComp.missingResult():
             return "Missing"
@@ -346,17 +339,17 @@ class TestProgressMonitor(guiutils.SubGUI):
         summary = self.getFileSummary(fileComp)
         fileClass = ["Failed", self.getDifferenceType(fileComp), (summary, fileComp.stem)]
 
-        filteredDiff = self.getFilteredDiff(fileComp)
+        signature = self.getDiffSignature(fileComp)
         extraGroupName = None
-        if filteredDiff is not None:
+        if signature:
             groupNames, summaryDiffs, ungrouped = self.diffStore.setdefault(summary, ({}, OrderedDict(), []))
             hasGroups = len(groupNames) > 0
-            testList, groupName = summaryDiffs.setdefault(filteredDiff, ([], None))
+            testList, groupName = summaryDiffs.setdefault(signature[0][0], ([], None))
             if test not in testList:
                 testList.append(test)
             if groupName is None:
                 onlyIfRepeated = len(testList) == 1
-                groupName, extraGroupName = self.setGroupName(groupNames, summaryDiffs, filteredDiff, onlyIfRepeated)
+                groupName, extraGroupName = self.setGroupName(groupNames, summaryDiffs, signature, onlyIfRepeated)
             if groupName:
                 fileClass.append(("Group " + groupName, fileComp.stem))
             else:
@@ -371,7 +364,7 @@ class TestProgressMonitor(guiutils.SubGUI):
             classifiers.addClassification(extraFileClass)
         self.diag.info("Adding file classification for " + repr(fileComp) + " = " + repr(fileClass))
         classifiers.addClassification(fileClass)
-        if filteredDiff is not None and groupName and not hasGroups:
+        if signature and groupName and not hasGroups:
             for _ in ungrouped:
                 extraFileClass = copy(fileClass[:-1])
                 extraFileClass.append(("Ungrouped", fileComp.stem))
@@ -389,37 +382,29 @@ class TestProgressMonitor(guiutils.SubGUI):
         self.diag.info("Adding file classification for " + repr(fileComp) + " = " + repr(fileClass))
         return fileClass
 
-    def extractRepeats(self, filteredDiff):
-        size = len(filteredDiff)
-        smallPrimes = [2, 3, 5, 7, 11, 13, 17, 19]  # Surely we won't repeat stuff more than 20 times :)
-        for prime in smallPrimes:
-            if size > prime and size % prime == 0:
-                chunkSize = size // prime
-                firstPart = filteredDiff[:chunkSize]
-                if filteredDiff == firstPart * prime:
-                    return firstPart, prime
-        return None, None
-
-    def setGroupName(self, groupNames, summaryDiffs, filteredDiff, onlyIfRepeated):
-        groupName, extraGroupName = self.getGroupName(groupNames, summaryDiffs, filteredDiff, onlyIfRepeated)
+    def setGroupName(self, groupNames, summaryDiffs, signature, onlyIfRepeated):
+        groupName, extraGroupName = self.getGroupName(groupNames, summaryDiffs, signature, onlyIfRepeated)
         if not groupName:
             return None, None
 
-        groupNames[groupName] = filteredDiff
-        tests = summaryDiffs[filteredDiff][0] if filteredDiff in summaryDiffs else []
-        summaryDiffs[filteredDiff] = (tests, groupName)
+        diffDigest = signature[0][0]
+        groupNames[groupName] = diffDigest
+        tests = summaryDiffs[diffDigest][0] if diffDigest in summaryDiffs else []
+        summaryDiffs[diffDigest] = (tests, groupName)
         return groupName, extraGroupName
 
-    def getGroupName(self, groupNames, summaryDiffs, filteredDiff, onlyIfRepeated):
-        self.diag.info("Getting group name for " + repr(filteredDiff))
-        singleVersion, timesRepeated = self.extractRepeats(filteredDiff)
-        if singleVersion:
-            self.diag.info("Extracted repeats of " + repr(singleVersion))
-            _, group = summaryDiffs.get(singleVersion, (None, None))
+    def getGroupName(self, groupNames, summaryDiffs, signature, onlyIfRepeated):
+        diffDigest, timesRepeated = signature[0]
+        self.diag.info("Getting group name for difference " + diffDigest)
+        if timesRepeated:
+            singleVersion = signature[1:]
+            singleDigest = singleVersion[0][0]
+            self.diag.info("Extracted repeats of difference " + singleDigest)
+            _, group = summaryDiffs.get(singleDigest, (None, None))
             if group is None:
                 group, _ = self.setGroupName(groupNames, summaryDiffs, singleVersion, False)
                 self.diag.info("Created group " + repr(group))
-                tests, _ = summaryDiffs.get(singleVersion, (None, None))
+                tests, _ = summaryDiffs.get(singleDigest, (None, None))
                 extraGroupName = group if len(tests) == 1 else None
             else:
                 extraGroupName = None
@@ -438,18 +423,17 @@ class TestProgressMonitor(guiutils.SubGUI):
     def notifySelectInGroup(self, fileComp):
         summary = self.getFileSummary(fileComp)
         _, summaryDiffs, _ = self.diffStore.get(summary, {})
-        filteredDiff = self.getFilteredDiff(fileComp)
-        testList, groupName = summaryDiffs.get(filteredDiff, ([], False))
+        signature = self.getDiffSignature(fileComp)
+        testList, groupName = summaryDiffs.get(signature[0][0], ([], False)) if signature else ([], False)
         if groupName:
             self.notify("SetTestSelection", testList)
 
     def getFileSummary(self, fileComp):
         return fileComp.getSummary(includeNumbers=False)
 
-    def getFilteredDiff(self, fileComp):
-        freeText = fileComp.getFreeTextBody()
-        if freeText.count("\n") < self.maxLengthForGrouping:
-            return self.filterDiff(freeText)
+    def getDiffSignature(self, fileComp):
+        # Usually already there, unless the comparison was made in the GUI itself
+        return fileComp.getDiffSignature(self.diffFilterGroup, self.maxLengthForGrouping)
 
     def removeFromModel(self, test):
         for iter in self.findTestIterators(test):
@@ -507,9 +491,9 @@ class TestProgressMonitor(guiutils.SubGUI):
             groupName = nodeClassifier[6:]
             parentName = self.treeModel.get_value(parentIter, 0)
             groupNames, summaryDiffs, ungrouped = self.diffStore.get(parentName)
-            filteredDiff = groupNames.get(groupName)
-            if filteredDiff is not None:
-                testList = summaryDiffs[filteredDiff][0]
+            diffDigest = groupNames.get(groupName)
+            if diffDigest is not None:
+                testList = summaryDiffs[diffDigest][0]
                 for test in testList:
                     if test in ungrouped:
                         self.removeFromUngroupedNode(test, parentIter)
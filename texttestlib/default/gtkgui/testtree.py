@@ -257,6 +257,8 @@ class TestTreeGUI(guiutils.ContainerGUI):
         self.longActionRunning = False
         self.recreateOnActionStop = False
         self.testSuitesWithResults = set()
+        self.visibleChildren = {}
+        self.modelDetached = False
 
     def notifyDefaultVisibility(self, newValue):
         self.newTestsVisible = newValue
@@ -266,6 +268,7 @@ class TestTreeGUI(guiutils.ContainerGUI):
         return not parentIter or self.treeView.row_expanded(self.filteredModel.get_path(parentIter))
 
     def notifyAllRead(self, *args):
+        self.reattachModel()
         if not self.dynamic:
             self.newTestsVisible = True
             self.model.foreach(self.makeRowVisible)
@@ -277,6 +280,27 @@ class TestTreeGUI(guiutils.ContainerGUI):
 
     def makeRowVisible(self, model, dummyPath, iter):
         model.set_value(iter, 5, True)
+        for test in model.get_value(iter, 2):
+            self.updateVisibleChildren(test)
+
+    def detachModel(self):
+        # The view doesn't need to keep up with each test as it's read in, only to show them all at the end
+        if self.treeView and not self.modelDetached:
+            self.diag.info("Detaching model from view while reading tests")
+            self.selecting = True
+            self.treeView.set_model(None)
+            self.selecting = False
+            self.modelDetached = True
+
+    def reattachModel(self):
+        if self.modelDetached:
+            self.diag.info("Reattaching model to view")
+            self.selecting = True
+            self.treeView.set_model(self.filteredModel)
+            self.selecting = False
+            self.modelDetached = False
+            if self.newTestsVisible:
+                self.treeView.expand_all()
 
     def getNodeName(self, suite, parent):
         nodeName = suite.name
@@ -294,8 +318,9 @@ class TestTreeGUI(guiutils.ContainerGUI):
         iter = self.model.insert_before(parent, follower, row)
         storeIter = iter.copy()
         self.itermap.store(suite, storeIter)
+        self.updateVisibleChildren(suite)
         path = self.model.get_path(iter)
-        if self.newTestsVisible and parent is not None:
+        if self.newTestsVisible and parent is not None and not self.modelDetached:
             filterPath = self.filteredModel.convert_child_path_to_path(path)
             self.treeView.expand_to_path(filterPath)
         return iter
@@ -584,18 +609,20 @@ class TestTreeGUI(guiutils.ContainerGUI):
             self.diag.info("No iterator found for " + repr(test))
             return False
 
-    def findAllTests(self):
+    def findAllTests(self, maxCount=None):
         tests = []
-        self.model.foreach(self.appendTest, tests)
+        self.model.foreach(self.appendTest, (tests, maxCount))
         return tests
 
-    def appendTest(self, model, dummy, iter, tests):
+    def appendTest(self, model, dummy, iter, data):
+        tests, maxCount = data
         for test in model.get_value(iter, 2):
             if test.classId() == "test-case":
                 tests.append(test)
+        return maxCount is not None and len(tests) >= maxCount  # stops iterating
 
     def getTestForAutoSelect(self):
-        allTests = self.findAllTests()
+        allTests = self.findAllTests(maxCount=2)
         if len(allTests) == 1:
             test = allTests[0]
             if self.isVisible(test):
@@ -617,6 +644,8 @@ class TestTreeGUI(guiutils.ContainerGUI):
             return  # don't show empty suites in the dynamic GUI
 
         self.diag.info("Adding test " + repr(test))
+        if initial:
+            self.detachModel()
         self.tryAddTest(test, initial)
         if test.parent is None and not initial:
             # We've added a new suite, we should also select it as it's likely the user wants to add stuff under it
@@ -674,6 +703,7 @@ class TestTreeGUI(guiutils.ContainerGUI):
         if not test in currTests:
             self.diag.info("Adding additional test to node " + self.model.get_value(iter, 0))
             currTests.append(test)
+            self.updateVisibleChildren(test)
 
     def notifyRemove(self, test):
         delta = -test.size()
@@ -685,6 +715,7 @@ class TestTreeGUI(guiutils.ContainerGUI):
         else:
             self.notify("TestTreeCounters", totalDelta=delta, totalShownDelta=delta, totalRowsDelta=0)
             allTests.remove(test)
+            self.updateVisibleChildren(test)
 
     def removeTest(self, test, iter):
         self.diag.info("Removing test " + self.model.get_value(iter, 0))
@@ -696,6 +727,8 @@ class TestTreeGUI(guiutils.ContainerGUI):
         self.selectionChanged(direct=False)
         self.model.remove(iter)
         self.itermap.remove(test)
+        self.updateVisibleChildren(test)
+        self.visibleChildren.pop(test, None)
 
     def notifyNameChange(self, test, origRelPath):
         iter = self.itermap.updateIterator(test, origRelPath)
@@ -779,9 +812,10 @@ class TestTreeGUI(guiutils.ContainerGUI):
 
         if (newValue and len(visibleTests) > 1) or (not newValue and len(visibleTests) > 0):
             self.diag.info("No row visibility change : " + repr(test))
-            return changed
         else:
-            return self.setVisibility(testIter, newValue)
+            changed = self.setVisibility(testIter, newValue)
+        self.updateVisibleChildren(test)
+        return changed
 
     def setVisibility(self, iter, newValue):
         oldValue = self.model.get_value(iter, 5)
@@ -789,7 +823,18 @@ class TestTreeGUI(guiutils.ContainerGUI):
             return False
 
         self.model.set_value(iter, 5, newValue)
+        for test in self.model.get_value(iter, 2):
+            self.updateVisibleChildren(test)
         return True
 
+    def updateVisibleChildren(self, test):
+        # Keep track of the visible tests in each suite, rather than checking all of them every time one is hidden
+        if test.parent is not None:
+            visibleChildren = self.visibleChildren.setdefault(test.parent, set())
+            if self.isMarkedVisible(test):
+                visibleChildren.add(test)
+            else:
+                visibleChildren.discard(test)
+
     def hasVisibleChildren(self, suite):
-        return any((self.isMarkedVisible(test) for test in suite.testcases))
+        return len(self.visibleChildren.get(suite, ())) > 0
@@ -178,7 +178,9 @@ class TextViewGUI(guiutils.SubGUI):
 
     def getDescriptionParagraphs(self, test):
         paragraphs = [self.getDescription(test)]
-        for stem in sorted(set(["performance"] + list(test.getConfigValue("performance_logfile_extractor").keys()))):
+        perfStems = ["performance"] + list(test.getConfigValue("performance_logfile_extractor").keys()) + \
+            list(test.getConfigValue("performance_resource_usage").keys())
+        for stem in sorted(set(perfStems)):
             fileName = test.getFileName(stem)
             if fileName and os.path.isfile(fileName):
                 paragraphs.append(self.getFilePreview(fileName))
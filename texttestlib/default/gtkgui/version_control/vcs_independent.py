@@ -7,6 +7,7 @@ import shutil
 import tempfile
 from gi.repository import Gtk, Gdk, GObject
 from texttestlib import plugins
+from texttestlib.default.comparefile import getUnifiedDiffLines
 from .. import guiplugins, guiutils, entrycompletion
 from ..default_gui import adminactions, changeteststate
 from . import custom_widgets
@@ -775,8 +776,11 @@ class FilteredDiffGUI(GenericDiffGUI):
                 if errors:
                     self.storeResult(fileName, errors, test)
                     continue
-                proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-                output = proc.communicate()[0]
+                if diffProgram == "builtin":
+                    output = "".join(getUnifiedDiffLines(args[1], args[2]))
+                else:
+                    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+                    output = proc.communicate()[0]
                 self.storeResult(fileName, output, test)
             shutil.rmtree(tmpDir)
 
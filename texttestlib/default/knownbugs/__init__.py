@@ -5,10 +5,14 @@ import sys
 import logging
 import glob
 import re
+import json
+import time
 from texttestlib import plugins
 from configparser import ConfigParser, NoOptionError
 from copy import copy
 from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
 
 plugins.addCategory("bug", "known bugs", "had known bugs")
 plugins.addCategory("badPredict", "internal errors", "had internal errors")
@@ -52,7 +56,100 @@ class Bug:
             return ""
 
 
+class BugInfoCache:
+    """ What bug systems said about each bug, so that each is only asked once per run,
+    however many tests find the same bug at the same time. Optionally also kept in a file for later runs """
+    # Returned by the bug system modules when they couldn't find out: not worth keeping for later runs
+    errorStatuses = ["unknown", "NONEXISTENT", "BAD SCRIPT", "PARSE ERROR", "JIRA ERROR", "AZURE DEVOPS ERROR", "PAT not set"]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.lookups = {}
+        self.fileEntries = None
+        self.diag = logging.getLogger("Bug Info Cache")
+
+    def getBugInfo(self, bug, location, username, password, maxMinutes):
+        key = bug.bugSystem, location, bug.bugId
+        with self.lock:
+            lookup = self.lookups.get(key)
+            isNew = lookup is None
+            if isNew:
+                lookup = self.lookups[key] = Future()
+        if isNew:
+            try:
+                info = self.lookUp(bug, key, username, password, maxMinutes)
+                lookup.set_result(info)
+                failed = info[0] in self.errorStatuses
+            except Exception as e:
+                lookup.set_exception(e)
+                failed = True
+            if failed:
+                # Anyone already waiting shares the failure, but later tests should try again
+                with self.lock:
+                    if self.lookups.get(key) is lookup:
+                        del self.lookups[key]
+        else:
+            self.diag.info("Waiting for or reusing earlier lookup of " + repr(key))
+        return lookup.result()
+
+    def lookUp(self, bug, key, username, password, maxMinutes):
+        fileKey = "\t".join(key)
+        if maxMinutes:
+            cached = self.readFileEntry(fileKey, maxMinutes)
+            if cached:
+                self.diag.info("Found " + repr(key) + " in cache file")
+                return cached
+        self.diag.info("Looking up " + repr(key))
+        info = bug.findBugInfo(bug.bugId, key[1], username, password)
+        if maxMinutes and info[0] not in self.errorStatuses:
+            self.writeFileEntry(fileKey, info)
+        return info
+
+    @staticmethod
+    def getFileName():
+        return os.path.join(plugins.getPersonalDir("cache"), "bug_system_info.json")
+
+    def readFile(self):
+        try:
+            with open(self.getFileName()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def readFileEntry(self, fileKey, maxMinutes):
+        with self.lock:
+            if self.fileEntries is None:
+                self.fileEntries = self.readFile()
+            entry = self.fileEntries.get(fileKey)
+        if entry and time.time() - entry[0] < maxMinutes * 60:
+            return tuple(entry[1])
+
+    def writeFileEntry(self, fileKey, info):
+        fileName = self.getFileName()
+        with self.lock:
+            # Other runs may have written to it since we read it
+            self.fileEntries = self.readFile()
+            self.fileEntries[fileKey] = time.time(), info
+            try:
+                plugins.ensureDirExistsForFile(fileName)
+                tmpFileName = fileName + "." + str(os.getpid())
+                with open(tmpFileName, "w") as f:
+                    json.dump(self.fileEntries, f)
+                os.replace(tmpFileName, fileName)
+            except OSError as e:
+                plugins.printWarning("Could not write bug information to " + fileName + " : " + str(e))
+
+    def prefetch(self, bugsWithLogins):
+        self.diag.info("Prefetching information for " + str(len(bugsWithLogins)) + " bugs")
+        executor = ThreadPoolExecutor(min(len(bugsWithLogins), 8), thread_name_prefix="BugInfoPrefetcher")
+        for bugWithLogin in bugsWithLogins:
+            executor.submit(self.getBugInfo, *bugWithLogin)
+        executor.shutdown(wait=False)
+
+
 class BugSystemBug(Bug):
+    infoCache = BugInfoCache()
+
     def __init__(self, bugSystem, bugId, priorityStr, *args):
         self.bugId = bugId
         self.bugSystem = bugSystem
@@ -62,14 +159,19 @@ class BugSystemBug(Bug):
     def __repr__(self):
         return self.bugId
 
-    def findInfo(self, test):
+    def getLogin(self, test):
         location = test.getCompositeConfigValue("bug_system_location", self.bugSystem)
         username = test.getCompositeConfigValue("bug_system_username", self.bugSystem)
         password = test.getCompositeConfigValue("bug_system_password", self.bugSystem)
-        status, bugText, isResolved, bugId = self.findBugInfo(self.bugId, location, username, password)
-        self.bugId = bugId
+        maxMinutes = test.getCompositeConfigValue("bug_system_cache_minutes", self.bugSystem)
+        return location, username, password, maxMinutes
+
+    def findInfo(self, test):
+        # The bug system may know the bug by another ID. Don't store it: bugs are shared between tests,
+        # and the ID they were written with is what looks them up
+        status, bugText, isResolved, bugId = self.infoCache.getBugInfo(self, *self.getLogin(test))
         category = self.findCategory(isResolved)
-        briefText = "bug " + self.bugId + " (" + status + ")"
+        briefText = "bug " + bugId + " (" + status + ")"
         return category, briefText, self.getRerunText() + bugText
 
     def findBugInfo(self, bugId, location, username, password):
@@ -210,11 +312,16 @@ class BugTrigger:
 
 
 class FileBugData:
+    # Regular expressions can't be combined if they refer to their own groups
+    groupReference = re.compile(r"\\[1-9]|\(\?P[<=]")
+
     def __init__(self):
         self.presentList = []
         self.absentList = []
         self.identicalList = []
         self.checkUnchanged = False
+        self.lineFilter = None
+        self.unfilteredTriggers = None
         self.diag = logging.getLogger("Check For Bugs")
 
     def addBugTrigger(self, getOption):
@@ -227,6 +334,33 @@ class FileBugData:
             self.identicalList.append(bugTrigger)
         else:
             self.presentList.append(bugTrigger)
+        self.unfilteredTriggers = None
+
+    def makeLineFilter(self):
+        # One pattern matching any line that any trigger, or any line of a multiline trigger, could match.
+        # Lines it doesn't match can't match or advance any of the triggers, and most lines are like that.
+        patterns = []
+        self.unfilteredTriggers = set()
+        for bugTrigger in self.presentList + self.absentList:
+            triggerPatterns = list(map(self.getCombinablePattern, bugTrigger.textTrigger.triggers))
+            if None in triggerPatterns:
+                self.unfilteredTriggers.add(bugTrigger)
+            else:
+                patterns += triggerPatterns
+        self.lineFilter = re.compile("|".join(patterns)) if patterns else None
+        self.diag.info("Combined " + str(len(patterns)) + " patterns, " +
+                       str(len(self.unfilteredTriggers)) + " triggers must be checked on every line")
+
+    def getCombinablePattern(self, lineTrigger):
+        if not lineTrigger.regex:
+            return re.escape(lineTrigger.text)
+        pattern = "(?:" + lineTrigger.regex.pattern + ")"
+        if not self.groupReference.search(pattern):
+            try:
+                re.compile(pattern)
+                return pattern
+            except re.error:
+                pass
 
     def findBugs(self, fileName, execHosts, isChanged, multipleDiffs):
         if not self.checkUnchanged and not isChanged:
@@ -241,23 +375,36 @@ class FileBugData:
 
         self.diag.info("Looking for bugs in " + fileName)
         dirname = os.path.dirname(fileName)
-        return self.findBugsInText(open(fileName).readlines(), execHosts=execHosts, isChanged=isChanged, multipleDiffs=multipleDiffs, tmpDir=dirname)
+        with open(fileName) as f:
+            return self.findBugsInText(f, execHosts=execHosts, isChanged=isChanged, multipleDiffs=multipleDiffs, tmpDir=dirname)
 
     def findBugsInText(self, lines, **kw):
         currAbsent = copy(self.absentList)
         bugs = []
-        for bugTrigger in self.identicalList:
-            if bugTrigger not in bugs and bugTrigger.exactMatch(lines, **kw):
-                bugs.append(bugTrigger)
+        if self.identicalList:
+            # These need all the lines at once
+            lines = list(lines)
+            for bugTrigger in self.identicalList:
+                if bugTrigger not in bugs and bugTrigger.exactMatch(lines, **kw):
+                    bugs.append(bugTrigger)
+        if self.unfilteredTriggers is None:
+            self.makeLineFilter()
         for line in lines:
+            if self.lineFilter and self.lineFilter.search(line):
+                presentList, absentList = self.presentList, currAbsent
+            elif self.unfilteredTriggers:
+                presentList = [t for t in self.presentList if t in self.unfilteredTriggers]
+                absentList = [t for t in currAbsent if t in self.unfilteredTriggers]
+            else:
+                continue
             self.diag.info("Checking " + repr(line))
-            for bugTrigger in self.presentList:
+            for bugTrigger in presentList:
                 self.diag.info("Checking for existence of " + repr(bugTrigger))
                 if bugTrigger not in bugs and bugTrigger.hasBug(line, **kw):
                     self.diag.info("FOUND!")
                     bugs.append(bugTrigger)
             toRemove = []
-            for bugTrigger in currAbsent:
+            for bugTrigger in absentList:
                 self.diag.info("Checking for absence of " + repr(bugTrigger))
                 if bugTrigger.matchesText(line):
                     self.diag.info("PRESENT!")
@@ -275,6 +422,14 @@ class FileBugData:
         return bugs
 
 
+def getFileKey(fileName):
+    try:
+        statInfo = os.stat(fileName)
+        return statInfo.st_mtime_ns, statInfo.st_size
+    except OSError:
+        pass
+
+
 class ParseMethod:
     def __init__(self, parser, section):
         self.parser = parser
@@ -288,17 +443,40 @@ class ParseMethod:
 
 
 class BugMap(OrderedDict):
+    # Parsed files, which are only read here, by path, with the modification time and size they had
+    parserCache = {}
+
+    def __init__(self, *args):
+        OrderedDict.__init__(self, *args)
+        self.lock = Lock()
+
     def checkUnchanged(self):
         for bugData in list(self.values()):
             if bugData.checkUnchanged:
                 return True
         return False
 
+    def resetTriggers(self):
+        # Multiline triggers remember how far they got
+        for bugData in self.values():
+            for bugTrigger in bugData.presentList + bugData.absentList + bugData.identicalList:
+                bugTrigger.textTrigger.reset()
+
     def readFromFile(self, fileName):
-        parser = self.makeParser(fileName)
+        parser = self.getParser(fileName)
         if parser:
             self.readFromParser(parser)
 
+    @classmethod
+    def getParser(cls, fileName):
+        fileKey = getFileKey(fileName)
+        cached = cls.parserCache.get(fileName)
+        if cached and cached[0] == fileKey:
+            return cached[1]
+        parser = cls.makeParser(fileName)
+        cls.parserCache[fileName] = fileKey, parser
+        return parser
+
     def readFromFileObject(self, f):
         parser = self.makeParserFromFileObject(f)
         if parser:
@@ -363,6 +541,8 @@ class CheckForCrashes(plugins.Action):
 
 
 class CheckForBugs(plugins.Action):
+    bugMapCache = {}
+
     def __init__(self):
         self.diag = logging.getLogger("Check For Bugs")
 
@@ -373,6 +553,23 @@ class CheckForBugs(plugins.Action):
     def __repr__(self):
         return "Checking known bugs for"
 
+    def setUpSuite(self, suite):
+        if suite.parent is None and suite.getConfigValue("bug_system_prefetch"):
+            bugsWithLogins = self.findBugSystemBugs(suite.testCaseList())
+            if bugsWithLogins:
+                BugSystemBug.infoCache.prefetch(bugsWithLogins)
+
+    def findBugSystemBugs(self, tests):
+        bugsWithLogins = OrderedDict()
+        for test in tests:
+            for fileBugData in self.readBugs(test).values():
+                for bugTrigger in fileBugData.presentList + fileBugData.absentList + fileBugData.identicalList:
+                    bug = bugTrigger.bugInfo
+                    if isinstance(bug, BugSystemBug):
+                        login = bug.getLogin(test)
+                        bugsWithLogins.setdefault((bug.bugSystem, login[0], bug.bugId), (bug,) + login)
+        return list(bugsWithLogins.values())
+
     def __call__(self, test):
         newState, rerunCount = self.checkTest(test, test.state)
         if newState:
@@ -416,11 +613,14 @@ class CheckForBugs(plugins.Action):
     def findAllBugs(self, test, state, activeBugs):
         multipleDiffs = self.hasMultipleDifferences(test, state)
         bugs, bugStems = [], []
-        for stem, fileBugData in list(activeBugs.items()):
-            newBugs = self.findBugsInFile(test, state, stem, fileBugData, multipleDiffs)
-            if newBugs:
-                bugs += newBugs
-                bugStems += [stem] * len(newBugs)
+        # The bugs may be shared with other tests, possibly being checked in other threads
+        with activeBugs.lock:
+            activeBugs.resetTriggers()
+            for stem, fileBugData in list(activeBugs.items()):
+                newBugs = self.findBugsInFile(test, state, stem, fileBugData, multipleDiffs)
+                if newBugs:
+                    bugs += newBugs
+                    bugStems += [stem] * len(newBugs)
         return bugs, bugStems
 
     def findBug(self, test, state, activeBugs):
@@ -482,12 +682,19 @@ class CheckForBugs(plugins.Action):
         return diffCount > 1
 
     def readBugs(self, test):
-        bugMap = BugMap()
         # Mostly for backwards compatibility, reverse the list so that more specific bugs
         # get checked first.
-        for bugFile in reversed(test.getAllPathNames("knownbugs")):
+        bugFiles = list(reversed(test.getAllPathNames("knownbugs")))
+        # Tests with the same bug files, unchanged since we last read them, can share the bugs read from them
+        fileKeys = list(map(getFileKey, bugFiles))
+        cached = self.bugMapCache.get(tuple(bugFiles))
+        if cached and cached[0] == fileKeys:
+            return cached[1]
+        bugMap = BugMap()
+        for bugFile in bugFiles:
             self.diag.info("Reading bugs from file " + bugFile)
             bugMap.readFromFile(bugFile)
+        self.bugMapCache[tuple(bugFiles)] = fileKeys, bugMap
         return bugMap
 
     def fixBackupMessage(self, newState):
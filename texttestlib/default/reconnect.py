@@ -1,5 +1,6 @@
 
 import os
+import sys
 import shutil
 import operator
 import logging
@@ -8,6 +9,13 @@ import datetime
 from texttestlib import plugins
 from glob import glob
 from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+    # Clones a file's data, where the file system can. Linux only, and only in the fcntl module from Python 3.12
+    FICLONE = getattr(fcntl, "FICLONE", 0x40049409 if sys.platform.startswith("linux") else None)
+except ImportError:
+    FICLONE = None  # Windows
 
 # Trawl around for a suitable dir to reconnect to if we haven't been told one
 # A tangle of side-effects: we find the run directory when asked for the extra versions,
@@ -245,6 +253,28 @@ class ReconnectConfig:
             app.addConfigEntry("unsaveable_version", datedVersion)
 
 
+def cloneFile(fullPath, targetPath):
+    if FICLONE is None:
+        return False
+    with open(fullPath, "rb") as src, open(targetPath, "xb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            # File system doesn't support it, or the files are on different file systems
+            pass
+    os.remove(targetPath)
+    return False
+
+
+def hardLinkFile(fullPath, targetPath):
+    try:
+        os.link(fullPath, targetPath)
+        return True
+    except OSError:
+        return False
+
+
 class ReconnectFilter(plugins.TextFilter):
     def __init__(self, rootDir):
         self.rootDir = rootDir
@@ -256,10 +286,56 @@ class ReconnectFilter(plugins.TextFilter):
         return os.path.exists(os.path.join(self.rootDir, suite.getRelPath()))
 
 
+class ReconnectLoader:
+    """ Loads the stored states of the tests, and fetches their files where needed, ahead of the action runner.
+    The action runner still changes their states in order, one at a time """
+    progressInterval = 100
+
+    def __init__(self, reconnectAction, threadCount):
+        self.reconnectAction = reconnectAction
+        self.executor = ThreadPoolExecutor(threadCount, thread_name_prefix="ReconnectLoader")
+        # Don't load everything into memory at once for huge runs
+        self.maxAhead = threadCount * 10
+        self.suite = None
+        self.tests = []
+        self.testIndices = {}
+        self.futures = {}
+        self.submitted = 0
+        self.collected = 0
+        self.diag = logging.getLogger("Reconnection")
+
+    def loadTests(self, suite):
+        self.suite = suite
+        self.tests = suite.testCaseList()
+        self.testIndices = dict((test, index) for index, test in enumerate(self.tests))
+        self.diag.info("Loading " + str(len(self.tests)) + " tests in the background")
+        self.submitUpTo(self.maxAhead)
+
+    def submitUpTo(self, limit):
+        while self.submitted < min(limit, len(self.tests)):
+            test = self.tests[self.submitted]
+            self.futures[test] = self.executor.submit(self.reconnectAction.prepareTest, test)
+            self.submitted += 1
+        if self.submitted == len(self.tests):
+            self.executor.shutdown(wait=False)
+
+    def getResult(self, test):
+        future = self.futures.pop(test, None)
+        if future is None:  # not one we knew about when we started
+            return self.reconnectAction.prepareTest(test)
+        # Tests may have been skipped, if the run has been killed for example
+        self.submitUpTo(self.testIndices[test] + 1 + self.maxAhead)
+        self.collected += 1
+        if self.collected % self.progressInterval == 0 or self.collected == len(self.tests):
+            self.suite.notify("Status", "Reconnected to " + str(self.collected) + " of " + str(len(self.tests)) + " tests ...")
+        return future.result()
+
+
 class ReconnectTest(plugins.Action):
     def __init__(self, rootDirToCopy, fullRecalculate):
         self.rootDirToCopy = rootDirToCopy
         self.fullRecalculate = fullRecalculate
+        self.loader = None
         self.diag = logging.getLogger("Reconnection")
 
     def __repr__(self):
@@ -272,13 +348,23 @@ class ReconnectTest(plugins.Action):
             test.changeState(newState)
 
     def getReconnectState(self, test):
+        loaded, newState = self.loader.getResult(test) if self.loader else self.prepareTest(test)
+        if loaded and self.modifyState(test, newState):  # if we can't read it, recompute it
+            return newState
+
+    def prepareTest(self, test):
+        # Doesn't depend on the current state of the test, so can be done in advance by the loader
         reconnLocation = os.path.join(self.rootDirToCopy, test.getRelPath())
         self.diag.info("Reconnecting to test at " + reconnLocation)
-        if os.path.isdir(reconnLocation):
-            return self.getReconnectStateFrom(test, reconnLocation)
-        else:
-            return plugins.Unrunnable(briefText="no results",
-                                      freeText="No file found to load results from under " + reconnLocation)
+        if not os.path.isdir(reconnLocation):
+            return True, plugins.Unrunnable(briefText="no results",
+                                            freeText="No file found to load results from under " + reconnLocation)
+
+        loaded, newState = self.loadState(test, reconnLocation)
+        # We recompute if we can't read the state, so we need the files then too
+        if self.fullRecalculate or not loaded:
+            self.copyFiles(test, reconnLocation)
+        return loaded, newState
 
     def getStateText(self, state):
         if state:
@@ -286,15 +372,22 @@ class ReconnectTest(plugins.Action):
         else:
             return " (recomputing)"
 
+    def loadState(self, test, location):
+        stateFile = os.path.join(location, "framework_tmp", "teststate")
+        if not os.path.isfile(stateFile):
+            return False, None
+
+        newTmpPath = os.path.dirname(self.rootDirToCopy)
+        with open(stateFile, "rb") as f:
+            loaded, newState = test.getNewState(f, updatePaths=True, newTmpPath=newTmpPath)
+        self.diag.info("Loaded state file at " + stateFile + " - " + repr(loaded))
+        return loaded, newState
+
     def getReconnectStateFrom(self, test, location, copyEvenIfLoadFails=True):
         stateToUse = None
-        stateFile = os.path.join(location, "framework_tmp", "teststate")
-        if os.path.isfile(stateFile):
-            newTmpPath = os.path.dirname(self.rootDirToCopy)
-            loaded, newState = test.getNewState(open(stateFile, "rb"), updatePaths=True, newTmpPath=newTmpPath)
-            self.diag.info("Loaded state file at " + stateFile + " - " + repr(loaded))
-            if loaded and self.modifyState(test, newState):  # if we can't read it, recompute it
-                stateToUse = newState
+        loaded, newState = self.loadState(test, location)
+        if loaded and self.modifyState(test, newState):  # if we can't read it, recompute it
+            stateToUse = newState
 
         if (copyEvenIfLoadFails or stateToUse) and (self.fullRecalculate or not stateToUse):
             self.copyFiles(test, location)
@@ -306,12 +399,17 @@ class ReconnectTest(plugins.Action):
         tmpDir = test.getDirectory(temporary=1)
         plugins.ensureDirectoryExists(tmpDir)
         self.diag.info("Copying files from " + reconnLocation + " to " + tmpDir)
+        linkFiles = test.getConfigValue("reconnect_link_files")
         for file in os.listdir(reconnLocation):
             fullPath = os.path.join(reconnLocation, file)
             if os.path.isfile(fullPath):
                 targetPath = os.path.join(tmpDir, os.path.basename(fullPath))
                 try:
-                    shutil.copyfile(fullPath, targetPath)
+                    # Anything already there might be linked to the original, don't write through it
+                    if os.path.lexists(targetPath):
+                        os.remove(targetPath)
+                    if not linkFiles or not self.linkFile(fullPath, targetPath, linkFiles):
+                        shutil.copyfile(fullPath, targetPath)
                 except EnvironmentError as e:
                     # File could not be copied, may not have been readable
                     # Write the exception to it instead
@@ -319,6 +417,11 @@ class ReconnectTest(plugins.Action):
                     targetFile.write("Failed to copy file - exception info follows :\n" + str(e) + "\n")
                     targetFile.close()
 
+    def linkFile(self, fullPath, targetPath, linkFiles):
+        # A reflink is an independent copy as far as anyone else is concerned.
+        # A hard link is the original file: only used if asked for, as anything writing to it in place changes the original run
+        return cloneFile(fullPath, targetPath) or (linkFiles == 2 and hardLinkFile(fullPath, targetPath))
+
     def modifyState(self, test, newState):
         if self.fullRecalculate:
             # Only pick up errors here, recalculate the rest. Don't notify until
@@ -335,6 +438,11 @@ class ReconnectTest(plugins.Action):
 
     def setUpApplication(self, app):
         plugins.log.info("Reconnecting to test results in directory " + self.rootDirToCopy)
+        threadCount = app.getConfigValue("reconnect_threads")
+        if threadCount > 1:
+            self.loader = ReconnectLoader(self, threadCount)
 
     def setUpSuite(self, suite):
         self.describe(suite)
+        if self.loader and suite.parent is None:
+            self.loader.loadTests(suite)
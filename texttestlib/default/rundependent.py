@@ -2,12 +2,17 @@
 
 
 import os
+import re
+import time
 import logging
-import shutil
+import multiprocessing
 from texttestlib.default import fpdiff
 from texttestlib import plugins
 from optparse import OptionParser
 from io import StringIO
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Filtering(plugins.TestState):
@@ -18,6 +23,10 @@ class Filtering(plugins.TestState):
 
 
 class FilterAction(plugins.Action):
+    processPool = None
+    lock = Lock()
+    timesByStem = {}
+
     def __init__(self, useFilteringStates=False):
         self.diag = logging.getLogger("Filter Actions")
         self.useFilteringStates = useFilteringStates
@@ -26,11 +35,19 @@ class FilterAction(plugins.Action):
         if self.useFilteringStates:
             self.changeToFilteringState(test)
 
+        filesToFilter = []
         for fileName, postfix in self.filesToFilter(test):
             self.diag.info("Considering for filtering : " + fileName)
             stem = self.getStem(fileName)
             newFileName = test.makeTmpFileName(stem + "." + test.app.name + postfix, forFramework=1)
-            self.performAllFilterings(test, stem, fileName, newFileName)
+            filesToFilter.append((stem, fileName, newFileName))
+
+        pool = self.getProcessPool(test.app) if len(filesToFilter) > 1 else None
+        if pool:
+            self.performAllFilteringsInPool(pool, test, filesToFilter)
+        else:
+            for stem, fileName, newFileName in filesToFilter:
+                self.performAllFilterings(test, stem, fileName, newFileName)
 
     def getStem(self, fileName):
         return os.path.basename(fileName).split(".")[0]
@@ -39,22 +56,55 @@ class FilterAction(plugins.Action):
         pass
 
     def performAllFilterings(self, test, stem, fileName, newFileName):
-        currFileName = fileName
         filters = self.makeAllFilters(test, stem, test.app)
-        for fileFilter in filters:
-            writeFileName = newFileName + "." + fileFilter.postfix
-            self.diag.info("Applying " + fileFilter.__class__.__name__ +
-                           " to make\n" + writeFileName + " from\n " + currFileName)
-            if os.path.isfile(writeFileName):
-                self.diag.info("Removing previous file at " + writeFileName)
-                os.remove(writeFileName)
-            currFile = open(currFileName, errors="ignore")
-            writeFile = plugins.openForWrite(writeFileName)
-            fileFilter.filterFile(currFile, writeFile)
-            writeFile.close()
-            currFileName = writeFileName
-        if len(filters) > 0 and currFileName != newFileName:
-            shutil.move(currFileName, newFileName)
+        if len(filters) > 0:
+            self.describeFiltering(filters, fileName, newFileName)
+            timeTaken = applyFilters(filters, fileName, newFileName)
+            self.recordTime(test, stem, filters, timeTaken)
+
+    def performAllFilteringsInPool(self, pool, test, filesToFilter):
+        futures = []
+        for stem, fileName, newFileName in filesToFilter:
+            filters = self.makeAllFilters(test, stem, test.app)
+            if len(filters) > 0:
+                self.describeFiltering(filters, fileName, newFileName)
+                futures.append((stem, filters, pool.submit(applyFilters, filters, fileName, newFileName)))
+        # Everything must be filtered before we go on to compare anything
+        for stem, filters, future in futures:
+            self.recordTime(test, stem, filters, future.result())
+
+    def describeFiltering(self, filters, fileName, newFileName):
+        self.diag.info("Applying " + ",".join(f.__class__.__name__ for f in filters) +
+                       " to make\n" + newFileName + " from\n " + fileName)
+
+    def recordTime(self, test, stem, filters, timeTaken):
+        self.diag.info("Filtered " + stem + " for " + repr(test) + " in " + "%.3f" % timeTaken +
+                       " seconds, using " + ",".join(f.__class__.__name__ for f in filters))
+        with self.lock:
+            FilterAction.timesByStem[stem] = FilterAction.timesByStem.get(stem, 0.0) + timeTaken
+
+    @classmethod
+    def getProcessPool(cls, app):
+        processCount = app.getConfigValue("filter_processes")
+        if processCount <= 1:
+            return
+        with cls.lock:
+            if FilterAction.processPool is None:
+                # Don't fork a process that has other threads running, they might be holding locks
+                context = multiprocessing.get_context("spawn")
+                FilterAction.processPool = ProcessPoolExecutor(max_workers=processCount, mp_context=context)
+            return FilterAction.processPool
+
+    @classmethod
+    def finalise(cls):
+        if FilterAction.processPool is not None:
+            FilterAction.processPool.shutdown()
+            FilterAction.processPool = None
+        if FilterAction.timesByStem:
+            diag = logging.getLogger("Filter Actions")
+            for stem, timeTaken in sorted(FilterAction.timesByStem.items(), key=lambda item: -item[1]):
+                diag.info("Total time filtering " + stem + " files : " + "%.3f" % timeTaken + " seconds")
+            FilterAction.timesByStem = {}
 
     def getAllFilters(self, test, fileName, app):
         stem = self.getStem(fileName)
@@ -62,22 +112,14 @@ class FilterAction(plugins.Action):
 
     def getFilteredText(self, test, fileName, app):
         filters = self.getAllFilters(test, fileName, app)
-        inFile = open(fileName, errors="ignore")
-        if len(filters) == 0:
-            try:
+        with open(fileName, errors="ignore") as inFile:
+            if len(filters) == 0:
                 return inFile.read()
-            finally:
-                inFile.close()
-        for fileFilter in filters:
-            self.diag.info("Applying " + fileFilter.__class__.__name__ + " to " + fileName)
+            self.diag.info("Applying " + ",".join(f.__class__.__name__ for f in filters) + " to " + fileName)
             outFile = StringIO()
-            fileFilter.filterFile(inFile, outFile)
-            inFile.close()
-            inFile = outFile
-            inFile.seek(0)
-        value = outFile.getvalue()
-        outFile.close()
-        return value
+            # The stages used to be chained via StringIO here, so no newline translation between them
+            FilterPipeline(filters, translateNewlines=False).filterFile(inFile, outFile)
+            return outFile.getvalue()
 
     def makeAllFilters(self, test, stem, app):
         filters = self._makeAllFilters(test, stem, app)
@@ -107,6 +149,19 @@ class FilterAction(plugins.Action):
         return [(file, postfix) for file in files]
 
 
+# Module level so it can be run in another process
+def applyFilters(filters, fileName, newFileName):
+    startTime = time.perf_counter()
+    with open(fileName, errors="ignore") as currFile, plugins.openForWrite(newFileName) as writeFile:
+        if len(filters) > 1 and filters[0].postfix == RunDependentTextFilter.postfix:
+            # The content-filtered file, before sorting etc., is used for viewing and saving
+            with plugins.openForWrite(newFileName + "." + filters[0].postfix) as normalFile:
+                FilterPipeline(filters).filterFile(currFile, writeFile, normalFile)
+        else:
+            FilterPipeline(filters).filterFile(currFile, writeFile)
+    return time.perf_counter() - startTime
+
+
 class FilterOriginal(FilterAction):
     def filesToFilter(self, test):
         resultFiles, defFiles = test.listApprovedFiles(allVersions=False, defFileCategory="regenerate")
@@ -178,6 +233,61 @@ class FilterResultRecompute(FilterOnTempFile):
         return result
 
 
+class FilterPipeline:
+    """ Streams the lines of a file through all the filters in one pass.
+    Each filter used to write a file of its own for the next one to read: the lines are
+    split up again between the stages as if that was still happening, so that the output is the same."""
+    def __init__(self, filters, translateNewlines=True):
+        self.filters = filters
+        self.translateNewlines = translateNewlines
+
+    def filterFile(self, inFile, writeFile, firstStageFile=None):
+        lines = inFile
+        for index, fileFilter in enumerate(self.filters):
+            sourceFile = inFile if index == 0 else None
+            if index > 0:
+                lines = self.splitIntoLines(lines)
+            lines = fileFilter.filterLines(lines, sourceFile)
+            if index == 0 and firstStageFile is not None:
+                lines = self.copyLines(lines, firstStageFile)
+        writeFile.writelines(lines)
+
+    def copyLines(self, lines, copyFile):
+        for line in lines:
+            copyFile.write(line)
+            yield line
+
+    def splitIntoLines(self, chunks):
+        pending = ""
+        for chunk in chunks:
+            # Nearly always a single complete line, in which case there is nothing to do
+            if not pending and chunk.endswith("\n") and chunk.find("\n") == len(chunk) - 1 and \
+                    (not self.translateNewlines or "\r" not in chunk):
+                yield chunk
+                continue
+            pending += chunk
+            carry = ""
+            if self.translateNewlines:
+                if pending.endswith("\r"):  # might be the start of \r\n
+                    pending, carry = pending[:-1], "\r"
+                pending = self.translate(pending)
+            lines = pending.split("\n")
+            for line in lines[:-1]:
+                yield line + "\n"
+            pending = lines[-1] + carry
+        if self.translateNewlines:
+            pending = self.translate(pending)
+        lines = pending.split("\n")
+        for line in lines[:-1]:
+            yield line + "\n"
+        if lines[-1]:
+            yield lines[-1]
+
+    def translate(self, text):
+        # Universal newlines, as when reading a file in text mode
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
 class FloatingPointFilter:
     postfix = "fpdiff"
 
@@ -188,14 +298,23 @@ class FloatingPointFilter:
         self.split = split
 
     def filterFile(self, inFile, writeFile):
+        self.writeFilteredLines(inFile.readlines(), writeFile)
+
+    def filterLines(self, lines, sourceFile=None):
+        # Needs the whole file anyway
+        writeFile = StringIO()
+        self.writeFilteredLines(list(lines), writeFile)
+        yield writeFile.getvalue()
+
+    def writeFilteredLines(self, tolines, writeFile):
         fromlines = open(self.origFileName, errors="ignore").readlines()
-        tolines = inFile.readlines()
         fpdiff.fpfilter(fromlines, tolines, writeFile, self.tolerance, self.relative, split=self.split)
 
 
 class RunDependentTextFilter(plugins.Observable):
     configKey = "run_dependent_text"
     postfix = "normal"
+    maxBufferInMemory = 64 * 1024 * 1024
 
     def __init__(self, filterTexts, testId=""):
         plugins.Observable.__init__(self)
@@ -269,6 +388,58 @@ class RunDependentTextFilter(plugins.Observable):
                     filteredAway.setdefault(lineFilter, []).append(line)
             seekPoints.append(newFile.tell())
 
+    def filterLines(self, lines, sourceFile=None, filteredAway=None):
+        if self.needsBuffering(sourceFile):
+            yield from self.filterBuffered(lines, sourceFile, filteredAway)
+            return
+
+        lineNumber = 0
+        lineFilters = self.findRelevantFilters(sourceFile)
+        dispatcher = TriggerDispatcher([lineFilter for lineFilter, _ in lineFilters])
+        removing = False
+        reportProgress = len(self.observers) > 0 and self.inMainThread()
+        for line in lines:
+            if reportProgress:
+                self.notifyIfMainThread("ActionProgress")
+            lineNumber += 1
+            # Filters part-way through removing lines need to see everything, otherwise only lines they might match
+            if not removing and not dispatcher.mightMatch(line, lineNumber):
+                yield line
+                continue
+
+            self.removeFinishedFilters(lineFilters, lineNumber)
+            lineFilter, filteredLine, _ = self.getFilteredLine(line, lineNumber, lineFilters)
+            removing = any(f.autoRemove for f, _ in lineFilters)
+            if filteredLine:
+                yield filteredLine
+            elif filteredAway is not None and lineFilter is not None:
+                filteredAway.setdefault(lineFilter, []).append(line)
+
+    def needsBuffering(self, sourceFile):
+        # {PREVLINES} removes text already written, and sections need to see the whole file first
+        if any(lineFilter.prevLinesToRemove for lineFilter in self.lineFilters):
+            return True
+        return sourceFile is None and any(lineFilter.untrigger is not None for lineFilter in self.lineFilters)
+
+    def filterBuffered(self, lines, sourceFile, filteredAway):
+        self.diag.info("Filtering via a buffer, cannot stream with these filters")
+        with SpooledTemporaryFile(max_size=self.maxBufferInMemory, mode="w+") as newFile:
+            if sourceFile is not None:
+                RunDependentTextFilter.filterFile(self, sourceFile, newFile, filteredAway)
+            else:
+                with SpooledTemporaryFile(max_size=self.maxBufferInMemory, mode="w+") as file:
+                    file.writelines(lines)
+                    file.seek(0)
+                    RunDependentTextFilter.filterFile(self, file, newFile, filteredAway)
+            newFile.seek(0)
+            yield from newFile
+
+    def removeFinishedFilters(self, lineFilters, lineNumber):
+        # Done by getFilteredLine on the last relevant line, but we may have skipped it
+        for lineFilter, lastRelevantLine in list(lineFilters):
+            if lastRelevantLine is not None and lastRelevantLine < lineNumber:
+                lineFilters.remove((lineFilter, lastRelevantLine))
+
     def getFilteredLine(self, line, lineNumber, lineFilters):
         appliedLineFilter = None
         filteredLine = line
@@ -302,18 +473,22 @@ class UnorderedTextFilter(RunDependentTextFilter):
     def filterFile(self, file, newFile):
         unorderedLines = {}
         RunDependentTextFilter.filterFile(self, file, newFile, unorderedLines)
-        self.writeUnorderedText(newFile, unorderedLines)
+        newFile.writelines(self.getUnorderedText(unorderedLines))
+
+    def filterLines(self, lines, sourceFile=None):
+        unorderedLines = {}
+        yield from RunDependentTextFilter.filterLines(self, lines, sourceFile, unorderedLines)
+        yield from self.getUnorderedText(unorderedLines)
 
-    def writeUnorderedText(self, newFile, lines):
+    def getUnorderedText(self, lines):
         for filter in self.lineFilters:
             unordered = lines.get(filter, [])
             if len(unordered) == 0:
                 continue
             unordered.sort()
-            newFile.write("-- Unordered text as found by filter '" + filter.originalText + "' --" + "\n")
-            for line in unordered:
-                newFile.write(line)
-            newFile.write("\n")
+            yield "-- Unordered text as found by filter '" + filter.originalText + "' --" + "\n"
+            yield from unordered
+            yield "\n"
 
 
 class LineNumberTrigger:
@@ -352,6 +527,57 @@ class MatchNumberTrigger(plugins.TextTrigger):
         self.matchCounter = 0
 
 
+class TriggerDispatcher:
+    """ Combines the text triggers of many line filters into a single regular expression,
+    so that lines none of them could match can be passed on with one search """
+    def __init__(self, lineFilters):
+        self.diag = logging.getLogger("Run Dependent Text")
+        self.lineNumbers = set()
+        self.separateRegexes = []
+        self.alwaysMatch = False
+        patterns = []
+        for lineFilter in lineFilters:
+            trigger = lineFilter.trigger
+            if isinstance(trigger, LineNumberTrigger):
+                self.lineNumbers.add(trigger.lineNumber)
+            elif isinstance(trigger, plugins.TextTrigger) and trigger.matchEmptyString:
+                if trigger.regex is None:
+                    patterns.append(re.escape(trigger.text))
+                elif self.canCombine(trigger.regex.pattern):
+                    patterns.append(trigger.regex.pattern)
+                else:
+                    self.separateRegexes.append(trigger.regex)
+            else:
+                self.alwaysMatch = True
+        self.combinedRegex = self.makeCombinedRegex(patterns)
+        self.diag.info("Combined " + str(len(patterns)) + " triggers, " +
+                       str(len(self.separateRegexes)) + " regular expressions to search separately")
+
+    def canCombine(self, pattern):
+        # Group references and global flags stop working if the pattern is embedded in a larger one
+        if re.search(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)", pattern):
+            return False
+        try:
+            re.compile("(?:" + pattern + ")|x")
+            return True
+        except re.error:
+            return False
+
+    def makeCombinedRegex(self, patterns):
+        if patterns:
+            try:
+                return re.compile("|".join("(?:" + pattern + ")" for pattern in patterns))
+            except re.error:  # e.g. the same group name used in two patterns
+                self.separateRegexes += [re.compile(pattern) for pattern in patterns]
+
+    def mightMatch(self, line, lineNumber):
+        if self.alwaysMatch or lineNumber in self.lineNumbers:
+            return True
+        if self.combinedRegex is not None and self.combinedRegex.search(line):
+            return True
+        return len(self.separateRegexes) > 0 and any(regex.search(line) for regex in self.separateRegexes)
+
+
 def getWriteDirRegexp(testId):
     testId = testId.replace("\\", "/")
     for char in "+^":
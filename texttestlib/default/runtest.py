@@ -9,7 +9,7 @@ import signal
 import shlex
 from texttestlib import plugins
 from texttestlib.jobprocess import killProcessAndChildren
-from time import sleep
+from time import sleep, perf_counter
 from threading import Lock, Timer
 from locale import getpreferredencoding
 
@@ -96,11 +96,14 @@ class RunTest(plugins.Action):
         self.describe(test)
         machine = test.app.getRunMachine()
         killTimeout = test.getConfigValue("kill_timeout")
+        measureUsage = self.measuresResourceUsage(test)
+        usages = []
         for postfix in self.getTestRunPostfixes(test):
             if postfix:
                 # Checks for support processes like virtual displays, restarts if needed
                 test.notify("TestProcessComplete")
 
+            startTime = perf_counter()
             process = self.getTestProcess(test, machine, postfix)
             self.registerProcess(test, process)
             if not postfix:
@@ -109,15 +112,20 @@ class RunTest(plugins.Action):
 
             if killTimeout and not test.app.isRecording() and not test.app.isActionReplay():
                 self.runMultiTimer(killTimeout, self.kill, (test, "timeout"))
-                self.wait(process)
+                usage = self.wait(process, measureUsage)
                 self.currentTimer.cancel()
                 self.currentTimer = None
             else:
-                self.wait(process)
+                usage = self.wait(process, measureUsage)
+            if usage is not None:
+                usages.append((perf_counter() - startTime, usage))
             self.checkAndClear(test, postfix)
             if self.killSignal is not None:
                 break  # Don't start other processes
 
+        if usages and test not in self.killedTests:
+            self.storeResourceUsage(test, usages)
+
     def getTestRunPostfixes(self, test):
         postfixes = [""]
         for postfix in test.getConfigValue("extra_test_process_postfix"):
@@ -132,6 +140,31 @@ class RunTest(plugins.Action):
             self.killProcess(test)
         self.lock.release()
 
+    def canMeasureResourceUsage(self, test):
+        return hasattr(os, "wait4") and test.app.getRunMachine() == "localhost"
+
+    def checksCpuTime(self, test):
+        return test.app.hasAutomaticCputimeChecking() and test.app.executingOnPerformanceMachine(test)
+
+    def measuresResourceUsage(self, test):
+        return self.canMeasureResourceUsage(test) and \
+            (self.checksCpuTime(test) or len(test.getConfigValue("performance_resource_usage")) > 0)
+
+    def storeResourceUsage(self, test, usages):
+        # Same format as 'time -p', which we still use when running elsewhere
+        maxrss = max(usage.ru_maxrss for _, usage in usages)
+        if sys.platform == "darwin":
+            maxrss //= 1024  # bytes here, kilobytes elsewhere
+        values = [("real", "%.2f" % sum(realTime for realTime, _ in usages)),
+                  ("user", "%.2f" % sum(usage.ru_utime for _, usage in usages)),
+                  ("sys", "%.2f" % sum(usage.ru_stime for _, usage in usages)),
+                  ("maxrss", str(maxrss))]
+        for field in ["inblock", "oublock", "nvcsw", "nivcsw"]:
+            values.append((field, str(sum(getattr(usage, "ru_" + field) for _, usage in usages))))
+        with open(test.makeTmpFileName("unixperf", forFramework=1), "w") as f:
+            for name, value in values:
+                f.write(name + " " + value + "\n")
+
     def storeReturnCode(self, test, code, postfix):
         file = open(test.makeTmpFileName("exitcode" + postfix), "w")
         file.write(str(code) + "\n")
@@ -213,7 +246,15 @@ class RunTest(plugins.Action):
         remoteScript = os.path.join(tmpDir, "kill_test.sh")
         test.app.runCommandOn(machine, ["sh", plugins.quote(remoteScript)])
 
-    def wait(self, process):
+    def wait(self, process, measureUsage=False):
+        if measureUsage:
+            try:
+                # As 'time' does, so it covers the process and everything it waited for
+                _, status, usage = plugins.retryOnInterrupt(os.wait4, process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                return usage
+            except ChildProcessError:
+                pass  # Already collected elsewhere, while killing it
         try:
             plugins.retryOnInterrupt(process.wait)
         except OSError:  # pragma: no cover - workaround for Python bugs only
@@ -386,7 +427,7 @@ class RunTest(plugins.Action):
 
     def getLocalExecuteCmdArgs(self, test, postfix="", makeDirs=True, forLinux=False):
         args = []
-        if test.app.hasAutomaticCputimeChecking() and test.app.executingOnPerformanceMachine(test):
+        if self.checksCpuTime(test) and not self.canMeasureResourceUsage(test):
             args += self.getTimingArgs(test, makeDirs)
 
         # Don't expand environment if we're running on a different file system
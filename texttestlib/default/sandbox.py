@@ -4,6 +4,7 @@ import re
 import stat
 import subprocess
 import glob
+import fnmatch
 import logging
 import difflib
 import time
@@ -13,6 +14,8 @@ from texttestlib.jobprocess import killProcessAndChildren
 from .runtest import Killed
 from collections import OrderedDict
 from string import Template
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 
 def getScriptArgs(script):
@@ -622,13 +625,123 @@ class TestEnvironmentCreator:
         return pathVars
 
 
+class DirectorySnapshot:
+    """ The contents of a test's sandbox, each directory read with os.scandir the first time it's needed and then kept.
+    Matches glob patterns against that, as glob.glob would from inside the directory, without changing directory """
+    def __init__(self):
+        self.listings = {}
+        self.updatedStats = {}
+        self.nameMatches = {}
+
+    def getEntries(self, dir):
+        if dir not in self.listings:
+            try:
+                with os.scandir(dir) as entries:
+                    self.listings[dir] = dict((entry.name, entry) for entry in entries)
+            except OSError:
+                self.listings[dir] = {}
+        return self.listings[dir]
+
+    def update(self, path):
+        """ Take account of a file we have written or removed ourselves since reading its directory """
+        dir, name = os.path.split(path)
+        entries = self.getEntries(dir)
+        self.nameMatches.pop(dir, None)
+        if os.path.lexists(path):
+            entries[name] = None
+            self.updatedStats[path] = self.readStat(path)
+        else:
+            entries.pop(name, None)
+            self.updatedStats.pop(path, None)
+
+    def readStat(self, path, entry=None):
+        try:
+            return entry.stat() if entry is not None else os.stat(path)
+        except OSError:
+            # Dead links etc.
+            return None
+
+    def getStat(self, path):
+        if path in self.updatedStats:
+            return self.updatedStats[path]
+        dir, name = os.path.split(path)
+        # Not listed might still mean a case-insensitive file system, or "..", so ask it directly
+        return self.readStat(path, self.getEntries(dir).get(name))
+
+    def exists(self, path):
+        # As for glob, links count even if they're dead
+        dir, name = os.path.split(path)
+        return name in self.getEntries(dir) or os.path.lexists(path)
+
+    def modifiedTime(self, path):
+        statInfo = self.getStat(path)
+        if statInfo is not None:
+            return statInfo[stat.ST_MTIME]
+
+    def isFile(self, path):
+        statInfo = self.getStat(path)
+        return statInfo is not None and stat.S_ISREG(statInfo.st_mode)
+
+    def isDir(self, path):
+        statInfo = self.getStat(path)
+        return statInfo is not None and stat.S_ISDIR(statInfo.st_mode)
+
+    def glob(self, dir, pattern):
+        return [os.path.join(dir, path) for path in self.findMatches(dir, pattern)]
+
+    def findMatches(self, dir, pattern, dirsOnly=False):
+        dirname, basename = os.path.split(pattern)
+        if dirname and dirname != pattern and glob.has_magic(dirname):
+            parents = self.findMatches(dir, dirname, dirsOnly=True)
+        else:
+            parents = [dirname]
+        matches = []
+        for parent in parents:
+            if glob.has_magic(basename):
+                names = self.matchNames(os.path.join(dir, parent), basename, dirsOnly)
+            elif basename:
+                names = [basename] if self.exists(os.path.join(dir, parent, basename)) else []
+            else:
+                # Pattern ends in a separator, so only matches directories
+                names = [basename] if self.isDir(os.path.join(dir, parent)) else []
+            matches += [os.path.join(parent, name) for name in names]
+        return matches
+
+    def matchNames(self, dir, pattern, dirsOnly):
+        dirMatches = self.nameMatches.setdefault(dir, {})
+        key = pattern, dirsOnly
+        if key not in dirMatches:
+            dirMatches[key] = self.findMatchingNames(dir, pattern, dirsOnly)
+        return dirMatches[key]
+
+    def findMatchingNames(self, dir, pattern, dirsOnly):
+        names = []
+        for name, entry in self.getEntries(dir).items():
+            # Like glob, hidden files only match patterns that start with a dot
+            if name.startswith(".") and not pattern.startswith("."):
+                continue
+            if dirsOnly and not self.entryIsDir(entry, os.path.join(dir, name)):
+                continue
+            names.append(name)
+        return fnmatch.filter(names, pattern)
+
+    def entryIsDir(self, entry, path):
+        if entry is None:
+            return self.isDir(path)
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+
 class CollateFiles(plugins.Action):
     def __init__(self):
         self.filesPresentBefore = {}
-        self.collationProc = None
+        self.collationProcs = []
+        self.collationLock = Lock()
         self.diag = logging.getLogger("Collate Files")
 
-    def expandCollations(self, test):
+    def expandCollations(self, test, snapshot):
         newColl = OrderedDict()
         coll = test.getConfigValue("collate_file")
         self.diag.info("coll initial:" + str(coll))
@@ -640,7 +753,7 @@ class CollateFiles(plugins.Action):
 
             # add each file to newColl by transferring wildcards across
             for sourcePattern in sourcePatterns:
-                testDir, sourcePaths = self.findPaths(test, sourcePattern)
+                testDir, sourcePaths = self.findPaths(test, sourcePattern, snapshot)
                 for sourcePath in sourcePaths:
                     # Use relative paths: easier to debug and SequenceMatcher breaks down if strings are longer than 200 chars
                     relativeSourcePath = plugins.relpath(sourcePath, testDir)
@@ -691,11 +804,12 @@ class CollateFiles(plugins.Action):
 
     def __call__(self, test):
         if test not in self.filesPresentBefore:
-            self.filesPresentBefore[test] = self.getFilesPresent(test)
+            self.filesPresentBefore[test] = self.getFilesPresent(test, DirectorySnapshot())
         else:
             self.tryFetchRemoteFiles(test)
-            self.collate(test)
-            self.removeUnwanted(test)
+            snapshot = DirectorySnapshot()
+            self.collate(test, snapshot)
+            self.removeUnwanted(test, snapshot)
 
     def containsRegexps(self, filePath, regexps):
         with open(filePath) as f:
@@ -704,18 +818,19 @@ class CollateFiles(plugins.Action):
                     return True
         return False
 
-    def removeUnwantedFile(self, filePath):
+    def removeUnwantedFile(self, filePath, snapshot):
         self.diag.info("Trying to remove generated file " + os.path.basename(filePath))
         try:
             # Checking for existence too dependent on file server (?)
             os.remove(filePath)
         except EnvironmentError:
             pass
+        snapshot.update(filePath)
 
-    def removeUnwanted(self, test):
+    def removeUnwanted(self, test, snapshot):
         for stem in test.getConfigValue("discard_file"):
             filePath = test.makeTmpFileName(stem)
-            self.removeUnwantedFile(filePath)
+            self.removeUnwantedFile(filePath, snapshot)
 
         for stemPattern, texts in list(test.getConfigValue("discard_file_text").items()):
             if not texts:
@@ -723,28 +838,54 @@ class CollateFiles(plugins.Action):
             if stemPattern == "default":
                 stemPattern = "*"
             regexps = list(map(re.compile, texts))
-            for filePath in glob.glob(test.makeTmpFileName(stemPattern)):
+            writeDir = test.getDirectory(temporary=1)
+            pattern = plugins.relpath(test.makeTmpFileName(stemPattern), writeDir, normalise=False)
+            for filePath in snapshot.glob(writeDir, pattern):
                 if self.containsRegexps(filePath, regexps):
-                    self.removeUnwantedFile(filePath)
+                    self.removeUnwantedFile(filePath, snapshot)
 
-    def findEditedFiles(self, test, patterns):
+    def findEditedFiles(self, test, patterns, snapshot):
         editedFiles = []
         for pattern in patterns:
-            for fullpath in self.findPaths(test, pattern)[1]:
-                if self.testEdited(test, fullpath):
+            for fullpath in self.findPaths(test, pattern, snapshot)[1]:
+                if self.testEdited(test, fullpath, snapshot):
                     editedFiles.append(fullpath)
                 else:
                     self.diag.info("Found " + fullpath + " but it wasn't edited")
         return editedFiles
 
-    def collate(self, test):
-        for targetStem, sourcePatterns in self.expandCollations(test):
-            sourceFiles = self.findEditedFiles(test, sourcePatterns)
+    def collate(self, test, snapshot):
+        pool = self.makeCollationPool(test)
+        futures = []
+        for targetStem, sourcePatterns in self.expandCollations(test, snapshot):
+            sourceFiles = self.findEditedFiles(test, sourcePatterns, snapshot)
             if sourceFiles:
                 targetFile = test.makeTmpFileName(targetStem)
                 collationErrFile = test.makeTmpFileName(targetStem + ".collate_errs", forFramework=1)
                 self.diag.info("Extracting " + ",".join(sourceFiles) + " to " + targetFile)
-                self.extract(test, sourceFiles, targetFile, collationErrFile)
+                if pool is None:
+                    self.extract(test, sourceFiles, targetFile, collationErrFile)
+                else:
+                    scripts = self.getCollateScripts(test, sourceFiles, targetFile)
+                    if scripts:
+                        future = pool.submit(self.runCollationScripts, test, scripts, sourceFiles, targetFile, collationErrFile)
+                        futures.append((scripts, sourceFiles, targetFile, collationErrFile, future))
+                        continue
+                # Later collations, and discarding files, should see what we've written
+                snapshot.update(targetFile)
+
+        # Report in the same order as when running them one at a time
+        for scripts, sourceFiles, targetFile, collationErrFile, future in futures:
+            self.checkCollation(test, scripts, sourceFiles, targetFile, collationErrFile, *future.result())
+            snapshot.update(targetFile)
+        if pool is not None:
+            pool.shutdown()
+
+    def makeCollationPool(self, test):
+        processCount = test.getConfigValue("collate_script_processes")
+        if processCount > 1:
+            # Threads are enough, they only wait for the collate_script processes
+            return ThreadPoolExecutor(max_workers=processCount, thread_name_prefix="CollateScripts")
 
     def tryFetchRemoteFiles(self, test):
         machine, remoteTmpDir = test.app.getRemoteTestTmpDir(test)
@@ -755,20 +896,20 @@ class CollateFiles(plugins.Action):
         sourcePaths = os.path.join(plugins.quote(tmpDir), "*")
         test.app.copyFileRemotely(sourcePaths, machine, test.getDirectory(temporary=1), "localhost")
 
-    def getFilesPresent(self, test):
+    def getFilesPresent(self, test, snapshot):
         files = OrderedDict()
         for sourcePatterns in list(test.getConfigValue("collate_file").values()):
             for sourcePattern in sourcePatterns:
-                for fullPath in self.findPaths(test, sourcePattern)[1]:
+                for fullPath in self.findPaths(test, sourcePattern, snapshot)[1]:
                     self.diag.info("Pre-existing file found " + fullPath)
-                    files[fullPath] = plugins.modifiedTime(fullPath)
+                    files[fullPath] = snapshot.modifiedTime(fullPath)
         return files
 
-    def testEdited(self, test, fullPath):
+    def testEdited(self, test, fullPath, snapshot):
         filesBefore = self.filesPresentBefore[test]
         if fullPath not in filesBefore:
             return True
-        return filesBefore[fullPath] != plugins.modifiedTime(fullPath)
+        return filesBefore[fullPath] != snapshot.modifiedTime(fullPath)
 
     def alreadyCollated(self, test, path, sourcePattern):
         if "/" not in sourcePattern:
@@ -777,31 +918,24 @@ class CollateFiles(plugins.Action):
                 return True  # Don't collate generated files
         return False
 
-    def glob(self, test, sourcePattern):
+    def glob(self, test, sourcePattern, snapshot):
         # Test name may contain glob meta-characters, and there is no way to quote them (see comment in fnmatch.py)
-        # So we can't just form an absolute path and glob that
+        # So we match only the pattern, relative to the test directory
         localTestDir = test.getDirectory(temporary=1, local=1)
-        localFiles = self.globDir(localTestDir, sourcePattern)
+        localFiles = snapshot.glob(localTestDir, sourcePattern)
         if not localFiles:
             logDir = test.getDirectory(temporary=1)
             if logDir != localTestDir:
-                logDirFiles = self.globDir(logDir, sourcePattern)
+                logDirFiles = snapshot.glob(logDir, sourcePattern)
                 if logDirFiles:
                     return logDir, logDirFiles
         return localTestDir, localFiles
 
-    def globDir(self, testDir, sourcePattern):
-        origCwd = os.getcwd()
-        os.chdir(testDir)
-        result = glob.glob(sourcePattern)
-        os.chdir(origCwd)
-        return [os.path.join(testDir, f) for f in result]
-
-    def findPaths(self, test, sourcePattern):
+    def findPaths(self, test, sourcePattern, snapshot):
         self.diag.info("Looking for pattern " + sourcePattern + " for " + repr(test))
-        testDir, paths = self.glob(test, sourcePattern)
+        testDir, paths = self.glob(test, sourcePattern, snapshot)
         paths.sort()
-        existingPaths = list(filter(os.path.isfile, paths))
+        existingPaths = list(filter(snapshot.isFile, paths))
         if sourcePattern == "*":  # interpret this specially to mean 'all files which are not collated already'
             return testDir, [f for f in existingPaths if not self.alreadyCollated(test, f, sourcePattern)]
         else:
@@ -828,28 +962,39 @@ class CollateFiles(plugins.Action):
                 stderr.close()
 
     def kill(self, test, sig):
-        if self.collationProc:
-            proc = self.collationProc
-            self.collationProc = None
-            killProcessAndChildren(proc, cmd=test.getConfigValue("kill_command"))
+        with self.collationLock:
+            procs = self.collationProcs
+            self.collationProcs = []
+        # Latest first, so the end of each pipeline goes before what feeds it
+        for proc in reversed(procs):
+            killProcessAndChildren(proc.pid, cmd=test.getConfigValue("kill_command"))
 
     def extract(self, test, sourceFiles, targetFile, collationErrFile):
+        scripts = self.getCollateScripts(test, sourceFiles, targetFile)
+        if scripts:
+            missingMsg, killedScript = self.runCollationScripts(test, scripts, sourceFiles, targetFile, collationErrFile)
+            self.checkCollation(test, scripts, sourceFiles, targetFile, collationErrFile, missingMsg, killedScript)
+
+    def getCollateScripts(self, test, sourceFiles, targetFile):
         stem = os.path.splitext(os.path.basename(targetFile))[0]
         scripts = test.getCompositeConfigValue("collate_script", stem)
-        sourceFilesStr = ",".join(sourceFiles)
         if len(scripts) == 0:
             if len(sourceFiles) > 1:
                 msg = "Multiple files are found for '" + stem + "' in " + \
                     repr(test) + ", but no collate_script is defined.\n"
                 sys.stderr.write(msg)
-            return shutil.copyfile(sourceFiles[0], targetFile)
+            shutil.copyfile(sourceFiles[0], targetFile)
+        return scripts
 
-        self.collationProc = None
+    def runCollationScripts(self, test, scripts, sourceFiles, targetFile, collationErrFile):
+        """ Returns the error if a script could not be started, and the script that was killed, if any """
+        sourceFilesStr = ",".join(sourceFiles)
+        procs = []
         stdin = None
         for script in scripts:
             args = script.split()
-            if self.collationProc:
-                stdin = self.collationProc.stdout
+            if procs:
+                stdin = procs[-1].stdout
             else:
                 args += sourceFiles
             self.diag.info("Opening extract process with args " + repr(args))
@@ -860,31 +1005,47 @@ class CollateFiles(plugins.Action):
                 stdout = subprocess.PIPE
                 stderr = subprocess.STDOUT
 
-            self.collationProc = self.runCollationScript(args, test, stdin, stdout, stderr)
-            if not self.collationProc:
+            # Register it straight away, so kill can find it
+            with self.collationLock:
+                proc = self.runCollationScript(args, test, stdin, stdout, stderr)
+                if proc:
+                    self.collationProcs.append(proc)
+            if not proc:
+                self.forgetCollationProcs(procs)
                 if os.path.isfile(targetFile):
                     os.remove(targetFile)
                 errorMsg = "Could not find extract script '" + script + \
                     "', not extracting file(s) at\n" + sourceFilesStr + "\n"
                 stderr = open(collationErrFile, "w")
                 stderr.write(errorMsg)
-                plugins.printWarning(errorMsg.strip())
                 stderr.close()
-                return
-
-        if self.collationProc:
-            self.diag.info("Waiting for collation process to terminate...")
-            self.collationProc.wait()
-            if self.collationProc:
-                self.collationProc = None
-            else:
-                procName = args[0]
-                briefText = "KILLED (" + os.path.basename(procName) + ")"
-                freeText = "Killed collation script '" + procName + \
-                    "'\n while collating file(s) at " + sourceFilesStr + "\n"
-                test.changeState(Killed(briefText, freeText, test.state))
-            stdout.close()
-            stderr.close()
+                return errorMsg, None
+            procs.append(proc)
+
+        self.diag.info("Waiting for collation process to terminate...")
+        proc.wait()
+        stdout.close()
+        stderr.close()
+        killed = self.forgetCollationProcs(procs)
+        return None, (args[0] if killed else None)
+
+    def forgetCollationProcs(self, procs):
+        """ Returns True if kill got to them first """
+        with self.collationLock:
+            killed = len(procs) > 0 and procs[-1] not in self.collationProcs
+            self.collationProcs = [proc for proc in self.collationProcs if proc not in procs]
+        return killed
+
+    def checkCollation(self, test, scripts, sourceFiles, targetFile, collationErrFile, missingMsg, killedScript):
+        if missingMsg:
+            plugins.printWarning(missingMsg.strip())
+            return
+        sourceFilesStr = ",".join(sourceFiles)
+        if killedScript:
+            briefText = "KILLED (" + os.path.basename(killedScript) + ")"
+            freeText = "Killed collation script '" + killedScript + \
+                "'\n while collating file(s) at " + sourceFilesStr + "\n"
+            test.changeState(Killed(briefText, freeText, test.state))
 
         if len(sourceFiles) > 0 and any((os.path.getsize(fn) > 0 for fn in sourceFiles)) and os.path.getsize(targetFile) == 0 and os.path.getsize(collationErrFile) == 0:
             # Collation scripts that don't write anything shouldn't produce empty files...
@@ -1080,30 +1241,34 @@ class UNIXPerformanceInfoFinder:
         self.diag = diag
         self.includeSystemTime = 0
 
-    def findTimesUsedBy(self, test):
-        # Read the UNIX performance file, allowing us to discount system time.
+    def findResourceUsage(self, test):
+        # Written by 'time -p', or in the same format by RunTest when it measured the test process itself
         tmpFile = test.makeTmpFileName("unixperf", forFramework=1)
         self.diag.info("Reading performance file " + tmpFile)
+        usage = {}
         if not os.path.isfile(tmpFile):
-            return None, None
+            return usage
+
+        with open(tmpFile) as f:
+            for line in f:
+                self.diag.info("Parsing line " + line.strip())
+                words = line.strip().split()
+                if len(words) > 1:
+                    try:
+                        usage[words[0].lower()] = float(words[-1])
+                    except ValueError:
+                        pass  # Not a measurement
+        return usage
 
-        file = open(tmpFile)
-        cpuTime = None
-        realTime = None
-        for line in file.readlines():
-            self.diag.info("Parsing line " + line.strip())
-            if line.startswith("user") or line.startswith("User"):
-                cpuTime = self.parseUnixTime(line)
-            if self.includeSystemTime and (line.startswith("sys") or line.startswith("Sys")):
-                cpuTime = cpuTime + self.parseUnixTime(line)
-            if line.startswith("real") or line.startswith("Real"):
-                realTime = self.parseUnixTime(line)
-        return cpuTime, realTime
-
-    def parseUnixTime(self, line):
-        # Assumes output of GNU time
-        words = line.strip().split()
-        return float(words[-1])
+    def findTimesUsedBy(self, test):
+        return self.getTimesUsed(self.findResourceUsage(test))
+
+    def getTimesUsed(self, usage):
+        # Allowing us to discount system time.
+        cpuTime = usage.get("user")
+        if self.includeSystemTime and cpuTime is not None:
+            cpuTime += usage.get("sys", 0.0)
+        return cpuTime, usage.get("real")
 
     def setUpApplication(self, app):
         self.includeSystemTime = app.getConfigValue("cputime_include_system_time")
@@ -1113,6 +1278,10 @@ class UNIXPerformanceInfoFinder:
 
 
 class MakePerformanceFile(PerformanceFileCreator):
+    resourceMeasures = {"maxrss": (["maxrss"], "MB"),
+                        "blockio": (["inblock", "oublock"], "blocks"),
+                        "contextswitches": (["nvcsw", "nivcsw"], "switches")}
+
     def __init__(self, machineInfoFinder):
         PerformanceFileCreator.__init__(self, machineInfoFinder)
         self.systemPerfInfoFinder = UNIXPerformanceInfoFinder(self.diag)
@@ -1120,15 +1289,29 @@ class MakePerformanceFile(PerformanceFileCreator):
     def setUpApplication(self, app):
         PerformanceFileCreator.setUpApplication(self, app)
         self.systemPerfInfoFinder.setUpApplication(app)
+        for stem, measure in list(app.getConfigValue("performance_resource_usage").items()):
+            if measure not in self.resourceMeasures:
+                plugins.printWarning("Not writing performance file for " + stem + ": unknown resource usage '" + measure +
+                                     "', expected one of " + ", ".join(sorted(self.resourceMeasures)))
 
     def makePerformanceFiles(self, test):
-        cpuTime, realTime = self.systemPerfInfoFinder.findTimesUsedBy(test)
+        usage = self.systemPerfInfoFinder.findResourceUsage(test)
+        cpuTime, realTime = self.systemPerfInfoFinder.getTimesUsed(usage)
         # There was still an error (jobs killed in emergency), so don't write performance files
         if cpuTime is None:
             return
 
-        fileToWrite = test.makeTmpFileName("performance")
-        self.writeFile(test, cpuTime, realTime, fileToWrite)
+        # We may have measured the test process only for the sake of the entries below
+        if test.app.hasAutomaticCputimeChecking() and self.allMachinesTestPerformance(test, "cputime"):
+            fileToWrite = test.makeTmpFileName("performance")
+            self.writeFile(test, cpuTime, realTime, fileToWrite)
+        for stem, measure in list(test.getConfigValue("performance_resource_usage").items()):
+            if measure not in self.resourceMeasures:
+                continue
+            if self.allMachinesTestPerformance(test, stem):
+                self.writeResourceFile(test, stem, measure, usage)
+            else:
+                self.diag.info("Not writing performance file for " + stem + ": not on performance machines")
 
     def timeString(self, timeVal):
         return str(round(float(timeVal), 1)).rjust(9)
@@ -1142,6 +1325,22 @@ class MakePerformanceFile(PerformanceFileCreator):
             file.write(realLine)
         file.write(self.machineInfoFinder.getMachineInformation(test))
 
+    def writeResourceFile(self, test, stem, measure, usage):
+        fields, unit = self.resourceMeasures[measure]
+        if not all((field in usage for field in fields)):
+            return  # Measured by 'time', which doesn't tell us this
+
+        value = sum((usage[field] for field in fields))
+        if measure == "maxrss":
+            # From kilobytes, rounded to accuracy 0.01 as for memory found in log files
+            line = "Max " + stem.capitalize() + "  :      " + str(float(int(100 * value / 1024)) / 100)
+        else:
+            line = "Total " + stem.capitalize() + "  :      " + str(int(value))
+        fileName = test.makeTmpFileName(stem)
+        self.diag.info("Writing " + measure + " to file " + fileName)
+        with open(fileName, "w") as f:
+            f.write(line + " " + unit + "\n")
+
 # Relies on the config entry performance_logfile_extractor, so looks in the log file for anything reported
 # by the program
 
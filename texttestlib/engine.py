@@ -115,7 +115,12 @@ class Activator(plugins.Responder, plugins.Observable):
 
         filters = suite.app.getFilterList(self.suites)
         self.diag.info("Creating test suite with filters " + repr(filters))
-        return suite.readContents(filters)
+        if suite.app.startTestTreePrefetcher():
+            self.diag.info("Reading test directories in parallel")
+        try:
+            return suite.readContents(filters)
+        finally:
+            suite.app.stopTestTreePrefetcher()
 
     def run(self):
         goodSuites = []
@@ -134,6 +139,7 @@ class Activator(plugins.Responder, plugins.Observable):
             except plugins.TextTestError as e:
                 rejectionInfo[suite.app] = str(e)
 
+        self.saveTestTreeIndices()
         self.notify("AllRead", goodSuites)
 
         if len(rejectionInfo) > 0:
@@ -142,6 +148,14 @@ class Activator(plugins.Responder, plugins.Observable):
         self.performNotify("AllReadAndNotified")
         return goodSuites
 
+    def saveTestTreeIndices(self):
+        savedIndices = []
+        for suite in self.suites:
+            index = suite.app.testTreeIndex
+            if index and index not in savedIndices:
+                index.save()
+                savedIndices.append(index)
+
     def writeErrors(self, rejectionInfo):
         # Don't write errors if only some of a group are rejected
         appsByName = OrderedDict()
@@ -341,11 +355,13 @@ class TextTest(plugins.Responder, plugins.Observable):
     def createTestSuites(self, allApps):
         appSuites = OrderedDict()
         raisedError = False
+        testTreeIndices = {}
         for app in allApps:
             warningMessages = []
             appGroup = [app] + app.extras
             for partApp in appGroup:
                 try:
+                    partApp.setUpTestTreeIndex(testTreeIndices)
                     testSuite = self.createInitialTestSuite(partApp)
                     appSuites[partApp] = testSuite
                 except plugins.TextTestWarning as e:
@@ -383,6 +399,7 @@ class TextTest(plugins.Responder, plugins.Observable):
     def run(self):
         try:
             self._run()
+            self.diag.info(testmodel.Test.getConfigCacheStatistics())
             self.diag.info("Exiting with exit code " + str(self.exitCode))
             sys.exit(self.exitCode)
         except plugins.TextTestError as e:
@@ -10,9 +10,9 @@ def killProcessAndChildren(pid, sig=None, cmd=None, timeout=5):
     assert pid != os.getpid(), "won't kill myself"
     try:
         parent = psutil.Process(pid)
+        children = parent.children(recursive=True) + [parent]
     except psutil.NoSuchProcess:
         return False
-    children = parent.children(recursive=True) + [parent]
     for p in children:
         try:
             p.send_signal(signal.SIGTERM if sig is None else sig)
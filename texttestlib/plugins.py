@@ -12,6 +12,7 @@ import shlex
 import fnmatch
 import subprocess
 from collections import OrderedDict, deque
+from itertools import islice
 from traceback import format_exception
 from threading import currentThread, RLock
 from queue import Queue, Empty
@@ -566,6 +567,8 @@ def addCategory(name, briefDesc, longDesc=""):
 
 
 class ThreadedNotificationHandler:
+    maxBatchTime = 0.05  # seconds
+
     def __init__(self):
         self.workQueue = Queue()
         self.mutex = RLock()
@@ -591,16 +594,23 @@ class ThreadedNotificationHandler:
             self.idleHandler = None
 
     def pollQueue(self):
+        # Handle whatever has built up, for a while at least, rather than one notification per idle call.
+        # The GUI then redraws once for lots of changes, rather than after each one.
+        endTime = time.perf_counter() + self.maxBatchTime
         with self.mutex:
-            try:
-                observable, args, kwargs = self.workQueue.get_nowait()
+            while True:
+                try:
+                    observable, args, kwargs = self.workQueue.get_nowait()
+                except Empty:
+                    self.source = None
+                    return False
                 if len(self.allowedEvents) == 0 or args[0] in self.allowedEvents:
                     observable.diagnoseObs("From work queue", *args, **kwargs)
                     observable.performNotify(*args, **kwargs)
-            except Empty:
-                self.source = None
-                return False
-            return True
+                if self.source is None:  # polling was disabled while handling it
+                    return False
+                if time.perf_counter() >= endTime:
+                    return True
 
     def transfer(self, observable, *args, **kwargs):
         with self.mutex:
@@ -874,7 +884,16 @@ class MarkedTestState(TestState):
 
 
 class TestStateUnpickler(Unpickler):
+    classCache = {}
+
     def find_class(self, modName, className):
+        # Loading many states, e.g. a whole batch repository, would otherwise import each class for every file
+        key = modName, className
+        if key not in self.classCache:
+            self.classCache[key] = self.importClass(modName, className)
+        return self.classCache[key]
+
+    def importClass(self, modName, className):
         try:
             namespace = {}
             exec("from " + modName + " import " + className + " as _class", globals(), namespace)
@@ -882,7 +901,7 @@ class TestStateUnpickler(Unpickler):
         except ImportError as e:
             if not modName.startswith("texttestlib"):
                 try:
-                    return self.find_class("texttestlib." + modName, className)
+                    return self.importClass("texttestlib." + modName, className)
                 except:
                     raise e
             else:
@@ -899,7 +918,7 @@ def getNewTestStateFromFile(file):
         file.seek(0)
         unpickler = TestStateUnpickler(BytesIO(file.read().replace(b"\r\n", b"\n")), encoding=encoding, errors="replace")
         return unpickler.load()
-    
+
 
 log = None
 
@@ -1354,6 +1373,10 @@ class PreviewGenerator:
         file.close()
         return lines
 
+    def getPreviewFromIterable(self, iterable):
+        # Anything after the lines we show is never generated
+        return self.getPreviewFromLines(list(islice(iterable, self.maxLength)))
+
     def getPreviewFromLines(self, lines):
         cutLines = self.getCutLines(lines)
         lines = list(map(self.getWrappedLine, cutLines))
@@ -1812,6 +1835,18 @@ class MultiEntryDictionary(OrderedDict):
         else:
             return value
 
+    @classmethod
+    def copyValue(cls, value):
+        if isinstance(value, list):
+            return list(value)
+        elif isinstance(value, dict):
+            newDict = value.__class__()
+            for key, val in value.items():
+                newDict[key] = cls.copyValue(val)
+            return newDict
+        else:
+            return value
+
 
 class Option:
     def __init__(self, name, value, description, changeMethod):
@@ -382,6 +382,14 @@ class QueueSystemConfig(default.Config):
                              "Maximum possible number of parallel tests to run")
         app.setConfigDefault("queue_system_max_reruns", {
                              "default": self.defaultMaxReruns}, "Maximum number of times to rerun tests due to known bugs")
+        app.setConfigDefault("queue_system_test_order", "tree",
+                             "Order to submit tests in: \"tree\" for test suite order, or \"longest_first\" to start the tests expected to take longest first")
+        app.setConfigDefault("queue_system_fork_slaves", 0,
+                             "(local) Fork slaves from a copy of the master process made before it starts running, which has already read the configuration, instead of starting new TextTest processes")
+        app.setConfigDefault("queue_system_persistent_connections", 1,
+                             "Slaves send all their messages to the master over one connection, rather than a new one each time")
+        app.setConfigDefault("queue_system_lsf_polling", 0,
+                             "(LSF) Poll job status with 'bjobs -json', to notice jobs that die without reporting back. Needs a version of LSF that supports it")
         app.setConfigDefault("queue_system_min_test_count", 0,
                              "Minimum number of tests before it's worth submitting them to the grid")
         app.setConfigDefault("queue_system_resource", [],
@@ -396,6 +404,8 @@ class QueueSystemConfig(default.Config):
                              "Executable to run as a proxy for the real test program")
         app.setConfigDefault("queue_system_proxy_resource", [],
                              "Grid engine resources required to locate machine to run proxy process")
+        app.setConfigDefault("queue_system_compress_files", 0,
+                             "Compress result files sent from grid jobs, when the file system isn't shared with them")
         app.setConfigDefault("queue_system_core_file_location", "",
                              "System-wide location for core files from grid jobs, in case TEXTTEST_TMP is generated")
         app.addConfigEntry("builtin", "proxy_options", "definition_file_stems")
@@ -70,6 +70,9 @@ class QueueSystem(object):
     def slavesOnRemoteSystem(self):
         return False
 
+    def canForkSlaves(self):
+        return False  # only local slaves can be forked from the master
+
     def getTextTestArgs(self):
         texttest = plugins.getTextTestProgram()
         if plugins.isTextTestExe():
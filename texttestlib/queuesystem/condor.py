@@ -3,6 +3,7 @@ import os
 import subprocess
 from . import abstractqueuesystem
 from texttestlib.plugins import log
+from locale import getpreferredencoding
 
 # Used by the master to submit, monitor and delete jobs...
 
@@ -57,10 +58,13 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
     def getStatusForAllJobs(self):
         statusDict = {}
         proc = subprocess.Popen(['condor_q', '-format', '%s ', 'ClusterId', '-format', '%s\\n',
-                                 'JobStatus'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                                 'JobStatus'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                encoding=getpreferredencoding())
         outMsg = proc.communicate()[0]
         for line in outMsg.splitlines():
             words = line.split()
+            if len(words) < 2:
+                continue
             statusLetter = words[1]
             status = self.allStatuses.get(statusLetter)
             if status:
@@ -35,6 +35,20 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
             self.processes[jobId] = process
             return jobId, None
 
+    def canForkSlaves(self):
+        return os.name == "posix"
+
+    def forkSlaveJob(self, forkServer, slaveArgs, slaveEnv, logDir, submissionRules):
+        # The slave is forked by the fork server, rather than being a new TextTest process
+        outputFile, errorsFile = submissionRules.getJobFiles()
+        slaveEnv = self.getSlaveEnvironment(slaveEnv)
+        pid, errorMessage = forkServer.forkSlave(slaveArgs, slaveEnv, logDir, outputFile, errorsFile)
+        if errorMessage:
+            return None, errorMessage
+        jobId = str(pid)
+        self.processes[jobId] = ForkedProcess(pid)
+        return jobId, None
+
     def getCapacity(self):
         return cpu_count()
 
@@ -67,6 +81,28 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
     def getQueueSystemName(self):
         return "local queue"
 
+
+class ForkedProcess:
+    # The parts of the Popen interface we use, for slaves forked by the fork server.
+    # They aren't our children, so we can tell when they have finished but not how.
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = 0
+        return self.returncode
+
+    def send_signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
 # Interpret what the limit signals mean...
 
 
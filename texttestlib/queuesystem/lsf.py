@@ -1,12 +1,29 @@
 
 import os
+import json
+import subprocess
 from . import gridqueuesystem
+from texttestlib.plugins import log
+from locale import getpreferredencoding
 
 # Used by the master to submit, monitor and delete jobs...
 
 
 class QueueSystem(gridqueuesystem.QueueSystem):
+    allStatuses = {"PEND": ("PEND", "Pending"),
+                   "PSUSP": ("PSUSP", "Suspended by the user while pending"),
+                   "RUN": ("RUN", "Running"),
+                   "USUSP": ("USUSP", "Suspended by the user"),
+                   "SSUSP": ("SSUSP", "Suspended by LSF"),
+                   "WAIT": ("WAIT", "Waiting for its chunk to start"),
+                   "PROV": ("PROV", "Waiting for its host to be provisioned"),
+                   "UNKWN": ("UNKWN", "Lost contact with its host"),
+                   "ZOMBI": ("ZOMBI", "Killed while its host was unreachable")}
     submitProg = "bsub"
+    def __init__(self, app):
+        gridqueuesystem.QueueSystem.__init__(self, app)
+        self.pollingEnabled = app.getConfigValue("queue_system_lsf_polling") == 1
+
     def getSubmitCmdArgs(self, submissionRules, commandArgs=[], slaveEnv={}):
         bsubArgs = ["bsub", "-J", submissionRules.getJobName()]
         if submissionRules.processesNeeded != 1:
@@ -59,8 +76,38 @@ class QueueSystem(gridqueuesystem.QueueSystem):
             return resultOutput
 
     def supportsPolling(self):
-        # This feature was added to the SGE handling when I no longer had access to an LSF cluster
-        return False
+        return self.pollingEnabled
+
+    def getStatusForAllJobs(self):
+        if not self.pollingEnabled:
+            return
+        # One query for all our jobs, in a form that doesn't depend on column widths
+        proc = subprocess.Popen(["bjobs", "-o", "jobid stat", "-json"], stdin=open(os.devnull),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding=getpreferredencoding())
+        outMsg, errMsg = proc.communicate()
+        try:
+            records = json.loads(outMsg)["RECORDS"] if proc.returncode == 0 else None
+        except (ValueError, KeyError, TypeError):
+            records = None
+        if records is None:
+            # Without a proper answer we can't tell which jobs have gone, so go back to not polling at all
+            log.info("WARNING: could not read job status from 'bjobs -json', no longer polling LSF : " +
+                     (errMsg.strip() or outMsg.strip()))
+            self.pollingEnabled = False
+            return
+
+        statusDict = {}
+        for record in records:
+            jobId, statusName = record.get("JOBID"), record.get("STAT")
+            if not jobId or not statusName:
+                continue
+            status = self.allStatuses.get(statusName)
+            if status:
+                statusDict[jobId] = status
+            elif statusName not in ["DONE", "EXIT"]:
+                log.info("WARNING: unexpected job status " + repr(statusName) + " received from LSF!")
+                statusDict[jobId] = statusName, statusName
+        return statusDict
 
     def killJob(self, jobId):
         resultOutput = os.popen("bkill -s USR1 " + jobId + " 2>&1").read()
@@ -8,16 +8,20 @@ import socket
 import signal
 import logging
 import time
+import heapq
 from .utils import *
 from queue import Queue
 from socketserver import ThreadingTCPServer, StreamRequestHandler
-from threading import RLock, Lock
+from threading import RLock, Lock, active_count
 from collections import OrderedDict
+from itertools import count
+from io import BytesIO
 from texttestlib import plugins
 from texttestlib.default.console import TextDisplayResponder, InteractiveResponder
 from texttestlib.default.knownbugs import CheckForBugs
 from texttestlib.default.actionrunner import BaseActionRunner
-from texttestlib.default.performance import getTestPerformance
+from texttestlib.default.performance import getTimeDescription
+from .slavejobs import SlaveForkServer
 from glob import glob
 from locale import getpreferredencoding
 
@@ -57,6 +61,7 @@ class QueueSystemServer(BaseActionRunner):
         self.maxCapacity = 100000  # infinity, sort of
         self.allApps = allApps
         self.jobs = OrderedDict()
+        self.jobTracker = JobTracker()
         self.submissionRules = {}
         self.killedJobs = {}
         self.queueSystems = {}
@@ -68,6 +73,9 @@ class QueueSystemServer(BaseActionRunner):
         self.slaveLogDirs = set()
         self.delayedTestsForAdd = []
         self.remainingForApp = OrderedDict()
+        self.forkServer = None
+        self.forkServerChecked = False
+        self.scheduler = None
         appCapacities = []
         for app in allApps:
             appCapacity = self.maxCapacity
@@ -96,9 +104,15 @@ class QueueSystemServer(BaseActionRunner):
         capacityPerSuite = self.maxCapacity / len(allApps)
         for app in allApps:
             self.remainingForApp[app.name] = capacityPerSuite
+        if any((app.getConfigValue("queue_system_test_order") == "longest_first" for app in allApps)):
+            self.scheduler = LongestFirstScheduler(self.maxCapacity, allApps, self.diag)
         QueueSystemServer.instance = self
 
     def addSuites(self, suites):
+        if not self.forkServerChecked:
+            # Later suites come from tests added while running, when it's too late to start it
+            self.forkServerChecked = True
+            self.startForkServer(suites)
         for suite in suites:
             self.slaveLogDirs.add(suite.app.makeWriteDirectory("slavelogs"))
             plugins.log.info("Using "
@@ -106,6 +120,24 @@ class QueueSystemServer(BaseActionRunner):
                              + " queues for "
                              + suite.app.description(includeCheckout=True))
 
+    def startForkServer(self, suites):
+        # Proxies and reconnection need the slave command line, and the GUI has threads of its own
+        if "g" in self.optionMap or "reconnect" in self.optionMap or \
+                not any((self.canForkSlaves(suite.app) for suite in suites)):
+            return
+        # Must fork before there are other threads, which the submission and slave server threads will be
+        if active_count() > 1:
+            plugins.log.info("WARNING: starting slaves as new processes, as other threads are already running")
+            return
+        forkServer = SlaveForkServer(self.optionMap, suites)
+        if forkServer.start():
+            self.forkServer = forkServer
+
+    def canForkSlaves(self, app):
+        queueSystem = self.getQueueSystem(app)
+        return queueSystem is not None and queueSystem.canForkSlaves() and \
+            app.getConfigValue("queue_system_fork_slaves") and not app.getConfigValue("queue_system_proxy_executable")
+
     def setSlaveServerAddress(self, address):
         self.submitAddress = os.getenv("CAPTUREMOCK_SERVER", address)
         self.testQueue.put("TextTest slave server started on " + address)
@@ -126,15 +158,22 @@ class QueueSystemServer(BaseActionRunner):
     def queueTestForRerun(self, test):
         # Clear out the previous job reference, otherwise our grid polling will kill it off
         self.jobs[test] = []
+        self.jobTracker.removeTest(test)
         self.addTestToQueues(test)
 
     def addTestToQueues(self, test):
         with self.counterLock:
             self.testCount += 1
         queue = self.findQueueForTest(test)
-        if queue:
+        if queue is self.testQueue and self.scheduler:
+            self.releaseTest(self.scheduler.addTest(test))
+        elif queue:
             queue.put(test)
 
+    def releaseTest(self, test):
+        if test:
+            self.testQueue.put(test)
+
     def addDelayedTests(self):
         for test in self.delayedTestsForAdd:
             self.addTestToQueues(test)
@@ -142,6 +181,10 @@ class QueueSystemServer(BaseActionRunner):
 
     def notifyAllRead(self, suites):
         self.addDelayedTests()
+        if self.scheduler:
+            # Nothing more to wait for, so everything can go in ahead of the terminator
+            for test in self.scheduler.releaseAll():
+                self.testQueue.put(test)
         BaseActionRunner.notifyAllRead(self, suites)
         self.allRead = True
 
@@ -162,7 +205,10 @@ class QueueSystemServer(BaseActionRunner):
         interval = float(os.getenv("TEXTTEST_QS_POLL_INTERVAL", "0.5"))         # Amount of time to wait between checks for exit/completion when polling grid/cloud
         attempts = int(float(os.getenv("TEXTTEST_QS_POLL_WAIT", "5")) / interval) # Amount of time to wait before initiating polling of grid/cloud
         subsequentAttempts = int(float(os.getenv("TEXTTEST_QS_POLL_SUBSEQUENT_WAIT", "15")) / interval) # Amount of time to wait before subsequent polling of grid/cloud
+        maxAttempts = int(float(os.getenv("TEXTTEST_QS_POLL_MAX_WAIT", "60")) / interval) # Longest time to wait between polls when nothing is changing
         if attempts >= 0:
+            statusAttempts = attempts
+            attemptsToStatus = 0
             while True:
                 for _ in range(attempts):
                     time.sleep(interval)
@@ -170,8 +216,14 @@ class QueueSystemServer(BaseActionRunner):
                         return
                     if self.exited:
                         break
-                if not self.exited:
-                    self.updateJobStatus()
+                attemptsToStatus -= attempts
+                if not self.exited and attemptsToStatus <= 0:
+                    if self.updateJobStatus() == 0:
+                        # Nothing changed, so poll less often until something does. Reruns are still checked as often as before
+                        statusAttempts = max(subsequentAttempts, min(statusAttempts * 2, maxAttempts))
+                    else:
+                        statusAttempts = subsequentAttempts
+                    attemptsToStatus = statusAttempts
                 attempts = subsequentAttempts
                 self.diag.info("Trying to rerun queues " + repr(self.testsSubmitted) +
                                " out of " + repr(self.maxCapacity) + " tests submitted")
@@ -179,31 +231,40 @@ class QueueSystemServer(BaseActionRunner):
                 self.runQueue(self.getTestForRun, self.runTest, "rerunning", block=False)
 
     def canPoll(self):
-        queueSystem = self.getQueueSystem(list(self.jobs.keys())[0])
+        queueSystem = self.getQueueSystem(next(iter(self.jobs)))
         return queueSystem.supportsPolling()
 
     def updateJobStatus(self):
-        queueSystem = self.getQueueSystem(list(self.jobs.keys())[0])
+        queueSystem = self.getQueueSystem(next(iter(self.jobs)))
         statusInfo = queueSystem.getStatusForAllJobs()
-        self.diag.info("Got status for all jobs : " + repr(statusInfo))
-        if statusInfo is not None:  # queue system not available for some reason
-            for test, jobs in list(self.jobs.items()):
-                if not test.state.isComplete():
-                    for jobId, jobName in jobs:
-                        status = statusInfo.get(jobId)
-                        if status:
-                            # Only do this to test jobs (might make a difference for derived configurations)
-                            # Ignore filtering states for now, which have empty 'briefText'.
-                            self.updateRunStatus(test, status)
-                        elif not status and not self.jobCompleted(test, jobName):
-                            # Do this to any jobs
-                            self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId)
+        if statusInfo is None:  # queue system not available for some reason
+            self.diag.info("Got no status information")
+            return
+        activeJobs = self.jobTracker.getActiveJobs()
+        self.diag.info("Got status for " + str(len(statusInfo)) + " jobs, checking " + str(len(activeJobs)) + " active jobs")
+        changes = 0
+        for jobId, (test, jobName) in activeJobs:
+            if not test.state.isComplete():
+                status = statusInfo.get(jobId)
+                if status:
+                    # Only do this to test jobs (might make a difference for derived configurations)
+                    # Ignore filtering states for now, which have empty 'briefText'.
+                    if self.updateRunStatus(test, status):
+                        changes += 1
+                elif not self.jobCompleted(test, jobName):
+                    # Do this to any jobs
+                    self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId)
+                    changes += 1
+        self.diag.info("Job status changed for " + str(changes) + " jobs")
+        return changes
 
     def updateRunStatus(self, test, status):
         newRunStatus, newExplanation = status
         newState = test.state.makeModifiedState(newRunStatus, newExplanation, "grid status update")
         if newState:
             test.changeState(newState)
+            return True
+        return False
 
     def findQueueForTest(self, test):
         # If we've gone into reuse mode and there are no active tests for reuse, use the "reuse failure queue"
@@ -226,6 +287,8 @@ class QueueSystemServer(BaseActionRunner):
 
     def markTestReuse(self, test, newTest):
         self.jobs[newTest] = self.getJobInfo(test)
+        for jobId, jobName in self.jobs[newTest]:
+            self.jobTracker.addJob(newTest, jobId, jobName)
         with self.counterLock:
             if self.testCount > 1:
                 self.testCount -= 1
@@ -310,6 +373,10 @@ class QueueSystemServer(BaseActionRunner):
         if type(testOrStatus) == str:
             self.sendServerState(testOrStatus)
             return self.getTest(block)
+        elif self.scheduler:
+            test, nextTest = self.scheduler.takeTest(testOrStatus)
+            self.releaseTest(nextTest)
+            return test
         else:
             return testOrStatus
 
@@ -361,9 +428,15 @@ class QueueSystemServer(BaseActionRunner):
     def reuseCanFail(self):
         return any((not qs.slavesOnRemoteSystem() for qs in list(self.queueSystems.values())))
 
+    def notifyComplete(self, test):
+        BaseActionRunner.notifyComplete(self, test)
+        self.jobTracker.removeTest(test)
+
     def notifyAllComplete(self):
         BaseActionRunner.notifyAllComplete(self)
         self.cleanup(final=True)
+        if self.scheduler:
+            self.scheduler.reportMakespan()
         if self.reuseOnly: # could still be hanging waiting for this, make sure we terminate
             self.submitTerminators()
 
@@ -391,7 +464,7 @@ class QueueSystemServer(BaseActionRunner):
     def cleanup(self, final=False):
         cleanupComplete = True
         if self.jobs:
-            queueSystem = self.getQueueSystem(list(self.jobs.keys())[0])
+            queueSystem = self.getQueueSystem(next(iter(self.jobs)))
             cleanupComplete &= queueSystem.cleanup(final)
         if cleanupComplete and not final:
             self.sendServerState("Completed submission of all tests")
@@ -413,6 +486,8 @@ class QueueSystemServer(BaseActionRunner):
             self.testCount -= 1
             self.testsSubmitted += 1
             self.diag.info("Submission successful" + self.remainStr())
+        if self.scheduler:
+            self.scheduler.notifySubmitted()
         if not test.state.hasStarted():
             test.changeState(self.getPendingState(test))
         if self.testsSubmitted == self.maxCapacity:
@@ -539,13 +614,14 @@ class QueueSystemServer(BaseActionRunner):
 
             self.lockDiag.info("Got lock for submission")
             logDir = self.getSlaveLogDir(test)
-            jobId, errorMessage = queueSystem.submitSlaveJob(cmdArgs, slaveEnv, logDir, submissionRules, jobType)
+            jobId, errorMessage = self.submitSlaveJob(test, queueSystem, cmdArgs, slaveEnv, logDir, submissionRules, jobType)
             if jobId is not None:
                 self.diag.info("Job created with id " + jobId)
                 # if the slaves run elsewhere (e.g. the cloud) then the capacity of the system can change dynamically depending on what is available
                 if queueSystem.slavesOnRemoteSystem():
                     self.checkQueueCapacity(queueSystem)
                 self.jobs.setdefault(test, []).append((jobId, jobName))
+                self.jobTracker.addJob(test, jobId, jobName)
                 self.lockDiag.info("Releasing lock for submission...")
                 return True
             else:
@@ -554,6 +630,14 @@ class QueueSystemServer(BaseActionRunner):
                 self.handleErrorState(test)
                 return False
 
+    def submitSlaveJob(self, test, queueSystem, cmdArgs, slaveEnv, logDir, submissionRules, jobType):
+        if not jobType and self.forkServer and test.app in self.forkServer.apps and self.canForkSlaves(test.app):
+            self.diag.info("Forking slave for " + test.uniqueName + " instead of starting a new process")
+            slaveArgs = test.app.name, test.app.versions, test.getRelPath(), self.submitAddress
+            return queueSystem.forkSlaveJob(self.forkServer, slaveArgs, slaveEnv, logDir, submissionRules)
+        else:
+            return queueSystem.submitSlaveJob(cmdArgs, slaveEnv, logDir, submissionRules, jobType)
+
     def checkQueueCapacity(self, queueSystem):
         queueCapacity = queueSystem.getCapacity()
         if queueCapacity:
@@ -763,6 +847,117 @@ class QueueSystemServer(BaseActionRunner):
         postText = self.getPostText(test, jobId)
         plugins.log.info("T: Cancelling " + repr(test) + " " + postText)
 
+
+class JobTracker:
+    # The jobs whose tests haven't completed yet, which are the only ones polling needs to look at
+    def __init__(self):
+        self.lock = Lock()
+        self.activeJobs = OrderedDict()
+        self.jobsForTest = {}
+
+    def addJob(self, test, jobId, jobName):
+        with self.lock:
+            # Reused jobs move on to their new test
+            self.activeJobs[jobId] = test, jobName
+            self.jobsForTest.setdefault(test, []).append(jobId)
+
+    def removeTest(self, test):
+        with self.lock:
+            for jobId in self.jobsForTest.pop(test, []):
+                if jobId in self.activeJobs and self.activeJobs[jobId][0] is test:
+                    del self.activeJobs[jobId]
+
+    def getActiveJobs(self):
+        with self.lock:
+            return list(self.activeJobs.items())
+
+
+class LongestFirstScheduler:
+    """ Submits the tests expected to take longest first, so that a long test late in the
+    test suite doesn't end up running on its own after everything else has finished.
+    Tests are held here and released for submission one at a time, longest first, until all have been read """
+    def __init__(self, capacity, allApps, diag):
+        self.capacity = capacity
+        self.allApps = allApps
+        self.diag = diag
+        self.lock = Lock()
+        self.pending = []
+        self.sortKeys = {}
+        self.testIndices = count()  # equal times keep test suite order
+        self.released = 0
+        self.allReleased = False
+        self.expectedTimes = OrderedDict()
+        self.knownTimes = []
+        self.predictedMakespan = None
+        self.startTime = None
+
+    def addTest(self, test):
+        """ Returns the test to release now, if any """
+        expectedTime = test.app.getExpectedRunTime(test, self.allApps)
+        with self.lock:
+            if expectedTime is not None:
+                self.knownTimes.append(expectedTime)
+            else:
+                # Tests we know nothing about are assumed to be average
+                expectedTime = self.getAverageTime()
+            self.expectedTimes[test] = expectedTime
+            self.sortKeys[test] = -expectedTime, next(self.testIndices), test
+            if self.allReleased:  # i.e. a rerun
+                self.released += 1
+                return test
+            heapq.heappush(self.pending, self.sortKeys[test])
+            return self.releaseIfIdle()
+
+    def takeTest(self, test):
+        """ Called when a released test is taken for submission. Returns the test to submit instead, which is
+        a longer one if one has been read since it was released, and the test to release in its place, if any """
+        with self.lock:
+            self.released -= 1
+            if self.pending and self.pending[0] < self.sortKeys[test]:
+                test = heapq.heapreplace(self.pending, self.sortKeys[test])[-1]
+            return test, self.releaseIfIdle()
+
+    def releaseIfIdle(self):
+        if self.released == 0 and self.pending:
+            self.released += 1
+            return heapq.heappop(self.pending)[-1]
+
+    def releaseAll(self):
+        with self.lock:
+            self.allReleased = True
+            tests = [heapq.heappop(self.pending)[-1] for _ in range(len(self.pending))]
+            self.released += len(tests)
+            fallback = self.getAverageTime()
+            self.diag.info("Expected times for " + str(len(self.knownTimes)) + " of " + str(len(self.expectedTimes)) +
+                           " tests, others assumed to take " + str(fallback) + " seconds")
+            suiteOrder = list(self.expectedTimes.keys())
+            orderedTests = sorted(suiteOrder, key=lambda test: self.sortKeys[test])
+        self.predictedMakespan = self.predictMakespan(orderedTests)
+        self.diag.info("Predicted makespan " + str(self.predictedMakespan) + " seconds, in test suite order it would be " +
+                       str(self.predictMakespan(suiteOrder)) + " seconds")
+        return tests
+
+    def getAverageTime(self):
+        return sum(self.knownTimes) / len(self.knownTimes) if self.knownTimes else 0.0
+
+    def predictMakespan(self, tests):
+        # Each test goes to whichever slot becomes free first
+        slotEndTimes = [0.0] * min(self.capacity, len(tests))
+        for test in tests:
+            heapq.heapreplace(slotEndTimes, slotEndTimes[0] + self.expectedTimes[test])
+        return max(slotEndTimes, default=0.0)
+
+    def notifySubmitted(self):
+        if self.startTime is None:
+            self.startTime = time.time()
+
+    def reportMakespan(self):
+        if self.startTime is not None and self.predictedMakespan:
+            actualMakespan = time.time() - self.startTime
+            plugins.log.info("Q: Expected all tests to complete in " + getTimeDescription(int(self.predictedMakespan)) +
+                             ", they took " + getTimeDescription(int(actualMakespan)))
+
+
 # Used in slave
 
 
@@ -953,16 +1148,47 @@ class TestSubmissionRules(SubmissionRules):
 
 
 class SlaveRequestHandler(StreamRequestHandler):
+    persistent = False
+
     def handle(self):
         identifier = str(self.rfile.readline().strip(), getpreferredencoding())
         if identifier == "TERMINATE_SERVER":
             return
+        elif identifier == persistentConnectionText:
+            self.handlePersistentConnection()
+        else:
+            self.handleMessage(identifier)
 
-        self.handleMessage(identifier)
+    def handlePersistentConnection(self):
+        # The slave sends all its messages over this connection, until it closes it
+        self.persistent = True
+        self.server.addPersistentConnection(self.connection)
+        connectionReader = self.rfile
+        try:
+            for message in iter(lambda: receiveFrame(connectionReader), None):
+                # Each message is handled just as if it had its own connection
+                self.rfile, self.wfile = BytesIO(message), BytesIO()
+                try:
+                    self.handleMessage(str(self.rfile.readline().strip(), getpreferredencoding()))
+                except Exception:
+                    sys.stderr.write("WARNING: slave server caught exception while processing request!\n")
+                    plugins.printException()
+                sendFrame(self.connection, self.wfile.getvalue())
+        finally:
+            self.rfile = connectionReader
+            self.server.removePersistentConnection(self.connection)
+
+    def shutdownConnection(self, how):
+        if not self.persistent:
+            try:
+                self.connection.shutdown(how)
+            except socket.error:
+                # This only occurs on a mac, and doesn't affect functionality.
+                pass
 
     def handleMessage(self, identifier):
         # Don't use port, it changes all the time
-        identifier, sendFiles, getFiles, tryReuse, rerun = parseIdentifier(identifier)
+        identifier, sendFiles, getFiles, tryReuse, rerun, framedFiles = parseIdentifier(identifier)
         testString = str(self.rfile.readline().strip(), getpreferredencoding())
         test = self.server.getTest(testString)
         if test is None:
@@ -975,17 +1201,16 @@ class SlaveRequestHandler(StreamRequestHandler):
             if sendFiles:
                 self.server.diag.info("Test " + test.uniqueName +
                                       " - receiving files sent from slave to sandbox directory")
-                directoryUnserialise(test.writeDirectory, self.rfile)
+                if framedFiles:
+                    directoryReceive(test.writeDirectory, self.rfile)
+                else:
+                    directoryUnserialise(test.writeDirectory, self.rfile)
             # Don't use port, it changes all the time
             self.handleRequestFromHost(test, identifier, tryReuse, rerun)
         else:
             self.server.diag.info("Test " + test.uniqueName + " already complete, ignoring new results")
             self.sendReuseResponse(test, test.state, tryReuse, False)
-        try:
-            self.connection.shutdown(socket.SHUT_RDWR)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
+        self.shutdownConnection(socket.SHUT_RDWR)
 
     def getHostName(self, ipAddress):
         try:
@@ -1015,11 +1240,7 @@ class SlaveRequestHandler(StreamRequestHandler):
         if test.state.isComplete():
             state.lifecycleChange = "recalculated"
         doneRerun = self.server.changeStateOrRerun(test, state, rerun)
-        try:
-            self.connection.shutdown(socket.SHUT_RD)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
+        self.shutdownConnection(socket.SHUT_RD)
         if state.isComplete():
             self.sendReuseResponse(test, state, tryReuse, doneRerun)
         else:
@@ -1038,6 +1259,8 @@ class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
         self.testLocks = {}
         self.filePushLock = Lock()
         self.filePushProcesses = {}
+        self.persistentConnections = set()
+        self.connectionLock = Lock()
         self.diag = logging.getLogger("Slave Server")
         self.terminate = False
         self.totalReruns = 0
@@ -1081,9 +1304,28 @@ class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
         if len(self.testMap) == 0:
             self.notifyAllComplete()
 
+    def addPersistentConnection(self, connection):
+        with self.connectionLock:
+            self.persistentConnections.add(connection)
+
+    def removePersistentConnection(self, connection):
+        with self.connectionLock:
+            self.persistentConnections.discard(connection)
+
+    def closePersistentConnections(self):
+        # Slaves that are still around have nothing more to tell us, don't let their threads keep us waiting
+        # Only stop reading, the last message may still be waiting for its response
+        with self.connectionLock:
+            for connection in self.persistentConnections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+
     def notifyAllComplete(self):
         self.diag.info("Notified all complete, shutting down soon...")
         self.terminate = True
+        self.closePersistentConnections()
         sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sendSocket.connect(self.socket.getsockname())
         sendSocket.sendall("TERMINATE_SERVER\n".encode(getpreferredencoding()))
@@ -6,6 +6,7 @@ from . import gridqueuesystem
 from texttestlib.plugins import gethostname, log, TextTestError
 from time import sleep
 from locale import getpreferredencoding
+from xml.etree import ElementTree
 
 # Used by master process for submitting, deleting and monitoring slave jobs
 
@@ -105,39 +106,36 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         return jobId
 
     def getStatusForAllJobs(self):
-        statusDict = {}
-        proc = subprocess.Popen(["qstat"], stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding=getpreferredencoding())
+        # The XML form is one query for all our jobs, and doesn't depend on how columns are laid out
+        proc = subprocess.Popen(["qstat", "-xml"], stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         outMsg = proc.communicate()[0]
         if proc.returncode > 0:
             # SGE unavailable for the moment, don't update the job status
             return
+        try:
+            root = ElementTree.fromstring(outMsg)
+        except ElementTree.ParseError:
+            log.info("WARNING: could not parse job status output from SGE, not updating job status")
+            return
 
-        for line in outMsg.splitlines():
-            words = line.split()
-            if len(words) >= 5 and words[0].isdigit():
-                jobId = words[0]
-                statusLetter = self.getStatusLetter(words, 4)
-                if statusLetter in self.errorStatuses:
-                    self.errorReasons[jobId] = self.getErrorReason(jobId)
-                    self.killJob(jobId)
-                    continue
-
-                status = self.allStatuses.get(statusLetter)
-                if status:
-                    statusDict[jobId] = status
-                else:
-                    log.info("WARNING: unexpected job status " + repr(statusLetter) + " received from SGE!")
-                    statusDict[jobId] = statusLetter, statusLetter
-        return statusDict
-
-    def isDate(self, text):
-        return len(text) == 10 and text.count("/") == 2
+        statusDict = {}
+        for jobElement in root.iter("job_list"):
+            jobId = jobElement.findtext("JB_job_number", "").strip()
+            statusLetter = jobElement.findtext("state", "").strip()
+            if not jobId:
+                continue
+            if statusLetter in self.errorStatuses:
+                self.errorReasons[jobId] = self.getErrorReason(jobId)
+                self.killJob(jobId)
+                continue
 
-    def getStatusLetter(self, words, statusIndex):
-        if len(words) < statusIndex + 1 or self.isDate(words[statusIndex + 1]):
-            return words[statusIndex]
-        else:
-            return self.getStatusLetter(words, statusIndex + 1)
+            status = self.allStatuses.get(statusLetter)
+            if status:
+                statusDict[jobId] = status
+            else:
+                log.info("WARNING: unexpected job status " + repr(statusLetter) + " received from SGE!")
+                statusDict[jobId] = statusLetter, statusLetter
+        return statusDict
 
     def getErrorReason(self, jobId):
         proc = subprocess.Popen(["qstat", "-j", jobId], stdin=open(os.devnull), encoding=getpreferredencoding(),
@@ -0,0 +1,75 @@
+"""
+A queue system that runs nothing: each job is pending for a while, then running for a while, then disappears.
+For exercising the master's submission and polling with very many jobs, without a grid engine.
+The times are set with TEXTTEST_SIMULATED_PENDING_TIME and TEXTTEST_SIMULATED_RUN_TIME, in seconds.
+As no slave ever reports back, the master will decide each test's job exited without running it.
+"""
+
+import os
+import time
+from . import abstractqueuesystem
+from collections import OrderedDict
+
+
+class QueueSystem(abstractqueuesystem.QueueSystem):
+    allStatuses = {"PEND": ("PEND", "Pending"),
+                   "RUN": ("RUN", "Running")}
+
+    def __init__(self, *args):
+        self.pendingTime = float(os.getenv("TEXTTEST_SIMULATED_PENDING_TIME", "1"))
+        self.runTime = float(os.getenv("TEXTTEST_SIMULATED_RUN_TIME", "5"))
+        self.submitTimes = OrderedDict()
+        self.lastJobId = 0
+
+    def submitSlaveJob(self, cmdArgs, slaveEnv, logDir, submissionRules, jobType):
+        self.lastJobId += 1
+        jobId = str(self.lastJobId)
+        self.submitTimes[jobId] = time.time()
+        return jobId, None
+
+    def getStatusForAllJobs(self):
+        statusDict = {}
+        now = time.time()
+        # Finished jobs disappear, as they do from a grid engine
+        for jobId, submitTime in list(self.submitTimes.items()):
+            runningTime = now - submitTime - self.pendingTime
+            if runningTime >= self.runTime:
+                del self.submitTimes[jobId]
+            else:
+                statusDict[jobId] = self.allStatuses["RUN" if runningTime >= 0 else "PEND"]
+        return statusDict
+
+    def killJob(self, jobId):
+        return self.submitTimes.pop(jobId, None) is not None
+
+    def getJobFailureInfo(self, jobId):
+        return ""  # no accounting system here...
+
+    def formatCommand(self, cmdArgs):
+        return " ".join(cmdArgs)
+
+    def getQueueSystemName(self):
+        return "simulated queue"
+
+
+# Used by slave for producing performance data
+
+
+class MachineInfo:
+    def findActualMachines(self, machineOrGroup):
+        return [machineOrGroup]
+
+    def findResourceMachines(self, resource):
+        return []
+
+    def findRunningJobs(self, machine):
+        return []
+
+
+def getUserSignalKillInfo(userSignalNumber, explicitKillMethod):
+    return explicitKillMethod()
+
+
+def getExecutionMachines():
+    from texttestlib.plugins import gethostname
+    return [gethostname()]
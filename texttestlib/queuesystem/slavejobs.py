@@ -10,11 +10,13 @@ import socket
 import signal
 import logging
 from .utils import *
+from threading import Lock
 from texttestlib import plugins
 from texttestlib.default.runtest import RunTest
 from texttestlib.default.sandbox import FindExecutionHosts, MachineInfoFinder
 from texttestlib.default.actionrunner import ActionRunner
 from texttestlib.utils import getUserName
+from multiprocessing import Pipe
 from pickle import dumps
 from locale import getpreferredencoding
 
@@ -77,6 +79,9 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         self.transferAll = optionMap.get("keepslave") or optionMap.get("keeptmp")
         self.testsForRerun = []
         self.serverAddress = self.getServerAddress(optionMap)
+        self.connection = None
+        self.connectionReader = None
+        self.connectionLock = Lock()
 
     def getServerAddress(self, optionMap):
         servAddrStr = optionMap.get("servaddr", os.getenv("CAPTUREMOCK_SERVER"))
@@ -110,7 +115,7 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         rerun = test in self.testsForRerun
         if rerun:
             self.testsForRerun.remove(test)
-        return makeIdentifierLine(identifier, sendFiles, False, self.killed, rerun)
+        return makeIdentifierLine(identifier, sendFiles, False, self.killed, rerun, framedFiles=True)
 
     def notifyRerun(self, test):
         self.testsForRerun.append(test)
@@ -121,19 +126,25 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         pickleData = dumps(state, protocol=protocol)
         sendFiles = self.synchFiles and changeDesc == "complete" and (self.transferAll or not test.state.hasSucceeded())
         fullData = self.getProcessIdentifier(test, sendFiles) + os.linesep + testData + os.linesep
+        messageParts = [fullData.encode(getpreferredencoding())]
         if sendFiles:
-            fullData += directorySerialise(test.writeDirectory) + os.linesep
-        fullDataBytes = fullData.encode(getpreferredencoding()) + pickleData
-        return self.sendAndInterpret(fullDataBytes, self.interpretResponse, state)
+            # Streamed straight from the files when sending, so not stored in memory
+            compress = test.getConfigValue("queue_system_compress_files")
+            messageParts.append(lambda sendSocket: directorySend(sendSocket, test.writeDirectory, compress))
+        messageParts.append(pickleData)
+        persistent = self.usePersistentConnection(test) and not sendFiles
+        return self.sendAndInterpret(messageParts, self.interpretResponse, state, persistent=persistent)
 
-    def sendAndInterpret(self, fullData, responseMethod, *args):
+    def usePersistentConnection(self, test):
+        return test.getConfigValue("queue_system_persistent_connections")
+
+    def sendAndInterpret(self, messageParts, responseMethod, *args, persistent=False):
         sleepTime = 1
         for _ in range(9):
-            sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if not self.connect(sendSocket):
-                return self.notify("NoMoreExtraTests")
             try:
-                response = self.sendData(sendSocket, fullData)
+                response = self.exchangeData(messageParts, persistent)
+                if response is None:
+                    return self.notify("NoMoreExtraTests")
                 return responseMethod(response, *args) if responseMethod else True
             except socket.error as e:
                 plugins.log.info("Failed to communicate with master process - waiting " +
@@ -147,8 +158,56 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         plugins.log.info(message.strip())
         self.notify("NoMoreExtraTests")
 
-    def sendData(self, sendSocket, fullData):
-        sendSocket.sendall(fullData)
+    def exchangeData(self, messageParts, persistent):
+        # Messages can come from more than one thread, and must not be interleaved on a persistent connection
+        with self.connectionLock:
+            sendSocket = self.getConnection(persistent)
+            if sendSocket is None:
+                return
+            if not persistent:
+                return self.sendData(sendSocket, messageParts)
+            try:
+                return self.sendFramedData(sendSocket, messageParts)
+            except socket.error:
+                # Start again with a new connection next time
+                self.closeConnection()
+                raise
+
+    def getConnection(self, persistent):
+        if persistent and self.connection is not None:
+            return self.connection
+        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not self.connect(sendSocket):
+            return
+        if persistent:
+            if self.synchFiles:
+                # As for sendData: don't wait forever for a response over a connection that may have been cut
+                sendSocket.settimeout(25)
+            sendSocket.sendall((persistentConnectionText + "\n").encode())
+            self.connection = sendSocket
+            self.connectionReader = sendSocket.makefile("rb")
+        return sendSocket
+
+    def closeConnection(self):
+        if self.connection is not None:
+            self.connectionReader.close()
+            self.connection.close()
+            self.connection = None
+            self.connectionReader = None
+
+    def sendFramedData(self, sendSocket, messageParts):
+        sendFrame(sendSocket, b"".join(messageParts))
+        response = receiveFrame(self.connectionReader)
+        if response is None:
+            raise ConnectionError("Connection closed by master process")
+        return str(response, getpreferredencoding())
+
+    def sendData(self, sendSocket, messageParts):
+        for part in messageParts:
+            if callable(part):
+                part(sendSocket)
+            else:
+                sendSocket.sendall(part)
         sendSocket.shutdown(socket.SHUT_WR)
         if self.synchFiles:
             # Remote socket, possibly firewalls that kill connections, possibly other things. Use timeout and be prepared to retry...
@@ -172,7 +231,8 @@ class SocketResponder(plugins.Responder, plugins.Observable):
                 plugins.log.info(test.getIndent() + "Fetching required test data at " + repr(path) + " ...")
             data = makeIdentifierLine(str(os.getpid()), getFiles=True) + "\n" + socketSerialise(test) + "\n" + \
                 getUserName() + "@" + getIPAddress([test]) + "\n" + "\n".join(paths)
-            self.sendAndInterpret(data.encode(getpreferredencoding()), None)  # Just wait, no response to interpret
+            # Just wait, no response to interpret
+            self.sendAndInterpret([data.encode(getpreferredencoding())], None, persistent=self.usePersistentConnection(test))
 
 
 class SlaveActionRunner(ActionRunner):
@@ -190,6 +250,161 @@ class SlaveActionRunner(ActionRunner):
         self.testQueue.put(None)
 
 
+class SlaveForkServer:
+    """ A copy of the master process, made before the master starts any threads, which forks slaves when asked.
+    Forking the master itself once it is running copies only the forking thread: the others could be holding
+    locks, e.g. in logging, that the slave would then wait for forever. The configuration is read by then,
+    but not the tests, so the slaves read their tests as slaves started on the command line do """
+    def __init__(self, optionMap, rootSuites):
+        self.optionMap = optionMap
+        self.rootSuites = rootSuites
+        self.apps = [suite.app for suite in rootSuites]
+        self.connection = None
+        self.lock = Lock()
+
+    def start(self):
+        masterConnection, serverConnection = Pipe()
+        # Anything still buffered would be written by the server as well
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            plugins.printWarning("Failed to start fork server, starting slaves as new processes : " + str(e))
+            return False
+        if pid == 0:
+            masterConnection.close()
+            self.serve(serverConnection)
+        serverConnection.close()
+        self.connection = masterConnection
+        return True
+
+    def forkSlave(self, slaveArgs, slaveEnv, logDir, outputFile, errorsFile):
+        with self.lock:
+            try:
+                self.connection.send((slaveArgs, slaveEnv, logDir, outputFile, errorsFile))
+                return self.connection.recv()
+            except (OSError, EOFError) as e:
+                return None, "Failed to fork slave process : lost contact with fork server (" + str(e) + ")"
+
+    def serve(self, connection):
+        exitCode = 0
+        try:
+            # The master handles interrupts, and stops us by closing the connection, which it does when it exits
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # Nobody waits for the slaves here, so let the system clean up after them
+            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    break
+                connection.send(self.startSlave(connection, *request))
+        except BaseException:
+            plugins.printException()
+            exitCode = 1
+        finally:
+            # Don't run any of the master's exit handling
+            os._exit(exitCode)
+
+    def startSlave(self, connection, slaveArgs, slaveEnv, logDir, outputFile, errorsFile):
+        try:
+            pid = os.fork()
+        except OSError as e:
+            return None, "Failed to fork slave process : " + str(e)
+        if pid == 0:
+            connection.close()
+            self.runSlave(slaveArgs, slaveEnv, logDir, outputFile, errorsFile)
+        return pid, None
+
+    def runSlave(self, slaveArgs, slaveEnv, logDir, outputFile, errorsFile):
+        exitCode = 0
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Same files, directory and environment as a slave started on the command line
+            for fd, fileName in [(1, outputFile), (2, errorsFile)]:
+                with open(os.path.join(logDir, fileName), "w") as f:
+                    os.dup2(f.fileno(), fd)
+            os.chdir(logDir)
+            os.environ.clear()
+            os.environ.update(slaveEnv)
+            ForkedSlave(self.optionMap, self.rootSuites, *slaveArgs).run()
+        except BaseException:
+            plugins.printException()
+            exitCode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exitCode)
+
+
+class ForkedSlave(plugins.Responder):
+    """ A slave forked by the SlaveForkServer, which has already read the configuration.
+    Reads and runs tests as a slave started on the command line would, and reports to the master in the same way """
+    def __init__(self, optionMap, rootSuites, appName, versions, testPath, serverAddress):
+        plugins.Responder.__init__(self)
+        self.optionMap = optionMap
+        self.rootSuites = rootSuites
+        self.firstTestInfo = testPath, appName, versions
+        self.serverAddress = serverAddress
+        self.responder = None
+        self.runner = None
+        self.testsRun = []
+
+    def run(self):
+        rootSuite = self.findRootSuite(*self.firstTestInfo[1:])
+        # The configuration checks for this when deciding how to run tests
+        self.optionMap["slave"] = rootSuite.app.writeDirectory
+        self.optionMap["servaddr"] = self.serverAddress
+        self.responder = SocketResponder(self.optionMap)
+        self.responder.setObservers([self])
+        self.runner = SlaveActionRunner(self.optionMap)
+        # The master's responders were copied along with the suites, they mustn't hear anything from here
+        for suite in self.rootSuites:
+            suite.setObservers([self.responder, self.runner])
+        for sig in self.getSignals():
+            signal.signal(sig, self.handleSignal)
+        self.notifyExtraTest(*self.firstTestInfo)
+        self.runner.runAllTests()
+        self.cleanWriteDirectories()
+
+    def getSignals(self):
+        return [signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2, signal.SIGXCPU]
+
+    def handleSignal(self, sig, *args):
+        for ignoreSignal in self.getSignals():
+            signal.signal(ignoreSignal, signal.SIG_IGN)
+        self.responder.notifyKillProcesses()
+        self.runner.notifyKillProcesses(sig)
+
+    def findRootSuite(self, appName, versions):
+        for suite in self.rootSuites:
+            if suite.app.name == appName and suite.app.versions == versions:
+                return suite
+
+    def notifyExtraTest(self, testPath, appName, versions):
+        rootSuite = self.findRootSuite(appName, versions)
+        if rootSuite:
+            if rootSuite.app not in self.runner.appRunners:
+                self.runner.addSuite(rootSuite)
+            # As in a slave started on the command line, this reads the test, even if it's a rerun,
+            # and the runner hears about it being added
+            self.testsRun.append(rootSuite.addTestCaseWithPath(testPath))
+        else:
+            plugins.printWarning("Couldn't add extra test for application: " + str(appName))
+            self.runner.notifyNoMoreExtraTests()
+
+    def notifyNoMoreExtraTests(self):
+        self.runner.notifyNoMoreExtraTests()
+
+    def cleanWriteDirectories(self):
+        # Only for our own tests, the others may be running in other slaves
+        for test in self.testsRun:
+            if test and not test.app.keepTemporaryDirectories():
+                test.app.cleanSlaveFiles(test)
+
+
 class FindExecutionHostsInSlave(FindExecutionHosts):
     def getExecutionMachines(self, test):
         return importAndCallFromQueueSystem(test.app, "getExecutionMachines")
@@ -4,6 +4,7 @@ Utilities for both master and slave code
 """
 
 import os
+import zlib
 import socket
 from texttestlib import plugins
 from locale import getpreferredencoding
@@ -11,6 +12,7 @@ from locale import getpreferredencoding
 noReusePostfix = ".NO_REUSE"
 rerunPostfix = ".RERUN_TEST"
 sendFilePostfix = ".SEND_FILES"
+framedFilePostfix = ".FRAMED_FILES"
 getFilePostfix = ".GET_FILES"
 
 
@@ -49,9 +51,12 @@ def socketParse(testString):
     return testString.strip().split(":", 1)
 
 
-def makeIdentifierLine(identifier, sendFiles=False, getFiles=False, noReuse=False, rerun=False):
+def makeIdentifierLine(identifier, sendFiles=False, getFiles=False, noReuse=False, rerun=False, framedFiles=False):
     if sendFiles:
         identifier += sendFilePostfix
+        # Tells the master which format the files are in: older slaves don't send this
+        if framedFiles:
+            identifier += framedFilePostfix
     if getFiles:
         identifier += getFilePostfix
     if noReuse:
@@ -70,15 +75,40 @@ def parseIdentifier(line):
     if not tryReuse:
         line = line.replace(noReusePostfix, "")
 
+    getFiles = line.endswith(getFilePostfix)
+    if getFiles:
+        line = line.replace(getFilePostfix, "")
+
+    framedFiles = line.endswith(framedFilePostfix)
+    if framedFiles:
+        line = line.replace(framedFilePostfix, "")
+
     sendFiles = line.endswith(sendFilePostfix)
     if sendFiles:
         line = line.replace(sendFilePostfix, "")
 
-    getFiles = line.endswith(getFilePostfix)
-    if getFiles:
-        line = line.replace(getFilePostfix, "")
+    return line, sendFiles, getFiles, tryReuse, rerun, framedFiles
+
 
-    return line, sendFiles, getFiles, tryReuse, rerun
+# A slave that keeps one connection open for all its messages starts it with this line,
+# then sends each message as a frame: a line with its length, then the message itself.
+# The master answers each one with a frame, which may be empty.
+persistentConnectionText = "PERSISTENT_CONNECTION"
+
+
+def sendFrame(sendSocket, data):
+    sendSocket.sendall(str(len(data)).encode() + b"\n" + data)
+
+
+def receiveFrame(f):
+    header = f.readline()
+    if not header:
+        return  # connection closed between messages
+    length = int(header)
+    data = f.read(length)
+    if len(data) < length:
+        raise ConnectionError("Connection closed part way through receiving a message")
+    return data
 
 
 dirText = "DIRECTORY_CONTENTS"
@@ -86,23 +116,88 @@ fileText = "FILE_CONTENTS"
 endPrefix = "END_"
 
 
-def directorySerialise(dirName, ignoreLinks=False):
-    text = ""
+# Framed format: each file is a header line, then chunks each preceded by a line with their length,
+# then a zero length. Contents are sent as bytes, possibly compressed, so need not be text.
+# If a file shrinks while being sent, its chunk is padded and followed by a line giving its real length.
+chunkSize = 1024 * 1024
+truncateText = "TRUNCATE_FILE"
+
+
+def directorySend(sendSocket, dirName, compress=False):
     for root, _, files in os.walk(dirName):
         for fn in sorted(files):
             path = os.path.join(root, fn)
             if not os.path.islink(path):
                 relpath = plugins.relpath(path, dirName)
-                text += fileText + " " + relpath + "\n"
-                with open(path) as f:
-                    text += f.read()
-                if not text.endswith("\n"):
-                    text += "\n"
-                text += endPrefix + fileText + "\n"
-    text += endPrefix + dirText
-    return text
-
-
+                flag = b"z" if compress else b"-"
+                sendSocket.sendall(fileText.encode() + b" " + flag + b" " + os.fsencode(relpath) + b"\n")
+                with open(path, "rb") as f:
+                    if compress:
+                        sendCompressedChunks(sendSocket, f)
+                    else:
+                        sendWholeFile(sendSocket, f)
+                sendSocket.sendall(b"0\n")
+    sendSocket.sendall((endPrefix + dirText + "\n").encode())
+
+
+def sendWholeFile(sendSocket, f):
+    size = os.fstat(f.fileno()).st_size
+    if size:
+        sendSocket.sendall(str(size).encode() + b"\n")
+        sent = sendSocket.sendfile(f, 0, size)
+        if sent < size:  # file shrank while we were sending it: keep the framing intact, then cut it back
+            for padding in range(sent, size, chunkSize):
+                sendSocket.sendall(b"\0" * min(chunkSize, size - padding))
+            sendSocket.sendall(truncateText.encode() + b" " + str(sent).encode() + b"\n")
+
+
+def sendCompressedChunks(sendSocket, f):
+    compressor = zlib.compressobj()
+    for block in iter(lambda: f.read(chunkSize), b""):
+        sendChunk(sendSocket, compressor.compress(block))
+    sendChunk(sendSocket, compressor.flush())
+
+
+def sendChunk(sendSocket, data):
+    if data:
+        sendSocket.sendall(str(len(data)).encode() + b"\n" + data)
+
+
+def directoryReceive(rootDir, f):
+    while True:
+        header = f.readline()
+        if not header or header.startswith((endPrefix + dirText).encode()):
+            break
+        _, flag, relpath = header.rstrip(b"\n").split(b" ", 2)
+        path = os.path.normpath(os.path.join(rootDir, os.fsdecode(relpath)))
+        if not path.startswith(os.path.normpath(rootDir) + os.sep):
+            raise plugins.TextTestError("Refusing to write file outside sandbox: " + repr(path))
+        plugins.ensureDirExistsForFile(path)
+        decompressor = zlib.decompressobj() if flag == b"z" else None
+        with open(path, "wb") as currFile:
+            while True:
+                line = f.readline()
+                if line.startswith(truncateText.encode()):
+                    currFile.truncate(int(line.split()[-1]))
+                    continue
+                length = int(line)
+                if length == 0:
+                    break
+                receiveChunk(f, length, currFile, decompressor)
+            if decompressor:
+                currFile.write(decompressor.flush())
+
+
+def receiveChunk(f, length, currFile, decompressor):
+    while length > 0:
+        data = f.read(min(length, chunkSize))
+        if not data:
+            raise plugins.TextTestError("Connection closed part way through receiving a file")
+        length -= len(data)
+        currFile.write(decompressor.decompress(data) if decompressor else data)
+
+
+# Text format as sent by older slaves
 def directoryUnserialise(rootDir, f):
     currFile = None
     for line in f:
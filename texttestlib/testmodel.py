@@ -10,14 +10,17 @@ import logging
 import glob
 import functools
 import fnmatch
+import time
 
 from multiprocessing import cpu_count
 from collections import OrderedDict
 from pickle import Pickler, Unpickler, UnpicklingError
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkstemp, mkdtemp
 from copy import deepcopy
 from functools import reduce, cmp_to_key
+from bisect import bisect_left
 from locale import getpreferredencoding
 
 helpIntro = """
@@ -28,26 +31,46 @@ http://www.texttest.org
 
 
 class DirectoryCache:
-    def __init__(self, dir):
+    def __init__(self, dir, index=None):
         self.dir = dir
+        self.index = index
         self.contents = []
         self.refresh()
 
     def refresh(self):
         try:
-            self.contents = os.listdir(self.dir)
-            self.contents.sort()
+            if self.index:
+                self.contents = self.index.listDirectory(self.dir)
+            else:
+                self.contents = os.listdir(self.dir)
+                self.contents.sort()
         except OSError:  # usually caused by people removing stuff externally
             self.contents = []
+        self.contentSet = set(self.contents)
+        self.stemIndex = None
+
+    def getStemIndex(self):
+        # Stems get asked for repeatedly, so split the file names once, the first time it's needed.
+        # Files are grouped on the part before the first ".", which is all a stem can match,
+        # and we remember what version sets each stem has, all in the order of the directory listing
+        if self.stemIndex is None:
+            filesByFirstPart = OrderedDict()
+            stemVersionSets = OrderedDict()
+            for position, fileName in enumerate(self.contents):
+                stem, versionSet = self.splitStem(fileName)
+                filesByFirstPart.setdefault(stem, []).append(fileName)
+                if len(stem) > 0:
+                    stemVersionSets.setdefault(stem, []).append((position, versionSet))
+            self.stemIndex = filesByFirstPart, stemVersionSets, {}
+        return self.stemIndex
 
     def hasStem(self, stem):
-        for fileName in self.contents:
-            if fileName.startswith(stem):
-                return True
-        return False
+        # contents are sorted, so anything starting with the stem follows directly on from where it would be inserted
+        pos = bisect_left(self.contents, stem)
+        return pos < len(self.contents) and self.contents[pos].startswith(stem)
 
     def exists(self, fileName):
-        return fileName in self.contents
+        return fileName in self.contentSet
 
     def pathName(self, fileName):
         return os.path.join(self.dir, fileName)
@@ -75,22 +98,180 @@ class DirectoryCache:
             return newCache.findVersionSets(local, predicate)
 
         versionSets = OrderedDict()
-        for fileName in self.contents:
-            versionSet = self.findVersionSet(fileName, stem)
-            if versionSet is not None and (predicate is None or predicate(versionSet)):
-                versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
+        for versionSet, paths in self.getAllVersionSets(stem).items():
+            if predicate is None or predicate(versionSet):
+                versionSets[versionSet] = list(paths)
+        return versionSets
+
+    def getAllVersionSets(self, stem):
+        filesByFirstPart, _, versionSetsByStem = self.getStemIndex()
+        versionSets = versionSetsByStem.get(stem)
+        if versionSets is None:
+            versionSets = OrderedDict()
+            for fileName in filesByFirstPart.get(stem.split(".")[0], []):
+                versionSet = self.findVersionSet(fileName, stem)
+                if versionSet is not None:
+                    versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
+            versionSetsByStem[stem] = versionSets
         return versionSets
 
     def findStemsMatching(self, pattern):
         return self.findAllStems(lambda stem, vset: fnmatch.fnmatch(stem, pattern))
 
     def findAllStems(self, predicate=None):
-        stems = []
-        for file in self.contents:
-            stem, versionSet = self.splitStem(file)
-            if len(stem) > 0 and stem not in stems and (predicate is None or predicate(stem, versionSet)):
-                stems.append(stem)
-        return stems
+        stemVersionSets = self.getStemIndex()[1]
+        if predicate is None:
+            return list(stemVersionSets.keys())
+        else:
+            # Ordered by the first file that matches, not the first file with that stem
+            matches = []
+            for stem, versionSets in stemVersionSets.items():
+                for position, versionSet in versionSets:
+                    if predicate(stem, versionSet):
+                        matches.append((position, stem))
+                        break
+            return [stem for _, stem in sorted(matches)]
+
+
+# Persistent record of directory listings and parsed testsuite files, so that unchanged parts
+# of a large test tree don't need to be re-read from disk on every startup.
+# Everything is keyed on modification time and inode, so stale entries are simply ignored.
+class DirectoryIndex:
+    formatVersion = 1
+    # Don't trust stamps this recent: the directory could change again within the timestamp resolution
+    racyInterval = 2 * 10 ** 9
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.diag = logging.getLogger("directory index")
+        self.lock = Lock()
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        self.directories, self.testSuiteFiles = self.load()
+
+    def load(self):
+        if not os.path.isfile(self.fileName):
+            self.diag.info("No index found at " + self.fileName + ", reading test tree from scratch")
+            return {}, {}
+        try:
+            with open(self.fileName, "rb") as f:
+                version, directories, testSuiteFiles = Unpickler(f).load()
+            if version == self.formatVersion:
+                self.diag.info("Read index at " + self.fileName + " with " + str(len(directories)) + " directories")
+                return directories, testSuiteFiles
+            else:
+                self.diag.info("Index at " + self.fileName + " has old format version " + repr(version) + ", ignoring")
+        except Exception:
+            # Corrupt or truncated index: just fall back to reading everything
+            self.diag.info("Failed to read index at " + self.fileName + " :\n" + plugins.getExceptionString())
+        return {}, {}
+
+    def save(self):
+        with self.lock:
+            self.diag.info(self.getStatistics())
+            if not self.changed:
+                return
+            self.diag.info("Saving index to " + self.fileName)
+            try:
+                plugins.ensureDirExistsForFile(self.fileName)
+                tmpFile = self.fileName + ".tmp" + str(os.getpid())
+                with open(tmpFile, "wb") as f:
+                    Pickler(f, protocol=2).dump((self.formatVersion, self.directories, self.testSuiteFiles))
+                os.replace(tmpFile, self.fileName)
+                self.changed = False
+            except OSError as e:
+                plugins.printWarning("Could not save test tree index at " + self.fileName + " : " + str(e))
+
+    def getStatistics(self):
+        return str(self.hits) + " directories unchanged, " + str(self.misses) + " re-read"
+
+    def getStamp(self, path):
+        statObj = os.stat(path)
+        return statObj.st_ino, statObj.st_mtime_ns
+
+    def isTrustworthy(self, stamp):
+        return time.time_ns() - stamp[1] > self.racyInterval
+
+    def listDirectory(self, dir):
+        stamp = self.getStamp(dir)
+        with self.lock:
+            cached = self.directories.get(dir)
+            if cached and cached[0] == stamp:
+                self.hits += 1
+                return list(cached[1])
+        contents = os.listdir(dir)
+        contents.sort()
+        with self.lock:
+            self.misses += 1
+            if self.isTrustworthy(stamp):
+                self.directories[dir] = stamp, tuple(contents)
+                self.changed = True
+            else:
+                self.directories.pop(dir, None)
+        return contents
+
+    def readTestSuiteFile(self, fileName, readMethod, *args):
+        # Which tests get commented out depends on the directory contents, so that needs to be unchanged too
+        try:
+            stamp = self.getStamp(fileName), self.getStamp(os.path.dirname(fileName))
+        except OSError:
+            return readMethod(fileName, *args)
+        with self.lock:
+            cached = self.testSuiteFiles.get(fileName)
+            if cached and cached[0] == stamp:
+                return OrderedDict(cached[1]), OrderedDict(cached[2])
+        items, badItems = readMethod(fileName, *args)
+        # Absolute paths are checked outside the directory, so we can't tell if they've changed
+        if all(self.isTrustworthy(s) for s in stamp) and not any(os.path.isabs(name) for name in items):
+            with self.lock:
+                self.testSuiteFiles[fileName] = stamp, list(items.items()), list(badItems.items())
+                self.changed = True
+        return items, badItems
+
+
+# Reads directories of the test tree ahead of time in a pool of threads, so that on slow file systems
+# we wait for many directory listings at once rather than one at a time.
+# Tests are still created in order by the reading thread, which just picks up the results from here.
+class DirectoryPrefetcher:
+    def __init__(self, app, threadCount):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threadCount, thread_name_prefix="DirectoryPrefetcher")
+        self.futures = {}
+        self.lock = Lock()
+        self.diag = logging.getLogger("directory index")
+
+    def prefetchSubdirectories(self, dir, names):
+        with self.lock:
+            for name in names:
+                subdir = os.path.join(dir, name)
+                if subdir not in self.futures:
+                    self.futures[subdir] = self.executor.submit(self.readDirectory, subdir)
+
+    def readDirectory(self, dir):
+        dircache = DirectoryCache(dir, self.app.testTreeIndex)
+        if dircache.hasStem("testsuite." + self.app.name):
+            # Reading the file also has the effect of warming any file system caches for when we read it properly
+            contentFile = self.app.getFileNameFromCaches([dircache], "testsuite")
+            if contentFile:
+                self.prefetchSubdirectories(dir, plugins.readList(contentFile))
+        return dircache
+
+    def getDirectoryCache(self, dir):
+        with self.lock:
+            future = self.futures.pop(dir, None)
+        # If it hasn't been started yet, we're better off doing it ourselves than waiting in the queue
+        if future is None or future.cancel():
+            return DirectoryCache(dir, self.app.testTreeIndex)
+        try:
+            return future.result()
+        except Exception:
+            self.diag.info("Prefetching " + dir + " failed, reading it again :\n" + plugins.getExceptionString())
+            return DirectoryCache(dir, self.app.testTreeIndex)
+
+    def stop(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.futures = {}
 
 
 class DynamicMapping:
@@ -206,6 +387,9 @@ class TestEnvironment(OrderedDict):
 
 # Base class for TestCase and TestSuite
 class Test(plugins.Observable):
+    configCacheHits = 0
+    configCacheMisses = 0
+
     def __init__(self, name, description, dircache, app, parent=None):
         # Should notify which test it is
         plugins.Observable.__init__(self, passSelf=True)
@@ -217,6 +401,9 @@ class Test(plugins.Observable):
         self.parent = parent
         self.dircache = dircache
         self.configDir = None
+        # Expanded config values, valid as long as the application's config generation doesn't change
+        self.configCache = {}
+        self.configCacheGeneration = None
         self.diag = logging.getLogger("test objects")
         self.reloadConfiguration()
         populateFunction = plugins.Callable(app.setEnvironment, self)
@@ -246,6 +433,8 @@ class Test(plugins.Observable):
             newConfigDir = deepcopy(parentConfigDir)
             self.app.readValues(newConfigDir, "config", [self.dircache], insert=False, errorOnUnknown=True)
             self.configDir = newConfigDir
+            # Tests below us get their config from here too
+            self.app.configChanged()
             self.diagnose("config file settings are: " + "\n" + repr(self.configDir))
 
     def getConfigFileDefining(self, versionApp, sectionName, key, value):
@@ -309,6 +498,7 @@ class Test(plugins.Observable):
 
     def setEnvironment(self, var, value):
         self.environment[var] = value
+        self.configCache = {}
 
     def addProperty(self, var, value, propFile):
         if propFile not in self.properties:
@@ -555,7 +745,12 @@ class Test(plugins.Observable):
 
     def getConfigValue(self, key, expandVars=True, envMapping=None):
         if envMapping is None:
+            if expandVars:
+                return self.getCachedConfigValue((key,), self.lookUpConfigValue, key, expandVars, self.environment)
             envMapping = self.environment
+        return self.lookUpConfigValue(key, expandVars, envMapping)
+
+    def lookUpConfigValue(self, key, expandVars, envMapping):
         if self.configDir:
             return self.configDir.getSingle(key, expandVars, envMapping)
         else:
@@ -564,13 +759,41 @@ class Test(plugins.Observable):
 
     def getCompositeConfigValue(self, key, subKey, expandVars=True, envMapping=None):
         if envMapping is None:
+            if expandVars:
+                return self.getCachedConfigValue((key, subKey), self.lookUpCompositeConfigValue,
+                                                 key, subKey, expandVars, self.environment)
             envMapping = self.environment
+        return self.lookUpCompositeConfigValue(key, subKey, expandVars, envMapping)
+
+    def lookUpCompositeConfigValue(self, key, subKey, expandVars, envMapping):
         if self.configDir:
             return self.configDir.getComposite(key, subKey, expandVars, envMapping)
         else:
             confObj = self.parent or self.app
             return confObj.getCompositeConfigValue(key, subKey, expandVars, envMapping)
 
+    def getCachedConfigValue(self, cacheKey, lookUpMethod, *args):
+        generation = self.app.configGeneration
+        if generation != self.configCacheGeneration:
+            self.configCache = {}
+            self.configCacheGeneration = generation
+        if cacheKey in self.configCache:
+            Test.configCacheHits += 1
+            value = self.configCache[cacheKey]
+        else:
+            Test.configCacheMisses += 1
+            value = lookUpMethod(*args)
+            self.configCache[cacheKey] = value
+        # Callers are free to change what they get back, so they mustn't get our copy
+        return plugins.MultiEntryDictionary.copyValue(value)
+
+    @classmethod
+    def getConfigCacheStatistics(cls):
+        total = cls.configCacheHits + cls.configCacheMisses
+        hitRate = 100.0 * cls.configCacheHits / total if total else 0.0
+        return "Config lookups: " + str(cls.configCacheHits) + " cached, " + str(cls.configCacheMisses) + \
+            " computed (" + str(round(hitRate, 1)) + "% hit rate)"
+
     def configValueMatches(self, key, filePattern):
         for currPattern in self.getConfigValue(key):
             if fnmatch.fnmatch(filePattern, currPattern):
@@ -915,7 +1138,8 @@ class TestCase(Test):
         os.rename(newPath, os.path.join(os.path.dirname(newPath), "backup.aborted"))
         stateFile = self.getStateFile()
         if os.path.isfile(stateFile):
-            return plugins.getNewTestStateFromFile(open(stateFile))
+            with open(stateFile, "rb") as f:
+                return plugins.getNewTestStateFromFile(f)
 
     def backupPreviousTemporaryData(self, restoreLatest=False):
         writeDir = self.getDirectory(temporary=1)
@@ -994,17 +1218,22 @@ class TestSuiteFileHandler:
     def __init__(self):
         self.cache = {}
 
-    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None):
-        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod)
+    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None, index=None):
+        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod, index)
         goodTests = self.getTestWithDescriptions(items)
         self.cache[fileName] = items
         return goodTests, badTests
 
-    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None):
+    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None, index=None):
         if not ignoreCache:
             cached = self.cache.get(fileName)
             if cached is not None:
                 return cached, OrderedDict()
+            if index:
+                return index.readTestSuiteFile(fileName, self.readFromFile, filterMethod)
+        return self.readFromFile(fileName, filterMethod)
+
+    def readFromFile(self, fileName, filterMethod):
         return plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod))
 
     def getTestWithDescriptions(self, tests):
@@ -1169,7 +1398,7 @@ class TestSuite(Test):
             return testNames, OrderedDict()
         fileName = self.getContentFileName()
         if fileName:
-            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists)
+            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists, self.app.testTreeIndex)
         else:
             return OrderedDict(), OrderedDict()
 
@@ -1318,6 +1547,8 @@ class TestSuite(Test):
             return sorted(testNames, key=cmp_to_key(lambda a, b: self.compareTests(False, testCaseNames, a, b)))
 
     def createTestCases(self, filters, testNames, initial, guideSuite=None):
+        if self.app.testTreePrefetcher and not guideSuite:
+            self.app.testTreePrefetcher.prefetchSubdirectories(self.getDirectory(), list(testNames.keys()))
         testCaches = {}
         testCaseNames = []
         if self.autoSortOrder:
@@ -1343,7 +1574,11 @@ class TestSuite(Test):
                 subTest.notify("Add", initial)
 
     def createTestCache(self, testName):
-        return DirectoryCache(os.path.join(self.getDirectory(), testName))
+        dir = os.path.join(self.getDirectory(), testName)
+        if self.app.testTreePrefetcher:
+            return self.app.testTreePrefetcher.getDirectoryCache(dir)
+        else:
+            return DirectoryCache(dir, self.app.testTreeIndex)
 
     def getSubtestClass(self, cache):
         return TestSuite if cache.hasStem("testsuite." + self.app.name) else TestCase
@@ -1522,6 +1757,8 @@ class ConfigurationCall:
 
 class Application(object):
     def __init__(self, name, dircache, versions, inputOptions, configEntries={}):
+        # Incremented whenever the configuration changes, so tests know to discard cached values
+        self.configGeneration = 0
         self.name = name
         self.dircache = dircache
         # Place to store reference to extra_version applications
@@ -1533,6 +1770,8 @@ class Application(object):
         self.inputOptions = inputOptions
         self.configDir = plugins.MultiEntryDictionary(importKey="import_config_file", importFileFinder=self.configPath)
         self.overrideConfigDir = {}
+        self.testTreeIndex = None
+        self.testTreePrefetcher = None
         self.setUpConfiguration(configEntries)
         self.checkSanity()
         self.writeDirectory, self.localWriteDirectory = self.getWriteDirectories()
@@ -1608,6 +1847,10 @@ class Application(object):
         self.defaultDirCaches = tmpApp.defaultDirCaches
         self.configDocs = tmpApp.configDocs
         self.reapplyOverrides()
+        self.configChanged()
+
+    def configChanged(self):
+        self.configGeneration += 1
 
     def reapplyOverrides(self):
         for key, value in list(self.overrideConfigDir.items()):
@@ -1621,6 +1864,26 @@ class Application(object):
     def getConfigFileDefining(self, *args):
         return self.configDir.getFileDefining(*args)
 
+    def setUpTestTreeIndex(self, indices):
+        # Applications sharing an index file must share the index object too, or they'll overwrite each other
+        fileName = self.getConfigValue("test_tree_index_file")
+        if fileName:
+            fileName = os.path.normpath(os.path.expanduser(fileName))
+            if fileName not in indices:
+                indices[fileName] = DirectoryIndex(fileName)
+            self.testTreeIndex = indices[fileName]
+
+    def startTestTreePrefetcher(self):
+        threadCount = self.getConfigValue("test_tree_read_threads")
+        if threadCount > 0:
+            self.testTreePrefetcher = DirectoryPrefetcher(self, threadCount)
+        return self.testTreePrefetcher
+
+    def stopTestTreePrefetcher(self):
+        if self.testTreePrefetcher:
+            self.testTreePrefetcher.stop()
+            self.testTreePrefetcher = None
+
     def writeConfigEntries(self, configEntries):
         configFileName = self.dircache.pathName("config." + self.name)
         configFile = open(configFileName, "w")
@@ -1922,6 +2185,10 @@ class Application(object):
                               "Mapping of version names to a priority order in case of conflict.")
         self.setConfigDefault("extra_search_directory", {"default": []},
                               "Additional directories to search for TextTest files")
+        self.setConfigDefault("test_tree_index_file", "",
+                              "File to store an index of the test tree in, to avoid re-reading unchanged directories at startup")
+        self.setConfigDefault("test_tree_read_threads", 0,
+                              "Number of threads to read test directories with in parallel at startup. 0 means read them sequentially")
         self.setConfigDefault("filename_convention_scheme", "classic",
                               "Naming scheme to use for files for stdin,stdout and stderr")
         self.setConfigAlias("test_data_searchpath", "extra_search_directory")
@@ -2126,14 +2393,17 @@ class Application(object):
 
     def addConfigEntry(self, key, value, sectionName="", **kw):
         self.configDir.addEntry(key, value, sectionName, insert=False, errorOnUnknown=True, **kw)
+        self.configChanged()
 
     def addConfigEntryOverride(self, key, value, sectionName):
         self.configDir.addEntry(key, value, sectionName, insert=False,
                                 errorOnUnknown=True, errorOnClashWithGlobal=False)
         self.overrideConfigDir.setdefault(sectionName, {})[key] = value
+        self.configChanged()
 
     def removeConfigEntry(self, key, value, sectionName=""):
         self.configDir.removeEntry(key, value, sectionName)
+        self.configChanged()
 
     def setConfigDefault(self, key, value, docString="", trackFiles=False):
         self.configDir[key] = value
@@ -2141,10 +2411,12 @@ class Application(object):
             self.configDir.addFileTracking(key)
         if len(docString) > 0:
             self.configDocs[key] = docString
+        self.configChanged()
 
     def setConfigOverride(self, key, value):
         self.configDir[key] = value
         self.overrideConfigDir[key] = value
+        self.configChanged()
 
     def setConfigAlias(self, aliasName, realName):
         self.configDir.setAlias(aliasName, realName)